@@ -1,5 +1,7 @@
-from .doge_alignment import AlignmentCog
+from .doge_alignment import AlignmentCog, load_settings, settings_config
 
 
 async def setup(bot):
-    await bot.add_cog(AlignmentCog(bot))
+    config = settings_config()
+    settings = await load_settings(config)
+    await bot.add_cog(AlignmentCog(bot, config=config, **settings))
@@ -1,65 +1,872 @@
 from __future__ import annotations
 
+import asyncio
+import contextlib
+import csv
+import json
+import logging
+import time
+from io import BytesIO
+from itertools import islice
 from pathlib import Path
+from typing import TYPE_CHECKING, Literal
 
+import aiohttp
 import discord
-from redbot.core import app_commands, commands
-
-from doge_cogs.alignment import (
-        load_file_buffer,
-        parse_alignment_chart,
-        remove_user_alignment,
-        save_file_buffer,
-        serialize_alignment_chart,
-        set_user_alignment,
+import yaml
+from redbot.core import Config, app_commands, commands
+
+from doge_cogs.alignment import AlignmentChart, ChartStyle, RenderEngine
+from doge_cogs.avatars import AvatarDiskCache, AvatarFetcher
+from doge_cogs.cache import (
+        DEFAULT_FLUSH_AFTER,
+        DEFAULT_FLUSH_INTERVAL,
+        DEFAULT_MAX_GUILDS,
+        DEFAULT_WARM_CONCURRENCY,
+        ChartCache,
+)
+from doge_cogs.metrics import Metrics
+from doge_cogs.pages import ChartPages, PagesCache
+from doge_cogs.refresh import Profile, ProfileRefresher
+from doge_cogs.render import (
+        DEFAULT_RENDER_WORKERS,
+        RenderFlights,
+        RenderKey,
+        RenderPool,
+)
+from doge_cogs.sqlite_storage import SqliteBackend
+from doge_cogs.storage import (
+        DEFAULT_IO_WORKERS,
+        ChartBackend,
+        ChartStorage,
+        ShardedBackend,
+        YamlBackend,
 )
+from doge_cogs.tiles import TileCache
+from doge_cogs.transfer import (
+        DEFAULT_IMPORT_BYTES,
+        IMPORT_BATCH_OPS,
+        download_to_spool,
+        export_to_spool,
+        format_for_filename,
+        import_chart_ops,
+)
+
+if TYPE_CHECKING:
+        from collections.abc import Sequence
+
+        from doge_cogs.alignment import AlignmentOp
+
+log = logging.getLogger(__name__)
+
+# Names listed by /alignment_filter, keeps replies under 2000 characters
+FILTER_LIMIT = 50
+# Charts preloaded at cog load, from the most recently used last time
+DEFAULT_WARM_GUILDS = 16
+# How often the Prometheus text file is rewritten, in seconds
+METRICS_DUMP_INTERVAL = 60.0
+# Where interaction_check leaves the time a command arrived
+_STARTED = "doge_alignment_started"
+CONFIG_IDENTIFIER = 0x646F6765
+# AlignmentCog keyword arguments kept in Red's Config, read by setup
+DEFAULT_SETTINGS: dict[str, str | int | float | bool] = {
+        "backend": "yaml",
+        "io_workers": DEFAULT_IO_WORKERS,
+        "render_workers": DEFAULT_RENDER_WORKERS,
+        "render_engine": "wand",
+        "warm_guilds": DEFAULT_WARM_GUILDS,
+        "warm_concurrency": DEFAULT_WARM_CONCURRENCY,
+        "max_guilds": DEFAULT_MAX_GUILDS,
+        "flush_interval": DEFAULT_FLUSH_INTERVAL,
+        "flush_after": DEFAULT_FLUSH_AFTER,
+        "metrics": True,
+}
+_SETTING_CHOICES = {
+        "backend": ("yaml", "sqlite", "sharded"),
+        "render_engine": ("wand", "numpy"),
+}
+# Settings where 0 turns something off; the rest must be positive
+_ZERO_ALLOWED = ("render_workers", "warm_guilds")
+
+
+def settings_config() -> Config:
+        """Return the Config holding the cog's settings."""
+        config = Config.get_conf(
+                None, identifier=CONFIG_IDENTIFIER, cog_name="AlignmentCog"
+        )
+        config.register_global(**DEFAULT_SETTINGS)
+        return config
+
+
+async def load_settings(
+        config: Config,
+) -> dict[str, str | int | float | bool]:
+        """Read the settings to create the cog with."""
+        stored = await config.all()
+        return {name: stored[name] for name in DEFAULT_SETTINGS}
+
+
+def parse_setting(name: str, value: str) -> str | int | float | bool:
+        """Convert a setting typed by the owner, or raise ``ValueError``."""
+        choices = _SETTING_CHOICES.get(name)
+        if choices is not None:
+                if value not in choices:
+                        msg = f"{name} must be one of {', '.join(choices)}"
+                        raise ValueError(msg)
+                return value
+        default = DEFAULT_SETTINGS[name]
+        if isinstance(default, bool):
+                if value.lower() not in ("true", "false"):
+                        msg = f"{name} must be true or false"
+                        raise ValueError(msg)
+                return value.lower() == "true"
+        try:
+                parsed = type(default)(value)
+        except ValueError:
+                msg = f"{name} must be a number"
+                raise ValueError(msg) from None
+        minimum = 0 if name in _ZERO_ALLOWED else 1
+        if parsed < minimum:
+                msg = f"{name} must be at least {minimum}"
+                raise ValueError(msg)
+        return parsed
+
+
+class ChartPageView(discord.ui.View):
+        """Previous/next buttons paging through an alignment_show reply.
+
+        It holds the ``(guild, version)`` key of its pages, not the pages,
+        and each click pages the guild's current chart version.
+        """
+
+        def __init__(
+                self,
+                cog: AlignmentCog,
+                key: tuple[int, int],
+                page_count: int,
+                *,
+                timeout: float = 600,
+        ) -> None:
+                super().__init__(timeout=timeout)
+                self.cog = cog
+                self.key = key
+                self.number = 0
+                self._update_buttons(page_count)
+
+        def _update_buttons(self, page_count: int) -> None:
+                self.previous_page.disabled = self.number <= 0
+                self.next_page.disabled = self.number >= page_count - 1
+
+        async def _show(
+                self, interaction: discord.Interaction, number: int
+        ) -> None:
+                guild_id = self.key[0]
+                version, pages = await self.cog.chart_pages(guild_id)
+                self.key = (guild_id, version)
+                self.number = max(0, min(number, len(pages) - 1))
+                self._update_buttons(len(pages))
+                await interaction.response.edit_message(
+                        content=pages.page(self.number), view=self
+                )
+
+        @discord.ui.button(label="Previous", style=discord.ButtonStyle.gray)
+        async def previous_page(
+                self,
+                interaction: discord.Interaction,
+                button: discord.ui.Button,  # noqa: ARG002
+        ) -> None:
+                await self._show(interaction, self.number - 1)
+
+        @discord.ui.button(label="Next", style=discord.ButtonStyle.gray)
+        async def next_page(
+                self,
+                interaction: discord.Interaction,
+                button: discord.ui.Button,  # noqa: ARG002
+        ) -> None:
+                await self._show(interaction, self.number + 1)
 
 
 class AlignmentCog(commands.Cog):
         """Cog for keeping track of alignment charts."""
 
-        def __init__(self, bot) -> None:
+        def __init__(
+                self,
+                bot,
+                *,
+                backend: Literal["yaml", "sqlite", "sharded"] = "yaml",
+                io_workers: int = DEFAULT_IO_WORKERS,
+                render_workers: int = DEFAULT_RENDER_WORKERS,
+                render_engine: RenderEngine = "wand",
+                warm_guilds: int = DEFAULT_WARM_GUILDS,
+                warm_concurrency: int = DEFAULT_WARM_CONCURRENCY,
+                max_guilds: int = DEFAULT_MAX_GUILDS,
+                flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+                flush_after: int = DEFAULT_FLUSH_AFTER,
+                metrics: bool = True,
+                data_dir: Path | None = None,
+                config: Config | None = None,
+        ) -> None:
                 self.bot = bot
-                self.data_dir = Path(__file__).parent / "data"
+                # Where /alignment_settings stores settings, if anywhere
+                self.config = config
+                self.warm_guilds = warm_guilds
+                self.warm_concurrency = warm_concurrency
+                self._warm_task: asyncio.Task | None = None
+                self.data_dir = data_dir or Path(__file__).parent / "data"
+                self.recent_guilds_path = self.data_dir / "recent_guilds.json"
+                self.metrics = Metrics(enabled=metrics)
+                self.metrics_path = self.data_dir / "metrics.prom"
+                self._metrics_task: asyncio.Task | None = None
+                self.storage = ChartStorage(
+                        self._make_backend(backend, max_guilds),
+                        max_workers=io_workers,
+                )
+                self.charts = ChartCache(
+                        self._load_chart,
+                        self._save_chart,
+                        max_guilds=max_guilds,
+                        flush_interval=flush_interval,
+                        flush_after=flush_after,
+                )
+                self.tiles = TileCache()
+                self.renderer = RenderPool(
+                        ChartStyle(engine=render_engine),
+                        max_workers=render_workers,
+                        tiles=self.tiles,
+                )
+                self.renders = RenderFlights()
+                # Without Wand, every show would log the same failure
+                self._render_unavailable_logged = False
+                self.pages = PagesCache()
+                self.charts.add_listener(self.renderer.note_ops)
+                self.charts.add_listener(self.renders.note_ops)
+                self.avatars = AvatarFetcher(
+                        cache=AvatarDiskCache(self.data_dir / "avatars")
+                )
+                self.metrics.add_cache("charts", self.charts)
+                self.metrics.add_cache("renders", self.renders)
+                # The renderer sums the tile caches of its worker processes
+                self.metrics.add_cache("tiles", self.renderer)
+                self.refresher = ProfileRefresher(self._apply_profiles)
+
+        async def _load_chart(self, guild_id: int) -> AlignmentChart:
+                with self.metrics.span("load"):
+                        return await self.storage.load(guild_id)
+
+        async def _save_chart(
+                self,
+                guild_id: int,
+                chart: AlignmentChart,
+                ops: Sequence[AlignmentOp],
+        ) -> None:
+                with self.metrics.span("save"):
+                        await self.storage.save(guild_id, chart, ops)
+
+        async def _is_owner(self, user: discord.abc.User) -> bool:
+                with self.metrics.span("is_owner"):
+                        return await self.bot.is_owner(user)
+
+        async def _respond(
+                self,
+                interaction: discord.Interaction,
+                content: str,
+                **kwargs: object,
+        ) -> None:
+                with self.metrics.span("respond"):
+                        await interaction.response.send_message(
+                                content, **kwargs
+                        )
+
+        async def interaction_check(
+                self, interaction: discord.Interaction
+        ) -> bool:
+                if self.metrics.enabled:
+                        interaction.extras[_STARTED] = time.perf_counter()
+                return True
+
+        def _command_finished(self, interaction: discord.Interaction) -> None:
+                started = interaction.extras.pop(_STARTED, None)
+                if started is not None and interaction.command is not None:
+                        self.metrics.observe(
+                                "command",
+                                interaction.command.qualified_name,
+                                time.perf_counter() - started,
+                        )
+
+        @commands.Cog.listener()
+        async def on_app_command_completion(
+                self,
+                interaction: discord.Interaction,
+                command: app_commands.Command,  # noqa: ARG002
+        ) -> None:
+                self._command_finished(interaction)
+
+        async def cog_app_command_error(
+                self,
+                interaction: discord.Interaction,
+                error: app_commands.AppCommandError,  # noqa: ARG002
+        ) -> None:
+                # Failed commands count too, the bot still reports the error
+                self._command_finished(interaction)
+
+        async def _write_metrics(self) -> None:
+                # Rendered here on the loop, where metrics are recorded
+                text = self.metrics.prometheus_text()
+                try:
+                        await asyncio.to_thread(
+                                self.metrics.write_prometheus,
+                                self.metrics_path,
+                                text,
+                        )
+                except OSError:
+                        log.exception("Could not write metrics")
+
+        async def _dump_metrics(self) -> None:
+                while True:
+                        await asyncio.sleep(METRICS_DUMP_INTERVAL)
+                        await self._write_metrics()
+
+        async def _apply_profiles(
+                self,
+                guild_id: int,
+                profiles: dict[str, Profile],
+        ) -> None:
+                async with self.charts.lock(guild_id):
+                        chart = await self.charts.get(guild_id)
+                        ops: list[AlignmentOp] = []
+                        for user_id, profile in profiles.items():
+                                entry = chart["users"].get(user_id)
+                                # Skip users removed since, or back as they were
+                                if entry is None or profile == (
+                                        entry["display_name"],
+                                        entry["avatar_url"],
+                                ):
+                                        continue
+                                ops.append(
+                                        {
+                                                "op": "set",
+                                                "user_id": user_id,
+                                                "alignment": entry["alignment"],
+                                                "display_name": profile[0],
+                                                "avatar_url": profile[1],
+                                        }
+                                )
+                        if ops:
+                                with self.metrics.span("refresh"):
+                                        await self.charts.put(guild_id, *ops)
+
+        def _note_profile(self, guild_id: int, member: discord.Member) -> None:
+                # Only resident charts; others are refreshed by the next
+                # command their users run
+                chart = self.charts.peek(guild_id)
+                user_id = str(member.id)
+                if chart is None or user_id not in chart["users"]:
+                        return
+                avatar = member.display_avatar
+                self.refresher.note(
+                        guild_id,
+                        user_id,
+                        Profile(
+                                member.display_name,
+                                avatar.url if avatar else None,
+                        ),
+                )
+
+        @commands.Cog.listener()
+        async def on_member_update(
+                self,
+                before: discord.Member,
+                after: discord.Member,
+        ) -> None:
+                if (
+                        before.display_name != after.display_name
+                        or before.display_avatar != after.display_avatar
+                ):
+                        self._note_profile(after.guild.id, after)
+
+        @commands.Cog.listener()
+        async def on_user_update(
+                self,
+                before: discord.User,
+                after: discord.User,
+        ) -> None:
+                if (
+                        before.display_name == after.display_name
+                        and before.display_avatar == after.display_avatar
+                ):
+                        return
+                for guild_id in self.charts.recent_guilds():
+                        guild = self.bot.get_guild(guild_id)
+                        member = guild and guild.get_member(after.id)
+                        if member is not None:
+                                self._note_profile(guild_id, member)
+
+        def _make_backend(self, backend: str, max_guilds: int) -> ChartBackend:
+                # Move existing YAML data over with
+                # python -m doge_cogs.sqlite_storage <data_dir> <db_path>
+                if backend == "sqlite":
+                        self.data_dir.mkdir(parents=True, exist_ok=True)
+                        return SqliteBackend(self.data_dir / "alignment.db")
+                # Switching between these two converts each guild's files
+                # on its next load
+                if backend == "sharded":
+                        return ShardedBackend(
+                                self.data_dir, max_guilds=max_guilds
+                        )
+                return YamlBackend(self.data_dir)
+
+        def _read_recent_guilds(self) -> list[int]:
+                try:
+                        return [
+                                int(g)
+                                for g in json.loads(
+                                        self.recent_guilds_path.read_text()
+                                )
+                        ]
+                except (OSError, ValueError, TypeError):
+                        return []
+
+        def _write_recent_guilds(self, guild_ids: list[int]) -> None:
                 self.data_dir.mkdir(parents=True, exist_ok=True)
+                self.recent_guilds_path.write_text(json.dumps(guild_ids))
+
+        async def _warm(self) -> None:
+                guild_ids = await asyncio.to_thread(self._read_recent_guilds)
+                await self.charts.warm(
+                        guild_ids[: self.warm_guilds],
+                        concurrency=self.warm_concurrency,
+                )
+
+        async def cog_load(self) -> None:
+                self.charts.start()
+                if self.metrics.enabled:
+                        self.data_dir.mkdir(parents=True, exist_ok=True)
+                        self._metrics_task = asyncio.create_task(
+                                self._dump_metrics()
+                        )
+                if self.warm_guilds > 0:
+                        # In the background, so loading the cog stays fast;
+                        # commands arriving meanwhile share the loads
+                        self._warm_task = asyncio.create_task(self._warm())
+
+        async def cog_unload(self) -> None:
+                # Bot.close() removes every cog, so this also runs on shutdown
+                # Awaited, so no warm load lands after the flush
+                for task in (self._warm_task, self._metrics_task):
+                        if task is None:
+                                continue
+                        task.cancel()
+                        with contextlib.suppress(asyncio.CancelledError):
+                                await task
+                recent = self.charts.recent_guilds()
+                await self.refresher.close()
+                await self.charts.close()
+                if self.metrics.enabled:
+                        await self._write_metrics()
+                try:
+                        await asyncio.to_thread(
+                                self._write_recent_guilds, recent
+                        )
+                except OSError:
+                        log.exception("Could not record recently used guilds")
+                # Waits for queued I/O, so off the event loop
+                await asyncio.to_thread(self.storage.close)
+                await self.avatars.close()
+                self.renderer.close()
+
+        async def _render_chart(
+                self,
+                guild_id: int,
+                chart: AlignmentChart,
+        ) -> bytes:
+                avatars = await self.avatars.fetch_many(
+                        {
+                                uid: entry["avatar_url"]
+                                for uid, entry in chart["users"].items()
+                        }
+                )
+                return await self.renderer.render(guild_id, chart, avatars)
 
-        def _get_server_file(self, guild_id: int) -> Path:
-                return self.data_dir / f"{guild_id}.yaml"
+        async def chart_pages(self, guild_id: int) -> tuple[int, ChartPages]:
+                """Return a guild's current chart version and its pages."""
+                index = await self.charts.index(guild_id)
+                chart = await self.charts.get(guild_id)
+                version = self.charts.version(guild_id)
+                return version, self.pages.get(guild_id, version, chart, index)
 
         @app_commands.command(
                 name="alignment_show",
                 description="Display current alignment chart data.",
         )
         async def alignment_show(self, interaction: discord.Interaction):
-                """Display current alignment chart (text form for now)."""
+                """Display the current alignment chart as an image and text."""
                 guild_id = interaction.guild_id
                 if guild_id is None:
-                        await interaction.response.send_message(
+                        await self._respond(
+                                interaction,
                                 "This command must be used in a server.",
                                 ephemeral=True,
                         )
                         return
 
-                file_path = self._get_server_file(guild_id)
-                raw_data = load_file_buffer(file_path)
-                chart = parse_alignment_chart(raw_data)
+                version, pages = await self.chart_pages(guild_id)
+                chart = pages.chart
 
                 if not chart["users"]:
-                        await interaction.response.send_message(
-                                "No alignments set yet.", ephemeral=True
+                        await self._respond(
+                                interaction,
+                                "No alignments set yet.",
+                                ephemeral=True,
+                        )
+                        return
+                # Before any await; the index moves on with the chart
+                text = pages.page(0)
+                view = ChartPageView(self, (guild_id, version), len(pages))
+
+                # Rendering can outlast the interaction's 3 second deadline
+                await interaction.response.defer(ephemeral=True, thinking=True)
+                # Everyone showing the same chart shares one render
+                try:
+                        with self.metrics.span("render"):
+                                image = await self.renders.get(
+                                        RenderKey(
+                                                guild_id,
+                                                version,
+                                                self.renderer.style,
+                                        ),
+                                        lambda: self._render_chart(
+                                                guild_id, chart
+                                        ),
+                                )
+                except ImportError as e:
+                        # Wand or ImageMagick is missing; the text still works
+                        if not self._render_unavailable_logged:
+                                self._render_unavailable_logged = True
+                                log.warning(
+                                        "Chart rendering is unavailable: %s", e
+                                )
+                        await interaction.followup.send(
+                                text,
+                                view=view,
+                                ephemeral=True,
+                        )
+                        return
+                with self.metrics.span("respond"):
+                        await interaction.followup.send(
+                                text,
+                                file=discord.File(
+                                        BytesIO(image),
+                                        filename="alignment.png",
+                                ),
+                                view=view,
+                                ephemeral=True,
+                        )
+
+        @app_commands.command(
+                name="alignment_stats",
+                description="Show how many users have each alignment.",
+        )
+        async def alignment_stats(self, interaction: discord.Interaction):
+                guild_id = interaction.guild_id
+                if guild_id is None:
+                        await self._respond(
+                                interaction,
+                                "This command must be used in a server.",
+                                ephemeral=True,
+                        )
+                        return
+
+                counts = (await self.charts.index(guild_id)).counts()
+                lines = [f"**{name}** — {n}" for name, n in counts.items()]
+                lines.append(f"Total: {sum(counts.values())}")
+                await self._respond(
+                        interaction, "\n".join(lines), ephemeral=True
+                )
+
+        @app_commands.command(
+                name="alignment_metrics",
+                description="Show command latencies and cache hit rates.",
+        )
+        async def alignment_metrics(self, interaction: discord.Interaction):
+                if not await self._is_owner(interaction.user):
+                        await self._respond(
+                                interaction,
+                                "Only the bot owner can view metrics.",
+                                ephemeral=True,
+                        )
+                        return
+                if not self.metrics.enabled:
+                        await self._respond(
+                                interaction,
+                                "Metrics are disabled.",
+                                ephemeral=True,
+                        )
+                        return
+
+                text = self.metrics.prometheus_text()
+                await self._respond(
+                        interaction,
+                        self.metrics.summary()[:2000],
+                        file=discord.File(
+                                BytesIO(text.encode()), filename="metrics.prom"
+                        ),
+                        ephemeral=True,
+                )
+
+        @app_commands.command(
+                name="alignment_settings",
+                description="Show or change the cog's settings.",
+        )
+        @app_commands.describe(
+                setting="The setting to change.",
+                value="Its new value, applied when the cog is next loaded.",
+        )
+        @app_commands.choices(
+                setting=[
+                        app_commands.Choice(name=name, value=name)
+                        for name in DEFAULT_SETTINGS
+                ]
+        )
+        async def alignment_settings(
+                self,
+                interaction: discord.Interaction,
+                setting: str | None = None,
+                value: str | None = None,
+        ):
+                if not await self._is_owner(interaction.user):
+                        await self._respond(
+                                interaction,
+                                "Only the bot owner can change settings.",
+                                ephemeral=True,
+                        )
+                        return
+                if self.config is None:
+                        await self._respond(
+                                interaction,
+                                "Settings were passed in and are not stored.",
+                                ephemeral=True,
+                        )
+                        return
+
+                if setting is not None and value is not None:
+                        try:
+                                parsed = parse_setting(setting, value)
+                        except ValueError as e:
+                                await self._respond(
+                                        interaction, str(e), ephemeral=True
+                                )
+                                return
+                        await self.config.get_attr(setting).set(parsed)
+                        await self._respond(
+                                interaction,
+                                f"Set {setting} to {parsed}. Reload the cog"
+                                " to apply it.",
+                                ephemeral=True,
+                        )
+                        return
+
+                stored = await load_settings(self.config)
+                await self._respond(
+                        interaction,
+                        "\n".join(f"{name}: {stored[name]}" for name in stored),
+                        ephemeral=True,
+                )
+
+        @app_commands.command(
+                name="alignment_filter",
+                description="List the users with an alignment.",
+        )
+        @app_commands.describe(alignment="The alignment to list.")
+        @app_commands.choices(
+                alignment=[
+                        app_commands.Choice(name=a, value=a)
+                        for a in (
+                                "Lawful Good",
+                                "Neutral Good",
+                                "Chaotic Good",
+                                "Lawful Neutral",
+                                "True Neutral",
+                                "Chaotic Neutral",
+                                "Lawful Evil",
+                                "Neutral Evil",
+                                "Chaotic Evil",
+                        )
+                ]
+        )
+        async def alignment_filter(
+                self,
+                interaction: discord.Interaction,
+                alignment: app_commands.Choice[str],
+        ):
+                guild_id = interaction.guild_id
+                if guild_id is None:
+                        await self._respond(
+                                interaction,
+                                "This command must be used in a server.",
+                                ephemeral=True,
+                        )
+                        return
+
+                index = await self.charts.index(guild_id)
+                chart = await self.charts.get(guild_id)
+                name = alignment.value
+                count = index.count(name)  # type: ignore
+                if not count:
+                        await self._respond(
+                                interaction,
+                                f"Nobody is **{name}** yet.",
+                                ephemeral=True,
+                        )
+                        return
+
+                # Only the listed users are looked at, not the whole chart
+                names = [
+                        chart["users"][uid]["display_name"]
+                        for uid in islice(
+                                index.users(name),  # type: ignore
+                                FILTER_LIMIT,
+                        )
+                ]
+                text = f"**{name}** ({count}): " + ", ".join(names)
+                if count > len(names):
+                        text += f" and {count - len(names)} more"
+                await self._respond(interaction, text, ephemeral=True)
+
+        async def _is_admin(
+                self,
+                interaction: discord.Interaction,
+                chart: AlignmentChart,
+        ) -> bool:
+                invoker_id = str(interaction.user.id)
+                return (
+                        invoker_id == str(interaction.guild.owner_id)
+                        or invoker_id in chart["admins"]
+                        or await self._is_owner(interaction.user)
+                )
+
+        @app_commands.command(
+                name="alignment_export",
+                description="Download the alignment chart as CSV or YAML.",
+        )
+        @app_commands.describe(file_format="The file format to export.")
+        @app_commands.choices(
+                file_format=[
+                        app_commands.Choice(name="CSV", value="csv"),
+                        app_commands.Choice(name="YAML", value="yaml"),
+                ]
+        )
+        async def alignment_export(
+                self,
+                interaction: discord.Interaction,
+                file_format: app_commands.Choice[str],
+        ):
+                guild_id = interaction.guild_id
+                if guild_id is None:
+                        await self._respond(
+                                interaction,
+                                "This command must be used in a server.",
+                                ephemeral=True,
                         )
                         return
 
-                lines = []
-                for uid, entry in chart["users"].items():
-                        lines.append(
-                                f"**{entry['display_name']}** — "
-                                f"{entry['alignment']}"
+                chart = await self.charts.get(guild_id)
+                if not await self._is_admin(interaction, chart):
+                        await self._respond(
+                                interaction,
+                                "Only alignment admins can export the chart.",
+                                ephemeral=True,
                         )
-                text_output = "\n".join(lines)
+                        return
 
-                await interaction.response.send_message(
-                        text_output, ephemeral=True
+                await interaction.response.defer(ephemeral=True, thinking=True)
+                # Written row by row into a spool, off the event loop
+                out = await asyncio.to_thread(
+                        export_to_spool, chart, file_format.value
+                )
+                with out:
+                        await interaction.followup.send(
+                                f"{len(chart['users'])} alignments exported.",
+                                file=discord.File(
+                                        out, f"alignment.{file_format.value}"
+                                ),
+                                ephemeral=True,
+                        )
+
+        @app_commands.command(
+                name="alignment_import",
+                description="Set alignments in bulk from a CSV or YAML file.",
+        )
+        @app_commands.describe(
+                file="A CSV (user_id, alignment, display_name, avatar_url)"
+                " or YAML chart file.",
+        )
+        async def alignment_import(
+                self,
+                interaction: discord.Interaction,
+                file: discord.Attachment,
+        ):
+                guild_id = interaction.guild_id
+                if guild_id is None:
+                        await self._respond(
+                                interaction,
+                                "This command must be used in a server.",
+                                ephemeral=True,
+                        )
+                        return
+
+                chart = await self.charts.get(guild_id)
+                if not await self._is_admin(interaction, chart):
+                        await self._respond(
+                                interaction,
+                                "Only alignment admins can import alignments.",
+                                ephemeral=True,
+                        )
+                        return
+                file_format = format_for_filename(file.filename)
+                if file_format is None or file.size > DEFAULT_IMPORT_BYTES:
+                        await self._respond(
+                                interaction,
+                                "Attach a .csv or .yaml file of at most"
+                                f" {DEFAULT_IMPORT_BYTES // 2**20} MiB.",
+                                ephemeral=True,
+                        )
+                        return
+
+                await interaction.response.defer(ephemeral=True, thinking=True)
+                imported = 0
+                try:
+                        data = await download_to_spool(
+                                self.avatars.session, file.url
+                        )
+                        with data:
+                                ops = import_chart_ops(file_format, data)
+                                # One chart copy and one write per batch
+                                while batch := await asyncio.to_thread(
+                                        list, islice(ops, IMPORT_BATCH_OPS)
+                                ):
+                                        await self.charts.update(
+                                                guild_id, *batch
+                                        )
+                                        await self.charts.flush(guild_id)
+                                        imported += len(batch)
+                except (
+                        aiohttp.ClientError,
+                        TimeoutError,
+                        csv.Error,
+                        yaml.YAMLError,
+                        TypeError,
+                        ValueError,
+                ) as e:
+                        # Batches already applied stay, say how many
+                        await interaction.followup.send(
+                                f"Import failed after {imported} alignments:"
+                                f" {e}",
+                                ephemeral=True,
+                        )
+                        return
+
+                await interaction.followup.send(
+                        f"Imported {imported} alignments.", ephemeral=True
                 )
 
         @app_commands.command(
@@ -89,32 +896,31 @@ class AlignmentCog(commands.Cog):
         ):
                 guild_id = interaction.guild_id
                 if guild_id is None or interaction.user is None:
-                        await interaction.response.send_message(
+                        await self._respond(
+                                interaction,
                                 "This command must be used in a server.",
                                 ephemeral=True,
                         )
                         return
 
-                file_path = self._get_server_file(guild_id)
-                raw_data = load_file_buffer(file_path)
-                chart = parse_alignment_chart(raw_data)
-
-                updated_chart = set_user_alignment(
-                        chart,
-                        user_id=str(interaction.user.id),
-                        alignment=alignment.value,  # type: ignore
-                        display_name=interaction.user.display_name,
-                        avatar_url=(
-                                interaction.user.display_avatar.url
-                                if interaction.user.display_avatar
-                                else None
-                        ),
-                )
-
-                save_file_buffer(
-                        file_path, serialize_alignment_chart(updated_chart)
-                )
-                await interaction.response.send_message(
+                user = interaction.user
+                with self.metrics.span("mutate"):
+                        await self.charts.update(
+                                guild_id,
+                                {
+                                        "op": "set",
+                                        "user_id": str(user.id),
+                                        "alignment": alignment.value,  # type: ignore
+                                        "display_name": user.display_name,
+                                        "avatar_url": (
+                                                user.display_avatar.url
+                                                if user.display_avatar
+                                                else None
+                                        ),
+                                },
+                        )
+                await self._respond(
+                        interaction,
                         f"Alignment set to **{alignment.value}**.",
                         ephemeral=True,
                 )
@@ -126,33 +932,39 @@ class AlignmentCog(commands.Cog):
         async def alignment_remove(self, interaction: discord.Interaction):
                 guild_id = interaction.guild_id
                 if guild_id is None or interaction.user is None:
-                        await interaction.response.send_message(
+                        await self._respond(
+                                interaction,
                                 "This command must be used in a server.",
                                 ephemeral=True,
                         )
                         return
 
-                file_path = self._get_server_file(guild_id)
-                raw_data = load_file_buffer(file_path)
-                chart = parse_alignment_chart(raw_data)
-
-                updated_chart = remove_user_alignment(
-                        chart, str(interaction.user.id)
-                )
-                save_file_buffer(
-                        file_path, serialize_alignment_chart(updated_chart)
-                )
+                with self.metrics.span("mutate"):
+                        await self.charts.update(
+                                guild_id,
+                                {
+                                        "op": "remove",
+                                        "user_id": str(interaction.user.id),
+                                },
+                        )
 
-                await interaction.response.send_message(
-                        "Your alignment has been removed.", ephemeral=True
+                await self._respond(
+                        interaction,
+                        "Your alignment has been removed.",
+                        ephemeral=True,
                 )
 
         @app_commands.command(
                 name="alignment_set_other",
-                description="Set alignment for another user (with restrictions).",
+                description=(
+                        "Set alignment for another user (with restrictions)."
+                ),
         )
         @app_commands.describe(
-                target="The user whose alignment to set (leave blank to set your own)",
+                target=(
+                        "The user whose alignment to set"
+                        " (leave blank to set your own)"
+                ),
                 alignment="Choose the alignment to set",
         )
         @app_commands.choices(
@@ -179,64 +991,61 @@ class AlignmentCog(commands.Cog):
         ):
                 guild_id = interaction.guild_id
                 if guild_id is None:
-                        await interaction.response.send_message(
+                        await self._respond(
+                                interaction,
                                 "This command must be used in a server.",
                                 ephemeral=True,
                         )
                         return
 
-                file_path = self._get_server_file(guild_id)
-                raw_data = load_file_buffer(file_path)
-                chart = parse_alignment_chart(raw_data)
-
                 # Default to the person invoking if no target given
                 target_member = target or interaction.user
                 invoker_id = str(interaction.user.id)
                 target_id = str(target_member.id)
 
-                is_bot_owner = await self.bot.is_owner(interaction.user)
-                is_admin = invoker_id in chart["admins"] or is_bot_owner
-                # Rule enforcement
-                if (
-                        target_id != invoker_id
-                        and not is_admin
-                        and target_id in chart["users"]
-                ):
-                        await interaction.response.send_message(
-                                (
-                                        f"{target_member.display_name}"
-                                        " already has an alignment set."
-                                        " You cannot change it."
-                                ),
+                avatar = target_member.display_avatar
+                op: AlignmentOp = {
+                        "op": "set",
+                        "user_id": target_id,
+                        "alignment": alignment.value,  # type: ignore
+                        "display_name": target_member.display_name,
+                        "avatar_url": avatar.url if avatar else None,
+                }
+                is_bot_owner = await self._is_owner(interaction.user)
+                async with self.charts.lock(guild_id):
+                        chart = await self.charts.get(guild_id)
+                        is_admin = invoker_id in chart["admins"] or is_bot_owner
+                        # Rule enforcement
+                        denied = (
+                                target_id != invoker_id
+                                and not is_admin
+                                and target_id in chart["users"]
+                        )
+                        if not denied:
+                                with self.metrics.span("mutate"):
+                                        await self.charts.put(guild_id, op)
+
+                # Replied once the lock is free, so other commands can go on
+                if denied:
+                        await self._respond(
+                                interaction,
+                                f"{target_member.display_name} already has an"
+                                " alignment set. You cannot change it.",
                                 ephemeral=True,
                         )
                         return
-
-                # Apply update
-                updated_chart = set_user_alignment(
-                        chart,
-                        user_id=target_id,
-                        alignment=alignment.value,
-                        display_name=target_member.display_name,
-                        avatar_url=(
-                                target_member.display_avatar.url
-                                if target_member.display_avatar
-                                else None
-                        ),
-                )
-
-                save_file_buffer(
-                        file_path, serialize_alignment_chart(updated_chart)
-                )
-
                 if target_id == invoker_id:
-                        await interaction.response.send_message(
+                        await self._respond(
+                                interaction,
                                 f"Your alignment set to **{alignment.value}**.",
                                 ephemeral=True,
                         )
                 else:
-                        await interaction.response.send_message(
-                                f"Alignment for **{target_member.display_name}** set to **{alignment.value}**.",
+                        await self._respond(
+                                interaction,
+                                "Alignment for"
+                                f" **{target_member.display_name}**"
+                                f" set to **{alignment.value}**.",
                                 ephemeral=True,
                         )
 
@@ -249,36 +1058,35 @@ class AlignmentCog(commands.Cog):
         ):
                 guild_id = interaction.guild_id
                 if guild_id is None:
-                        await interaction.response.send_message(
+                        await self._respond(
+                                interaction,
                                 "This command must be used in a server.",
                                 ephemeral=True,
                         )
                         return
 
                 # Only existing admins or server owner can add new admins
-                file_path = self._get_server_file(guild_id)
-                raw_data = load_file_buffer(file_path)
-                chart = parse_alignment_chart(raw_data)
-                is_bot_owner = await self.bot.is_owner(interaction.user)
-                invoker_id = str(interaction.user.id)
-                if not (
-                        invoker_id == str(interaction.guild.owner_id)
-                        or invoker_id in chart["admins"]
-                        or is_bot_owner
-                ):
-                        await interaction.response.send_message(
+                async with self.charts.lock(guild_id):
+                        chart = await self.charts.get(guild_id)
+                        allowed = await self._is_admin(interaction, chart)
+                        if allowed and str(user.id) not in chart["admins"]:
+                                await self.charts.put(
+                                        guild_id,
+                                        {
+                                                "op": "add_admin",
+                                                "user_id": str(user.id),
+                                        },
+                                )
+
+                if not allowed:
+                        await self._respond(
+                                interaction,
                                 "You do not have permission to modify admins.",
                                 ephemeral=True,
                         )
                         return
-
-                if str(user.id) not in chart["admins"]:
-                        chart["admins"].append(str(user.id))
-                        save_file_buffer(
-                                file_path, serialize_alignment_chart(chart)
-                        )
-
-                await interaction.response.send_message(
+                await self._respond(
+                        interaction,
                         f"{user.display_name} is now an alignment admin.",
                         ephemeral=True,
                 )
@@ -292,46 +1100,43 @@ class AlignmentCog(commands.Cog):
         ):
                 guild_id = interaction.guild_id
                 if guild_id is None:
-                        await interaction.response.send_message(
+                        await self._respond(
+                                interaction,
                                 "This command must be used in a server.",
                                 ephemeral=True,
                         )
                         return
 
-                file_path = self._get_server_file(guild_id)
-                raw_data = load_file_buffer(file_path)
-                chart = parse_alignment_chart(raw_data)
-
-                is_bot_owner = await self.bot.is_owner(interaction.user)
                 invoker_id = str(interaction.user.id)
-                if not (
-                        invoker_id == str(interaction.guild.owner_id)
-                        or invoker_id in chart["admins"]
-                        or is_bot_owner
-                ):
-                        await interaction.response.send_message(
-                                "You do not have permission to modify admins.",
-                                ephemeral=True,
-                        )
-                        return
+                denied = None
+                async with self.charts.lock(guild_id):
+                        chart = await self.charts.get(guild_id)
+                        if not await self._is_admin(interaction, chart):
+                                denied = "modify"
+                        elif (
+                                invoker_id != str(interaction.guild.owner_id)
+                                and invoker_id not in chart["admins"]
+                        ):
+                                denied = "remove"
+                        elif str(user.id) in chart["admins"]:
+                                await self.charts.put(
+                                        guild_id,
+                                        {
+                                                "op": "remove_admin",
+                                                "user_id": str(user.id),
+                                        },
+                                )
 
-                if (
-                        invoker_id != str(interaction.guild.owner_id)
-                        and invoker_id not in chart["admins"]
-                ):
-                        await interaction.response.send_message(
-                                "You do not have permission to remove admins.",
+                if denied is not None:
+                        await self._respond(
+                                interaction,
+                                f"You do not have permission to {denied}"
+                                " admins.",
                                 ephemeral=True,
                         )
                         return
-
-                if str(user.id) in chart["admins"]:
-                        chart["admins"].remove(str(user.id))
-                        save_file_buffer(
-                                file_path, serialize_alignment_chart(chart)
-                        )
-
-                await interaction.response.send_message(
+                await self._respond(
+                        interaction,
                         f"{user.display_name} is no longer an alignment admin.",
                         ephemeral=True,
                 )
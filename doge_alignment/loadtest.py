@@ -0,0 +1,546 @@
+"""Drive ``AlignmentCog`` with a storm of fake slash commands.
+
+Run with ``python -m doge_alignment.loadtest``. Stand-in interactions,
+members, guilds and bot let commands run without Discord or a network.
+Commands from a weighted mix arrive at ``--rate`` per second across
+``--guilds`` guilds. Afterwards the cog is unloaded, so every queued
+save lands. The charts are then read back from disk and compared with
+what the commands should have left behind. A user or admin whose
+stored state differs is a lost update.
+
+Members have no avatars, so ``alignment_show`` never fetches one. It
+renders the chart if Wand is installed, and replies with the text pages
+otherwise.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import TYPE_CHECKING, Literal, TypedDict, get_args
+
+from discord import app_commands
+
+from doge_cogs.alignment import AlignmentName
+from doge_cogs.sqlite_storage import SqliteBackend
+from doge_cogs.storage import ShardedBackend, YamlBackend
+
+from .doge_alignment import AlignmentCog
+
+if TYPE_CHECKING:
+        from collections.abc import Mapping
+
+        from doge_cogs.storage import ChartBackend
+
+log = logging.getLogger(__name__)
+
+ALIGNMENTS: tuple[AlignmentName, ...] = get_args(AlignmentName)
+
+CommandName = Literal[
+        "set", "remove", "set_other", "show", "add_admin", "remove_admin"
+]
+COMMAND_NAMES: tuple[CommandName, ...] = get_args(CommandName)
+
+# Mostly members setting their own alignment and looking at the chart
+DEFAULT_MIX: dict[CommandName, float] = {
+        "set": 40,
+        "remove": 10,
+        "set_other": 15,
+        "show": 25,
+        "add_admin": 5,
+        "remove_admin": 5,
+}
+DEFAULT_GUILDS = 20
+DEFAULT_MEMBERS = 200
+DEFAULT_RATE = 500.0
+DEFAULT_COMMANDS = 5_000
+# How often the event loop is probed for lag, in seconds
+LAG_INTERVAL = 0.005
+# Owns every fake guild and the fake bot, so is allowed everything
+OPERATOR_ID = 1
+
+
+class CommandStats(TypedDict):
+        """Latencies of one command, in seconds."""
+
+        count: int
+        errors: int
+        p50: float
+        p99: float
+
+
+class LoadReport(TypedDict):
+        """The outcome of a load test, as saved with ``--json``."""
+
+        commands: int
+        errors: int
+        seconds: float
+        throughput: float
+        p50: float
+        p99: float
+        loop_lag_p99: float
+        loop_lag_max: float
+        lost_updates: int
+        by_command: dict[str, CommandStats]
+
+
+class FakeMember:
+        """Just enough of ``discord.Member`` for the cog."""
+
+        def __init__(self, member_id: int, guild: FakeGuild) -> None:
+                self.id = member_id
+                self.display_name = f"member{member_id}"
+                self.display_avatar = None
+                self.guild = guild
+
+
+class FakeGuild:
+        """Just enough of ``discord.Guild`` for the cog."""
+
+        def __init__(self, guild_id: int, num_members: int) -> None:
+                self.id = guild_id
+                self.owner_id = OPERATOR_ID
+                self.members = [FakeMember(OPERATOR_ID, self)] + [
+                        FakeMember(guild_id * 100_000 + i, self)
+                        for i in range(1, num_members)
+                ]
+                self._by_id = {m.id: m for m in self.members}
+
+        def get_member(self, member_id: int) -> FakeMember | None:
+                """Return a member by ID."""
+                return self._by_id.get(member_id)
+
+
+class FakeBot:
+        """Just enough of a Red bot for the cog."""
+
+        def __init__(self, guilds: Mapping[int, FakeGuild]) -> None:
+                self.guilds = guilds
+
+        async def is_owner(self, user: FakeMember) -> bool:
+                """Only the operator owns the bot."""
+                await asyncio.sleep(0)
+                return user.id == OPERATOR_ID
+
+        def get_guild(self, guild_id: int) -> FakeGuild | None:
+                """Return a guild by ID."""
+                return self.guilds.get(guild_id)
+
+
+class FakeResponse:
+        """Records replies instead of sending them."""
+
+        def __init__(self) -> None:
+                self.messages: list[str] = []
+                self.deferred = False
+
+        async def send_message(
+                self,
+                content: str | None = None,
+                **kwargs: object,  # noqa: ARG002
+        ) -> None:
+                """Record a reply."""
+                self.messages.append(content or "")
+
+        async def defer(self, **kwargs: object) -> None:  # noqa: ARG002
+                """Record that the reply will follow."""
+                self.deferred = True
+
+        async def send(
+                self,
+                content: str | None = None,
+                **kwargs: object,  # noqa: ARG002
+        ) -> None:
+                """Record a followup message."""
+                self.messages.append(content or "")
+
+
+@dataclass
+class FakeInteraction:
+        """Just enough of ``discord.Interaction`` for the cog."""
+
+        user: FakeMember
+        command: app_commands.Command
+        extras: dict = field(default_factory=dict)
+        response: FakeResponse = field(default_factory=FakeResponse)
+
+        @property
+        def guild(self) -> FakeGuild:
+                """The guild the command was used in."""
+                return self.user.guild
+
+        @property
+        def guild_id(self) -> int:
+                """The ID of the guild the command was used in."""
+                return self.user.guild.id
+
+        @property
+        def followup(self) -> FakeResponse:
+                """Followups land with the other replies."""
+                return self.response
+
+
+def _percentile(values: list[float], q: float) -> float:
+        if not values:
+                return 0.0
+        ordered = sorted(values)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class LoadTest:
+        """Replay a command mix against one ``AlignmentCog``.
+
+        Commands touching the same user, or the same admin entry, are
+        run one after another, so the expected end state is just the
+        last of them to finish. Different users of a guild still race
+        for its chart, and that is where updates could get lost.
+        """
+
+        def __init__(
+                self,
+                cog: AlignmentCog,
+                guilds: Mapping[int, FakeGuild],
+                mix: Mapping[CommandName, float],
+                *,
+                seed: int = 0,
+        ) -> None:
+                self.cog = cog
+                self.guilds = guilds
+                self.mix = mix
+                # Not for secrets: seeded, so a run can be replayed exactly
+                self.rng = random.Random(seed)  # noqa: S311
+                self.latencies: dict[CommandName, list[float]] = {
+                        name: [] for name in mix
+                }
+                self.errors: dict[CommandName, int] = dict.fromkeys(mix, 0)
+                self.lag: list[float] = []
+                # Per guild: user ID -> alignment (None once removed)
+                self.expected_users: dict[int, dict[str, str | None]] = {
+                        g: {} for g in guilds
+                }
+                # Per guild: user ID -> whether they are an admin
+                self.expected_admins: dict[int, dict[str, bool]] = {
+                        g: {} for g in guilds
+                }
+                self._locks: dict[tuple[int, str, str], asyncio.Lock] = {}
+
+        def _lock(self, guild_id: int, kind: str, user_id: str) -> asyncio.Lock:
+                key = (guild_id, kind, user_id)
+                lock = self._locks.get(key)
+                if lock is None:
+                        lock = self._locks[key] = asyncio.Lock()
+                return lock
+
+        async def _invoke(
+                self,
+                command: app_commands.Command,
+                invoker: FakeMember,
+                /,
+                **kwargs: object,
+        ) -> None:
+                interaction = FakeInteraction(invoker, command)
+                await self.cog.interaction_check(interaction)
+                await command.callback(self.cog, interaction, **kwargs)
+                await self.cog.on_app_command_completion(interaction, command)
+
+        async def run_one(self, name: CommandName) -> None:
+                """Run one command as a random member of a random guild."""
+                rng = self.rng
+                guild = self.guilds[rng.choice(list(self.guilds))]
+                member = rng.choice(guild.members)
+                user_id = str(member.id)
+                operator = guild.members[0]
+                cog = self.cog
+                alignment = rng.choice(ALIGNMENTS)
+                choice = app_commands.Choice(name=alignment, value=alignment)
+                users = self.expected_users[guild.id]
+                admins = self.expected_admins[guild.id]
+                started = time.perf_counter()
+                try:
+                        match name:
+                                case "set":
+                                        async with self._lock(
+                                                guild.id, "user", user_id
+                                        ):
+                                                await self._invoke(
+                                                        cog.alignment_set,
+                                                        member,
+                                                        alignment=choice,
+                                                )
+                                                users[user_id] = alignment
+                                case "remove":
+                                        async with self._lock(
+                                                guild.id, "user", user_id
+                                        ):
+                                                await self._invoke(
+                                                        cog.alignment_remove,
+                                                        member,
+                                                )
+                                                users[user_id] = None
+                                case "set_other":
+                                        async with self._lock(
+                                                guild.id, "user", user_id
+                                        ):
+                                                await self._invoke(
+                                                        cog.alignment_set_other,
+                                                        operator,
+                                                        alignment=choice,
+                                                        target=member,
+                                                )
+                                                users[user_id] = alignment
+                                case "show":
+                                        await self._invoke(
+                                                cog.alignment_show, member
+                                        )
+                                case "add_admin" | "remove_admin":
+                                        command = (
+                                                cog.alignment_add_admin
+                                                if name == "add_admin"
+                                                else cog.alignment_remove_admin
+                                        )
+                                        async with self._lock(
+                                                guild.id, "admin", user_id
+                                        ):
+                                                await self._invoke(
+                                                        command,
+                                                        operator,
+                                                        user=member,
+                                                )
+                                                admins[user_id] = (
+                                                        name == "add_admin"
+                                                )
+                except Exception:
+                        log.exception("%s failed", name)
+                        self.errors[name] += 1
+                        return
+                self.latencies[name].append(time.perf_counter() - started)
+
+        async def _watch_loop(self, stop: asyncio.Event) -> None:
+                while not stop.is_set():
+                        started = time.perf_counter()
+                        await asyncio.sleep(LAG_INTERVAL)
+                        self.lag.append(
+                                time.perf_counter() - started - LAG_INTERVAL
+                        )
+
+        async def run(self, num_commands: int, rate: float) -> float:
+                """Issue ``num_commands`` at ``rate`` per second.
+
+                Arrivals follow the schedule whether or not earlier
+                commands have finished. Returns the seconds taken until
+                the last command finished.
+                """
+                names = list(self.mix)
+                weights = list(self.mix.values())
+                stop = asyncio.Event()
+                watcher = asyncio.create_task(self._watch_loop(stop))
+                tasks = set()
+                start = time.perf_counter()
+                for i, name in enumerate(
+                        self.rng.choices(names, weights, k=num_commands)
+                ):
+                        delay = start + i / rate - time.perf_counter()
+                        if delay > 0:
+                                await asyncio.sleep(delay)
+                        tasks.add(asyncio.create_task(self.run_one(name)))
+                await asyncio.gather(*tasks)
+                elapsed = time.perf_counter() - start
+                stop.set()
+                await watcher
+                return elapsed
+
+        def lost_updates(self, backend: ChartBackend) -> int:
+                """Count users and admins stored differently than expected."""
+                lost = 0
+                for guild_id in self.guilds:
+                        chart = backend.load(guild_id)
+                        for user_id, alignment in self.expected_users[
+                                guild_id
+                        ].items():
+                                entry = chart["users"].get(user_id)
+                                stored = (
+                                        None
+                                        if entry is None
+                                        else entry["alignment"]
+                                )
+                                lost += stored != alignment
+                        for user_id, is_admin in self.expected_admins[
+                                guild_id
+                        ].items():
+                                lost += (user_id in chart["admins"]) != is_admin
+                return lost
+
+        def report(self, seconds: float, lost_updates: int) -> LoadReport:
+                """Summarize the run."""
+                everything = [
+                        t for times in self.latencies.values() for t in times
+                ]
+                errors = sum(self.errors.values())
+                return {
+                        "commands": len(everything) + errors,
+                        "errors": errors,
+                        "seconds": seconds,
+                        "throughput": len(everything) / seconds,
+                        "p50": _percentile(everything, 0.5),
+                        "p99": _percentile(everything, 0.99),
+                        "loop_lag_p99": _percentile(self.lag, 0.99),
+                        "loop_lag_max": max(self.lag, default=0.0),
+                        "lost_updates": lost_updates,
+                        "by_command": {
+                                name: {
+                                        "count": len(times),
+                                        "errors": self.errors[name],
+                                        "p50": _percentile(times, 0.5),
+                                        "p99": _percentile(times, 0.99),
+                                }
+                                for name, times in self.latencies.items()
+                        },
+                }
+
+
+async def run_load_test(
+        data_dir: Path,
+        *,
+        guilds: int = DEFAULT_GUILDS,
+        members: int = DEFAULT_MEMBERS,
+        mix: Mapping[CommandName, float] = DEFAULT_MIX,
+        rate: float = DEFAULT_RATE,
+        commands: int = DEFAULT_COMMANDS,
+        backend: Literal["yaml", "sqlite", "sharded"] = "yaml",
+        render_workers: int = 0,
+        seed: int = 0,
+) -> LoadReport:
+        """Load the cog on ``data_dir``, run a load test and unload it."""
+        fake_guilds = {
+                guild_id: FakeGuild(guild_id, members)
+                for guild_id in range(1_000, 1_000 + guilds)
+        }
+        cog = AlignmentCog(
+                FakeBot(fake_guilds),
+                backend=backend,
+                render_workers=render_workers,
+                warm_guilds=0,
+                data_dir=data_dir,
+        )
+        await cog.cog_load()
+        test = LoadTest(cog, fake_guilds, mix, seed=seed)
+        try:
+                seconds = await test.run(commands, rate)
+        finally:
+                await cog.cog_unload()
+        stored: ChartBackend = (
+                SqliteBackend(data_dir / "alignment.db")
+                if backend == "sqlite"
+                else ShardedBackend(data_dir)
+                if backend == "sharded"
+                else YamlBackend(data_dir)
+        )
+        try:
+                lost = test.lost_updates(stored)
+        finally:
+                stored.close()
+        return test.report(seconds, lost)
+
+
+def _parse_mix(text: str) -> dict[CommandName, float]:
+        mix = {}
+        for part in text.split(","):
+                name, _, weight = part.partition("=")
+                if name not in COMMAND_NAMES:
+                        msg = f"unknown command {name!r}"
+                        raise argparse.ArgumentTypeError(msg)
+                mix[name] = float(weight or 1)
+        return mix
+
+
+def main(argv: list[str] | None = None) -> int:
+        """Run a load test, print it, and optionally save it."""
+        parser = argparse.ArgumentParser(
+                prog="python -m doge_alignment.loadtest"
+        )
+        parser.add_argument("--guilds", type=int, default=DEFAULT_GUILDS)
+        parser.add_argument(
+                "--members",
+                type=int,
+                default=DEFAULT_MEMBERS,
+                help="members per guild",
+        )
+        parser.add_argument(
+                "--mix",
+                type=_parse_mix,
+                default=DEFAULT_MIX,
+                help="weighted commands, e.g. set=4,show=1 (choices: "
+                + ", ".join(COMMAND_NAMES)
+                + ")",
+        )
+        parser.add_argument(
+                "--rate",
+                type=float,
+                default=DEFAULT_RATE,
+                help="commands per second",
+        )
+        parser.add_argument("--commands", type=int, default=DEFAULT_COMMANDS)
+        parser.add_argument(
+                "--backend",
+                choices=("yaml", "sqlite", "sharded"),
+                default="yaml",
+        )
+        parser.add_argument("--render-workers", type=int, default=0)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+                "--data-dir",
+                type=Path,
+                help="where charts are stored (default: a temporary dir)",
+        )
+        parser.add_argument("--json", type=Path, help="save the report here")
+        args = parser.parse_args(argv)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+                report = asyncio.run(
+                        run_load_test(
+                                args.data_dir or Path(tmpdir),
+                                guilds=args.guilds,
+                                members=args.members,
+                                mix=args.mix,
+                                rate=args.rate,
+                                commands=args.commands,
+                                backend=args.backend,
+                                render_workers=args.render_workers,
+                                seed=args.seed,
+                        )
+                )
+        print(
+                f"{report['commands']} commands in {report['seconds']:.2f} s,"
+                f" {report['throughput']:.0f}/s, {report['errors']} errors"
+        )
+        print(
+                f"latency p50 {report['p50'] * 1000:.2f} ms,"
+                f" p99 {report['p99'] * 1000:.2f} ms"
+        )
+        for name, stats in report["by_command"].items():
+                print(
+                        f"  {name:14} n={stats['count']:<6}"
+                        f" p50 {stats['p50'] * 1000:8.2f} ms"
+                        f" p99 {stats['p99'] * 1000:8.2f} ms"
+                        f" errors {stats['errors']}"
+                )
+        print(
+                f"event loop lag p99 {report['loop_lag_p99'] * 1000:.2f} ms,"
+                f" max {report['loop_lag_max'] * 1000:.2f} ms"
+        )
+        print(f"lost updates {report['lost_updates']}")
+        if args.json is not None:
+                args.json.write_text(json.dumps(report, indent=2) + "\n")
+        return 1 if report["lost_updates"] or report["errors"] else 0
+
+
+if __name__ == "__main__":
+        sys.exit(main())
@@ -1,30 +1,58 @@
 from __future__ import annotations  # noqa: D100,I001
+import json
+import os
 import subprocess
-from io import BytesIO, StringIO
+import tempfile
+from collections.abc import Mapping  # noqa: TC003
+from dataclasses import dataclass
+from functools import lru_cache
+from io import BytesIO
 from pathlib import Path
-from typing import Literal, TypedDict
+from typing import TYPE_CHECKING, Literal, NamedTuple, TypedDict
 
 import yaml
-from wand.image import Image
-from wand.drawing import Drawing
-from wand.color import Color
-
-# Define all possible alignments (classic 3x3 chart)
-AlignmentName = Literal[
-        "Lawful Good",
-        "Neutral Good",
-        "Chaotic Good",
-        "Lawful Neutral",
-        "True Neutral",
-        "Chaotic Neutral",
-        "Lawful Evil",
-        "Neutral Evil",
-        "Chaotic Evil",
-]
 
+from doge_cogs.hamt import PersistentMap
+
+# AlignmentName, every possible alignment, lives with the records
+from doge_cogs.records import AlignmentName, UserRecord, compact_user
+from doge_cogs.tiles import Tile, TileCache, TileKey, source_hash
+
+# Wand loads ImageMagick, so it is only imported once something is drawn
+if TYPE_CHECKING:
+        from collections.abc import Iterable, KeysView
+
+        from wand.image import Image
+
+# Prefer the libyaml C implementation when PyYAML was built with it
+try:
+        from yaml import CSafeDumper as SafeDumper
+        from yaml import CSafeLoader as SafeLoader
+except ImportError:
+        from yaml import SafeDumper, SafeLoader
+
+
+class ChartDumper(SafeDumper):
+        """The fastest safe dumper, also accepting ``PersistentMap``."""
+
+
+ChartDumper.add_representer(PersistentMap, ChartDumper.represent_dict)
+ChartDumper.add_representer(UserRecord, ChartDumper.represent_dict)
+
+try:
+        import msgpack
+except ImportError:
+        msgpack = None
 
 BorderShape = Literal["square", "circle", "rounded"]
 
+RenderEngine = Literal["wand", "numpy"]
+
+# On-disk chart encodings. Binary files start with a magic header, so
+# parse_alignment_chart tells them apart from YAML on its own.
+ChartFormat = Literal["yaml", "binary"]
+BINARY_CHART_MAGIC = b"\x00DOGECHART\x01"
+
 
 # User entry in YAML
 class UserAlignment(TypedDict):
@@ -34,16 +62,45 @@ class UserAlignment(TypedDict):
 
 
 class AlignmentChart(TypedDict):
-        users: dict[str, UserAlignment]
+        # A dict, or a PersistentMap for charts kept in memory. Mapping
+        # is imported at runtime so get_type_hints can resolve this
+        users: Mapping[str, UserAlignment]
         admins: list[str]  # user IDs as strings
 
 
+# Chart operations, as recorded in the per-guild change journal.
+# Each one assigns a definite value, so replaying an already applied
+# sequence again leaves the chart unchanged.
+class SetAlignmentOp(TypedDict):
+        op: Literal["set"]
+        user_id: str
+        alignment: AlignmentName
+        display_name: str
+        avatar_url: str | None
+
+
+class RemoveAlignmentOp(TypedDict):
+        op: Literal["remove"]
+        user_id: str
+
+
+class AdminOp(TypedDict):
+        op: Literal["add_admin", "remove_admin"]
+        user_id: str
+
+
+AlignmentOp = SetAlignmentOp | RemoveAlignmentOp | AdminOp
+
+
 def solid_color_background(
         width: int = 512,
         height: int = 512,
         color: str = "black",
 ) -> Image:
         """Return a solid color background."""
+        from wand.color import Color
+        from wand.image import Image
+
         return Image(width=width, height=height, background=Color(color))
 
 
@@ -76,13 +133,85 @@ def layout_positions(
         num_images: int,
         cell_size: tuple[int, int],
         gap: int,
+        area_width: int | None = None,
 ) -> list[tuple[int, int]]:
-        """Calculate top-left positions for a simple grid layout."""
-        cols = int((cell_size[0] + gap) // (cell_size[0] + gap))
-        print(cols)
-        # For now we can just return fixed offsets for all images in a row
-        # Later we can make a proper auto-grid based on aspect ratio
-        return [(0, i * (cell_size[1] + gap)) for i in range(num_images)]
+        """Calculate top-left positions for a row-major grid layout.
+
+        As many ``cell_size`` images as fit in ``area_width`` go on each
+        row; without an area width the images form a single column.
+        """
+        width = cell_size[0] if area_width is None else area_width
+        cols = max(1, (width + gap) // (cell_size[0] + gap))
+        return [
+                (
+                        (i % cols) * (cell_size[0] + gap),
+                        (i // cols) * (cell_size[1] + gap),
+                )
+                for i in range(num_images)
+        ]
+
+
+def grid_dimensions(
+        num_images: int,
+        area: tuple[int, int],
+        gap: int,
+) -> tuple[int, int, int]:
+        """Pick the grid that fits ``num_images`` squares in ``area``.
+
+        Returns ``(cols, rows, tile)`` for the largest square tile size
+        that still fits every image, gaps included.
+        """
+        if num_images <= 0:
+                return 0, 0, 0
+        best = (1, num_images, 0)
+        for cols in range(1, num_images + 1):
+                rows = -(-num_images // cols)
+                tile = min(
+                        (area[0] - gap * (cols - 1)) // cols,
+                        (area[1] - gap * (rows - 1)) // rows,
+                )
+                if tile > best[2]:
+                        best = (cols, rows, tile)
+                if (area[0] - gap * (cols - 1)) // cols < best[2]:
+                        # Wider grids only shrink the tiles further
+                        break
+        return best
+
+
+@lru_cache(maxsize=64)
+def shape_mask(size: tuple[int, int], shape: BorderShape) -> Image | None:
+        """Return the shared alpha mask for a shape, built once per size.
+
+        The returned image is cached and must not be modified.
+        """
+        if shape not in ("circle", "rounded"):
+                return None
+        from wand.color import Color
+        from wand.drawing import Drawing
+        from wand.image import Image
+
+        mask_img = Image(
+                width=size[0],
+                height=size[1],
+                background=Color("transparent"),
+        )
+        with Drawing() as mask:
+                if shape == "circle":
+                        mask.circle(
+                                (size[0] // 2, size[1] // 2),
+                                (size[0] // 2, size[1]),
+                        )
+                else:
+                        radius = min(size) // 8
+                        mask.rectangle(
+                                0,
+                                0,
+                                size[0],
+                                size[1],
+                                radius=radius,
+                        )
+                mask.draw(mask_img)
+        return mask_img
 
 
 def process_avatar(
@@ -95,63 +224,328 @@ def process_avatar(
         img.resize(size[0], size[1])
 
         # Apply shape
-        match shape:
-                case "circle":
-                        with (
-                                Drawing() as mask,
-                                Image(
-                                        width=size[0],
-                                        height=size[1],
-                                        background=Color("transparent"),
-                                ) as mask_img,
-                        ):
-                                mask.circle(
-                                        (size[0] // 2, size[1] // 2),
-                                        (size[0] // 2, size[1]),
-                                )
-                                mask.draw(mask_img)
-                                img.composite_channel(
-                                        "alpha",
-                                        mask_img,
-                                        "copy_alpha",
-                                        0,
-                                        0,
-                                )
-                case "rounded":
-                        with (
-                                Drawing() as mask,
-                                Image(
-                                        width=size[0],
-                                        height=size[1],
-                                        background=Color("transparent"),
-                                ) as mask_img,
-                        ):
-                                radius = min(size) // 8
-                                mask.rectangle(
-                                        0,
-                                        0,
-                                        size[0],
-                                        size[1],
-                                        radius=radius,
-                                )
-
-                                mask.draw(mask_img)
-                                img.composite_channel(
-                                        "alpha",
-                                        mask_img,
-                                        "copy_alpha",
-                                        0,
-                                        0,
-                                )
-                case _:
-                        pass
+        mask_img = shape_mask(size, shape)
+        if mask_img is not None:
+                img.composite_channel(
+                        "alpha",
+                        mask_img,
+                        "copy_alpha",
+                        0,
+                        0,
+                )
         # Add border
         if border > 0:
+                from wand.color import Color
+
                 img.border(Color(border_color), border, border)
 
         return img.clone()
 
 
+# Rows run Good to Evil, columns Lawful to Chaotic
+ALIGNMENT_GRID: tuple[tuple[AlignmentName, ...], ...] = (
+        ("Lawful Good", "Neutral Good", "Chaotic Good"),
+        ("Lawful Neutral", "True Neutral", "Chaotic Neutral"),
+        ("Lawful Evil", "Neutral Evil", "Chaotic Evil"),
+)
+
+DISCORD_ATTACHMENT_LIMIT = 8 * 1024 * 1024
+
+Rect = tuple[int, int, int, int]  # left, top, width, height
+
+
+@dataclass(frozen=True)
+class ChartStyle:
+        """Look and output format of a rendered alignment chart."""
+
+        size: int = 1536
+        margin: int = 12
+        label_height: int = 56
+        gap: int = 6
+        border: int = 3
+        border_color: str = "white"
+        shape: BorderShape = "circle"
+        background: str = "black"
+        cell_background: str = "#1e1f22"
+        label_color: str = "white"
+        placeholder_color: str = "#5865f2"
+        image_format: Literal["png", "webp"] = "png"
+        max_bytes: int = DISCORD_ATTACHMENT_LIMIT
+        engine: RenderEngine = "wand"
+
+
+class CellLayout(NamedTuple):
+        tile: int  # tile edge, border included
+        slots: list[tuple[str, int, int]]  # user ID and canvas position
+
+
+def cell_rects(style: ChartStyle) -> dict[AlignmentName, Rect]:
+        """Return the canvas rectangle of each of the nine cells."""
+        cell = (style.size - style.margin * 4) // 3
+        return {
+                name: (
+                        style.margin + col * (cell + style.margin),
+                        style.margin + row * (cell + style.margin),
+                        cell,
+                        cell,
+                )
+                for row, names in enumerate(ALIGNMENT_GRID)
+                for col, name in enumerate(names)
+        }
+
+
+def avatar_area(rect: Rect, style: ChartStyle) -> Rect:
+        """Return the part of a cell below its label that holds avatars."""
+        left, top, width, height = rect
+        return (
+                left + style.gap,
+                top + style.label_height,
+                width - 2 * style.gap,
+                height - style.label_height - style.gap,
+        )
+
+
+def group_users_by_alignment(
+        chart: AlignmentChart,
+) -> dict[AlignmentName, list[str]]:
+        """Return user IDs per alignment, in chart order."""
+        groups: dict[AlignmentName, list[str]] = {
+                name: [] for row in ALIGNMENT_GRID for name in row
+        }
+        for user_id, entry in chart["users"].items():
+                groups[entry["alignment"]].append(user_id)
+        return groups
+
+
+def layout_cell(
+        user_ids: list[str],
+        area: Rect,
+        gap: int,
+) -> CellLayout:
+        """Auto-grid one cell's avatars, centered in its avatar area."""
+        left, top, width, height = area
+        cols, rows, tile = grid_dimensions(len(user_ids), (width, height), gap)
+        if not user_ids:
+                return CellLayout(0, [])
+        grid_width = cols * tile + (cols - 1) * gap
+        grid_height = rows * tile + (rows - 1) * gap
+        left += (width - grid_width) // 2
+        top += (height - grid_height) // 2
+        positions = layout_positions(
+                len(user_ids), (tile, tile), gap, grid_width
+        )
+        return CellLayout(
+                tile,
+                [
+                        (user_id, left + x, top + y)
+                        for user_id, (x, y) in zip(
+                                user_ids, positions, strict=True
+                        )
+                ],
+        )
+
+
+def layout_chart(
+        chart: AlignmentChart,
+        style: ChartStyle,
+) -> dict[AlignmentName, CellLayout]:
+        """Lay out every cell of the chart."""
+        rects = cell_rects(style)
+        return {
+                name: layout_cell(
+                        user_ids, avatar_area(rects[name], style), style.gap
+                )
+                for name, user_ids in group_users_by_alignment(chart).items()
+        }
+
+
+def draw_cells(canvas: Image, style: ChartStyle) -> None:
+        """Draw every cell's background and label in a single pass."""
+        from wand.color import Color
+        from wand.drawing import Drawing
+
+        with Drawing() as draw:
+                draw.fill_color = Color(style.cell_background)
+                rects = cell_rects(style)
+                for left, top, width, height in rects.values():
+                        draw.rectangle(
+                                left,
+                                top,
+                                left + width - 1,
+                                top + height - 1,
+                                radius=style.margin,
+                        )
+                draw.fill_color = Color(style.label_color)
+                draw.font_size = style.label_height // 2
+                draw.text_alignment = "center"
+                for name, (left, top, width, _) in rects.items():
+                        draw.text(
+                                left + width // 2,
+                                top + (style.label_height * 2) // 3,
+                                name,
+                        )
+                draw(canvas)
+
+
+def avatar_tile(
+        data: bytes | None,
+        tile: int,
+        style: ChartStyle,
+        tiles: TileCache | None = None,
+) -> Image:
+        """Decode and style one avatar, or a placeholder if it is unusable.
+
+        With a ``tiles`` cache, an avatar already styled the same way is
+        rebuilt from its cached pixels instead of going through
+        ``process_avatar`` again.
+        """
+        from wand.exceptions import WandException
+        from wand.image import Image
+
+        # Tiny tiles get no border, it would swallow the avatar
+        border = style.border if tile > 4 * style.border else 0
+        inner = tile - 2 * border
+        key = None
+        if tiles is not None:
+                source = (
+                        source_hash(data)
+                        if data
+                        else f"placeholder:{style.placeholder_color}"
+                )
+                key = TileKey(
+                        source, inner, border, style.border_color, style.shape
+                )
+                cached = tiles.get(key)
+                if cached is not None:
+                        return Image(
+                                blob=cached.rgba,
+                                format="rgba",
+                                width=cached.width,
+                                height=cached.height,
+                                depth=8,
+                        )
+        img = None
+        if data:
+                try:
+                        img = Image(blob=data)
+                except WandException:
+                        img = None
+        if img is None:
+                img = solid_color_background(
+                        inner, inner, style.placeholder_color
+                )
+        with img:
+                result = process_avatar(
+                        img,
+                        (inner, inner),
+                        border,
+                        style.border_color,
+                        style.shape,
+                )
+        if key is not None:
+                result.depth = 8
+                rgba = result.make_blob("RGBA")
+                tiles.put(key, Tile(result.width, result.height, rgba))
+        return result
+
+
+def encode_chart(canvas: Image, style: ChartStyle) -> bytes:
+        """Encode the canvas, shrinking it until it fits ``max_bytes``."""
+        # Leave out timestamps so equal pixels give equal bytes
+        canvas.strip()
+        canvas.options["png:exclude-chunk"] = "date,time"
+        canvas.format = style.image_format
+        blob = canvas.make_blob()
+        quality = 90
+        while len(blob) > style.max_bytes:
+                # Lossy WebP first, then smaller dimensions
+                canvas.format = "webp"
+                if quality >= 50:
+                        canvas.compression_quality = quality
+                        quality -= 20
+                else:
+                        canvas.resize(
+                                canvas.width * 3 // 4, canvas.height * 3 // 4
+                        )
+                blob = canvas.make_blob()
+        return blob
+
+
+def blank_chart(style: ChartStyle) -> Image:
+        """Return the chart canvas with its empty, labelled cells."""
+        canvas = solid_color_background(
+                style.size, style.size, style.background
+        )
+        draw_cells(canvas, style)
+        return canvas
+
+
+def composite_cell(
+        canvas: Image,
+        layout: CellLayout,
+        avatars: Mapping[str, bytes | None],
+        style: ChartStyle,
+        tiles: TileCache | None = None,
+) -> None:
+        """Composite one cell's avatar tiles onto the canvas."""
+        if layout.tile <= 0:
+                return
+        for user_id, left, top in layout.slots:
+                with avatar_tile(
+                        avatars.get(user_id), layout.tile, style, tiles
+                ) as tile:
+                        canvas.composite(tile, left=left, top=top)
+
+
+def render_alignment_chart(
+        chart: AlignmentChart,
+        avatars: Mapping[str, bytes | None],
+        style: ChartStyle = ChartStyle(),  # noqa: B008
+        tiles: TileCache | None = None,
+) -> bytes:
+        """Render the 3x3 alignment chart and return the encoded image.
+
+        ``avatars`` maps user IDs to raw image bytes; users without one
+        get a placeholder tile. Every tile is styled once and composited
+        once straight onto the canvas, so the cost grows linearly with
+        the number of users. Pass a ``TileCache`` to reuse styled avatars
+        between renders.
+        """
+        with blank_chart(style) as canvas:
+                for layout in layout_chart(chart, style).values():
+                        composite_cell(canvas, layout, avatars, style, tiles)
+                return encode_chart(canvas, style)
+
+
+def dirty_cells_for_op(
+        chart: AlignmentChart,
+        op: AlignmentOp,
+) -> set[AlignmentName]:
+        """Return the cells an operation changes, given the chart before it."""
+        previous = chart["users"].get(op["user_id"])
+        match op["op"]:
+                case "remove":
+                        return (
+                                set()
+                                if previous is None
+                                else {previous["alignment"]}
+                        )
+                case "set":
+                        entry = {
+                                "alignment": op["alignment"],
+                                "display_name": op["display_name"],
+                                "avatar_url": op["avatar_url"],
+                        }
+                        if previous == entry:
+                                return set()
+                        cells = {op["alignment"]}
+                        if previous is not None:
+                                cells.add(previous["alignment"])
+                        return cells
+                case _:
+                        return set()
+
+
 def normalize_chart(chart: dict) -> AlignmentChart:
         return {
                 "users": chart.get("users", {}),
@@ -159,32 +553,153 @@ def normalize_chart(chart: dict) -> AlignmentChart:
         }
 
 
+def persistent_chart(chart: AlignmentChart) -> AlignmentChart:
+        """Return a chart whose users are a ``PersistentMap``.
+
+        Updates to such a chart cost O(log n) and share everything they
+        do not touch with the chart before them. Entries are stored as
+        compact ``UserRecord`` objects where that is lossless.
+        """
+        if isinstance(chart["users"], PersistentMap):
+                return chart
+        return {
+                "users": PersistentMap(
+                        {
+                                user_id: compact_user(entry)
+                                for user_id, entry in chart["users"].items()
+                        }
+                ),
+                "admins": chart.get("admins", []),
+        }
+
+
+def plain_chart(chart: AlignmentChart) -> AlignmentChart:
+        """Return a chart of plain dicts, as loaded from a chart file."""
+        if not isinstance(chart["users"], PersistentMap):
+                return chart
+        return {
+                "users": {
+                        user_id: dict(entry)
+                        for user_id, entry in chart["users"].items()
+                },
+                "admins": chart.get("admins", []),
+        }
+
+
 def load_alignment_chart(buf: BytesIO) -> AlignmentChart:
-        buf.seek(0)
-        chart = yaml.safe_load(buf) or {}
-        return normalize_chart(chart)
+        return parse_alignment_chart(buf)
 
 
 def parse_alignment_chart(data: BytesIO) -> AlignmentChart:
-        data.seek(0)
-        text = data.read().decode("utf-8") or ""
-        loaded = yaml.safe_load(text)
+        """Parse a chart file, detecting the binary format by its magic."""
+        raw = data.getvalue()
+        if raw.startswith(BINARY_CHART_MAGIC):
+                if msgpack is None:
+                        msg = "msgpack is required to read binary chart files"
+                        raise RuntimeError(msg)
+                loaded = msgpack.unpackb(raw[len(BINARY_CHART_MAGIC) :])
+        else:
+                # libyaml reads the bytes directly, no decoded copy needed
+                loaded = yaml.load(raw, Loader=SafeLoader)  # noqa: S506
         if not loaded:
                 return {"users": {}, "admins": []}
-        if "users" not in loaded:
-                loaded["users"] = {}
-        if "admins" not in loaded:
-                loaded["admins"] = []
-        return normalize_chart(loaded)  # type: ignore
+        return normalize_chart(loaded)
+
 
+def serialize_alignment_chart(
+        chart: AlignmentChart,
+        fmt: ChartFormat = "yaml",
+) -> BytesIO:
+        """Convert Python dict into YAML (or binary) BytesIO."""
+        buf = BytesIO()
+        if fmt == "binary":
+                if msgpack is None:
+                        msg = "msgpack is required to write binary chart files"
+                        raise RuntimeError(msg)
+                buf.write(BINARY_CHART_MAGIC)
+                buf.write(msgpack.packb(chart, default=dict))
+        else:
+                yaml.dump(
+                        chart,
+                        buf,
+                        Dumper=ChartDumper,
+                        sort_keys=False,
+                        encoding="utf-8",
+                )
+        buf.seek(0)
+        return buf
+
+
+def serialize_alignment_ops(ops: Iterable[AlignmentOp]) -> BytesIO:
+        """Convert operations into journal lines, one JSON object each."""
+        buf = BytesIO()
+        for op in ops:
+                buf.write(json.dumps(op, separators=(",", ":")).encode())
+                buf.write(b"\n")
+        buf.seek(0)
+        return buf
 
-def serialize_alignment_chart(chart: AlignmentChart) -> BytesIO:
-        """Convert Python dict into YAML BytesIO."""
-        text_buf = StringIO()
-        yaml.safe_dump(chart, text_buf, sort_keys=False)
-        bytes_buf = BytesIO(text_buf.getvalue().encode("utf-8"))
-        bytes_buf.seek(0)
-        return bytes_buf
+
+def parse_alignment_journal(data: BytesIO) -> list[AlignmentOp]:
+        """Parse journal lines back into operations.
+
+        A torn final line, left by a crash mid-append, is ignored.
+        """
+        data.seek(0)
+        ops = []
+        for line in data:
+                if not line.endswith(b"\n"):
+                        break
+                try:
+                        ops.append(json.loads(line))
+                except ValueError:
+                        break
+        return ops
+
+
+class AlignmentIndex:
+        """User IDs per alignment, kept in step with one chart.
+
+        Each alignment maps to an insertion-ordered set (a dict with
+        ``None`` values) of user IDs, so counts and membership are O(1)
+        and listing an alignment never scans the whole chart. Pass it to
+        ``set_user_alignment``/``remove_user_alignment`` (or
+        ``apply_alignment_op``) to keep it current.
+        """
+
+        __slots__ = ("_members",)
+
+        def __init__(self, chart: AlignmentChart | None = None) -> None:
+                self._members: dict[AlignmentName, dict[str, None]] = {
+                        name: {} for row in ALIGNMENT_GRID for name in row
+                }
+                if chart is not None:
+                        for user_id, entry in chart["users"].items():
+                                self.move(user_id, None, entry["alignment"])
+
+        def count(self, alignment: AlignmentName) -> int:
+                """Return how many users have an alignment."""
+                return len(self._members[alignment])
+
+        def counts(self) -> dict[AlignmentName, int]:
+                """Return the number of users per alignment."""
+                return {name: len(ids) for name, ids in self._members.items()}
+
+        def users(self, alignment: AlignmentName) -> KeysView[str]:
+                """Return a live view of the users with an alignment."""
+                return self._members[alignment].keys()
+
+        def move(
+                self,
+                user_id: str,
+                old: AlignmentName | None,
+                new: AlignmentName | None,
+        ) -> None:
+                """Record a user changing alignment, joining or leaving."""
+                if old is not None:
+                        self._members[old].pop(user_id, None)
+                if new is not None:
+                        self._members[new][user_id] = None
 
 
 def set_user_alignment(
@@ -193,25 +708,195 @@ def set_user_alignment(
         alignment: AlignmentName,
         display_name: str,
         avatar_url: str | None = None,
+        *,
+        index: AlignmentIndex | None = None,
 ) -> AlignmentChart:
         """Return a new chart with updated alignment for a user."""
-        new_chart = {"users": dict(chart["users"])}
-        new_chart["users"][user_id] = {
+        if index is not None:
+                previous = chart["users"].get(user_id)
+                index.move(
+                        user_id,
+                        None if previous is None else previous["alignment"],
+                        alignment,
+                )
+        entry: UserAlignment = {
                 "alignment": alignment,
                 "display_name": display_name,
                 "avatar_url": avatar_url,
         }
-        return new_chart  # type: ignore
+        users = chart["users"]
+        if isinstance(users, PersistentMap):
+                users = users.set(user_id, compact_user(entry))
+        else:
+                users = {**users, user_id: entry}
+        return {"users": users, "admins": chart.get("admins", [])}
 
 
 def remove_user_alignment(
         chart: AlignmentChart,
         user_id: str,
+        *,
+        index: AlignmentIndex | None = None,
 ) -> AlignmentChart:
         """Return a new chart with a user removed."""
-        new_chart = {"users": dict(chart["users"])}
-        new_chart["users"].pop(user_id, None)
-        return new_chart  # type: ignore
+        previous = chart["users"].get(user_id)
+        if index is not None and previous is not None:
+                index.move(user_id, previous["alignment"], None)
+        users = chart["users"]
+        if isinstance(users, PersistentMap):
+                users = users.delete(user_id)
+        else:
+                users = dict(users)
+                users.pop(user_id, None)
+        return {"users": users, "admins": chart.get("admins", [])}
+
+
+def add_alignment_admin(
+        chart: AlignmentChart,
+        user_id: str,
+) -> AlignmentChart:
+        """Return a new chart with a user added to the admins."""
+        if user_id in chart["admins"]:
+                return chart
+        return {"users": chart["users"], "admins": [*chart["admins"], user_id]}
+
+
+def remove_alignment_admin(
+        chart: AlignmentChart,
+        user_id: str,
+) -> AlignmentChart:
+        """Return a new chart with a user removed from the admins."""
+        if user_id not in chart["admins"]:
+                return chart
+        return {
+                "users": chart["users"],
+                "admins": [a for a in chart["admins"] if a != user_id],
+        }
+
+
+def apply_alignment_op(
+        chart: AlignmentChart,
+        op: AlignmentOp,
+        index: AlignmentIndex | None = None,
+) -> AlignmentChart:
+        """Return a new chart with a single operation applied.
+
+        ``index``, if given, is updated to match the new chart.
+        """
+        match op["op"]:
+                case "set":
+                        return set_user_alignment(
+                                chart,
+                                op["user_id"],
+                                op["alignment"],
+                                op["display_name"],
+                                op["avatar_url"],
+                                index=index,
+                        )
+                case "remove":
+                        return remove_user_alignment(
+                                chart, op["user_id"], index=index
+                        )
+                case "add_admin":
+                        return add_alignment_admin(chart, op["user_id"])
+                case "remove_admin":
+                        return remove_alignment_admin(chart, op["user_id"])
+                case _:
+                        msg = f"Unknown chart operation: {op['op']!r}"
+                        raise ValueError(msg)
+
+
+def apply_alignment_ops(
+        chart: AlignmentChart,
+        ops: Iterable[AlignmentOp],
+        index: AlignmentIndex | None = None,
+) -> AlignmentChart:
+        """Return a new chart with many operations applied in order.
+
+        Unlike chaining ``apply_alignment_op``, the users dict and the
+        admins list are each copied at most once, whatever the number
+        of operations. Users in a ``PersistentMap`` are not copied at
+        all. ``index``, if given, is updated to match. Every operation
+        is checked first, so an unknown one changes nothing.
+        """
+        ops = list(ops)
+        for op in ops:
+                if op["op"] not in _OP_KINDS:
+                        msg = f"Unknown chart operation: {op['op']!r}"
+                        raise ValueError(msg)
+        return {
+                "users": _apply_user_ops(chart["users"], ops, index),
+                "admins": _apply_admin_ops(chart["admins"], ops),
+        }
+
+
+_OP_KINDS = frozenset(("set", "remove", "add_admin", "remove_admin"))
+
+
+def _apply_user_ops(
+        users: Mapping[str, UserAlignment],
+        ops: list[AlignmentOp],
+        index: AlignmentIndex | None,
+) -> Mapping[str, UserAlignment]:
+        original = users
+        persistent = isinstance(users, PersistentMap)
+        for op in ops:
+                if op["op"] not in ("set", "remove"):
+                        continue
+                user_id = op["user_id"]
+                previous = users.get(user_id)
+                after = op["alignment"] if op["op"] == "set" else None
+                if persistent:
+                        users = (
+                                users.delete(user_id)
+                                if after is None
+                                else users.set(
+                                        user_id, compact_user(_op_entry(op))
+                                )
+                        )
+                elif after is not None or previous is not None:
+                        if users is original:
+                                users = dict(users)
+                        if after is None:
+                                del users[user_id]
+                        else:
+                                users[user_id] = _op_entry(op)
+                if index is not None:
+                        index.move(
+                                user_id,
+                                previous["alignment"] if previous else None,
+                                after,
+                        )
+        return users
+
+
+def _apply_admin_ops(
+        admins: list[str],
+        ops: list[AlignmentOp],
+) -> list[str]:
+        original = admins
+        for op in ops:
+                user_id = op["user_id"]
+                adding = op["op"] == "add_admin"
+                if op["op"] not in ("add_admin", "remove_admin") or (
+                        adding == (user_id in admins)
+                ):
+                        continue
+                if admins is original:
+                        admins = list(admins)
+                if adding:
+                        admins.append(user_id)
+                else:
+                        admins.remove(user_id)
+        return admins
+
+
+def _op_entry(op: SetAlignmentOp) -> UserAlignment:
+        return {
+                "alignment": op["alignment"],
+                "display_name": op["display_name"],
+                "avatar_url": op["avatar_url"],
+        }
 
 
 def load_file_buffer(path: Path) -> BytesIO:
@@ -222,8 +907,52 @@ def load_file_buffer(path: Path) -> BytesIO:
 
 
 def save_file_buffer(path: Path, data: BytesIO) -> None:
-        """Write YAML BytesIO back to disk."""
-        path.write_bytes(data.getvalue())
+        """Atomically write YAML BytesIO back to disk.
+
+        The data goes to a temporary file next to ``path`` which is fsynced
+        and renamed over it, so a crash leaves either the old or the new
+        file, never a truncated one.
+        """
+        with tempfile.NamedTemporaryFile(
+                dir=path.parent,
+                prefix=f".{path.name}.",
+                suffix=".tmp",
+                delete=False,
+        ) as tmp:
+                tmp_path = Path(tmp.name)
+                try:
+                        tmp.write(data.getbuffer())
+                        tmp.flush()
+                        os.fsync(tmp.fileno())
+                except BaseException:
+                        tmp.close()
+                        tmp_path.unlink(missing_ok=True)
+                        raise
+        tmp_path.replace(path)
+        _fsync_dir(path.parent)
+
+
+def append_file_buffer(path: Path, data: BytesIO) -> int:
+        """Append to a file and fsync it. Returns the new file size."""
+        with path.open("ab") as f:
+                f.write(data.getbuffer())
+                f.flush()
+                os.fsync(f.fileno())
+                return f.tell()
+
+
+def _fsync_dir(path: Path) -> None:
+        """Persist a rename by syncing its directory, where supported."""
+        try:
+                fd = os.open(path, os.O_RDONLY)
+        except OSError:
+                return
+        try:
+                os.fsync(fd)
+        except OSError:
+                pass
+        finally:
+                os.close(fd)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,255 @@
+from __future__ import annotations  # noqa: D100
+
+import asyncio
+import hashlib
+import json
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import aiohttp
+
+if TYPE_CHECKING:
+        from collections.abc import Mapping
+
+log = logging.getLogger(__name__)
+
+DEFAULT_LIMIT_PER_HOST = 16
+DEFAULT_TIMEOUT = 10.0
+DEFAULT_CACHE_BYTES = 256 * 1024 * 1024
+INDEX_SAVE_EVERY = 64
+
+
+def _write_atomic(path: Path, data: bytes) -> None:
+        # No fsync, a lost cache entry is just downloaded again
+        with tempfile.NamedTemporaryFile(
+                dir=path.parent, suffix=".tmp", delete=False
+        ) as tmp:
+                tmp.write(data)
+        Path(tmp.name).replace(path)
+
+
+class AvatarDiskCache:
+        """Content-addressed avatar cache with a total byte budget.
+
+        Discord avatar URLs embed a hash of the image, so the bytes behind
+        a URL never change and entries never need revalidating. Files are
+        named after the SHA-256 of their URL. Least recently used entries
+        are evicted once ``max_bytes`` is exceeded.
+
+        Sizes and LRU order live in ``index.json``, so startup lists the
+        directory but only stat()s files the index does not know. Those
+        were written after the last save; they are counted and are the
+        first to be evicted. The index is rewritten every
+        ``INDEX_SAVE_EVERY`` puts and on ``close``. Reads only reorder
+        it in memory, so a cache that is mostly read is rarely written.
+        """
+
+        def __init__(
+                self,
+                path: Path,
+                *,
+                max_bytes: int = DEFAULT_CACHE_BYTES,
+        ) -> None:
+                self.path = path
+                self.path.mkdir(parents=True, exist_ok=True)
+                self.max_bytes = max_bytes
+                self._lock = threading.Lock()
+                self._entries: OrderedDict[str, int] = self._load_index()
+                self._total = sum(self._entries.values())
+                self._unsaved = 0
+                # Reads since the last save, whose order is not saved yet
+                self._reordered = False
+                with self._lock:
+                        self._evict()
+
+        @property
+        def _index_path(self) -> Path:
+                return self.path / "index.json"
+
+        def _load_index(self) -> OrderedDict[str, int]:
+                try:
+                        indexed = dict(
+                                json.loads(self._index_path.read_bytes())
+                        )
+                except (OSError, ValueError):
+                        # Missing or corrupt, rebuild it from the files
+                        indexed = {}
+                on_disk = {
+                        entry.name: entry
+                        for entry in self.path.iterdir()
+                        if len(entry.name) == 64
+                }
+                # Files the index does not list go first in LRU order
+                entries = OrderedDict(
+                        (name, entry.stat().st_size)
+                        for name, entry in on_disk.items()
+                        if name not in indexed
+                )
+                entries.update(
+                        (name, size)
+                        for name, size in indexed.items()
+                        if name in on_disk
+                )
+                return entries
+
+        def _save_index(self) -> None:
+                _write_atomic(
+                        self._index_path,
+                        json.dumps(list(self._entries.items())).encode(),
+                )
+                self._unsaved = 0
+                self._reordered = False
+
+        def _changed(self) -> None:
+                self._unsaved += 1
+                if self._unsaved >= INDEX_SAVE_EVERY:
+                        self._save_index()
+
+        @staticmethod
+        def key_for(url: str) -> str:
+                """Return the cache key (and file name) for a URL."""
+                return hashlib.sha256(url.encode()).hexdigest()
+
+        def __contains__(self, url: str) -> bool:
+                return self.key_for(url) in self._entries
+
+        @property
+        def total_bytes(self) -> int:
+                """Return the bytes currently accounted to the cache."""
+                return self._total
+
+        def get(self, url: str) -> bytes | None:
+                """Return the cached bytes for a URL, if any."""
+                key = self.key_for(url)
+                with self._lock:
+                        if key not in self._entries:
+                                return None
+                        self._entries.move_to_end(key)
+                        self._reordered = True
+                try:
+                        return (self.path / key).read_bytes()
+                except OSError:
+                        with self._lock:
+                                self._total -= self._entries.pop(key, 0)
+                        return None
+
+        def put(self, url: str, data: bytes) -> None:
+                """Store the bytes behind a URL, evicting old entries."""
+                key = self.key_for(url)
+                if len(data) > self.max_bytes:
+                        return
+                _write_atomic(self.path / key, data)
+                with self._lock:
+                        self._total += len(data) - self._entries.pop(key, 0)
+                        self._entries[key] = len(data)
+                        self._evict()
+                        self._changed()
+
+        def _evict(self) -> None:
+                while self._total > self.max_bytes:
+                        key, size = self._entries.popitem(last=False)
+                        self._total -= size
+                        (self.path / key).unlink(missing_ok=True)
+
+        def close(self) -> None:
+                """Persist the index, if anything changed."""
+                with self._lock:
+                        if self._unsaved or self._reordered:
+                                self._save_index()
+
+
+class AvatarFetcher:
+        """Download avatar images over one shared, pooled HTTP session.
+
+        At most ``limit_per_host`` requests are in flight per host.
+        Concurrent requests for the same URL, from one render or several,
+        share a single download. Failed or timed out downloads return
+        ``placeholder`` (``None`` lets the renderer draw its own).
+
+        With a ``cache``, avatars already on disk are never downloaded
+        again.
+        """
+
+        def __init__(
+                self,
+                *,
+                limit_per_host: int = DEFAULT_LIMIT_PER_HOST,
+                timeout: float = DEFAULT_TIMEOUT,
+                placeholder: bytes | None = None,
+                cache: AvatarDiskCache | None = None,
+        ) -> None:
+                self.cache = cache
+                self.limit_per_host = limit_per_host
+                self.timeout = aiohttp.ClientTimeout(total=timeout)
+                self.placeholder = placeholder
+                self._session: aiohttp.ClientSession | None = None
+                self._inflight: dict[str, asyncio.Future[bytes | None]] = {}
+
+        def _get_session(self) -> aiohttp.ClientSession:
+                # Created lazily, it has to be bound to the running loop
+                if self._session is None or self._session.closed:
+                        self._session = aiohttp.ClientSession(
+                                connector=aiohttp.TCPConnector(
+                                        limit=0,
+                                        limit_per_host=self.limit_per_host,
+                                ),
+                                timeout=self.timeout,
+                        )
+                return self._session
+
+        @property
+        def session(self) -> aiohttp.ClientSession:
+                """Return the shared session, for other downloads to reuse."""
+                return self._get_session()
+
+        async def fetch(self, url: str | None) -> bytes | None:
+                """Return the image behind ``url``, or the placeholder."""
+                if not url:
+                        return self.placeholder
+                inflight = self._inflight.get(url)
+                if inflight is None:
+                        inflight = asyncio.ensure_future(self._download(url))
+                        self._inflight[url] = inflight
+                        inflight.add_done_callback(
+                                lambda _: self._inflight.pop(url, None)
+                        )
+                # One caller giving up must not cancel the shared download
+                return await asyncio.shield(inflight)
+
+        async def _download(self, url: str) -> bytes | None:
+                if self.cache is not None:
+                        data = await asyncio.to_thread(self.cache.get, url)
+                        if data is not None:
+                                return data
+                try:
+                        async with self._get_session().get(url) as response:
+                                response.raise_for_status()
+                                data = await response.read()
+                except (aiohttp.ClientError, TimeoutError) as e:
+                        log.debug("Avatar download failed for %s: %r", url, e)
+                        return self.placeholder
+                if self.cache is not None:
+                        await asyncio.to_thread(self.cache.put, url, data)
+                return data
+
+        async def fetch_many(
+                self,
+                urls: Mapping[str, str | None],
+        ) -> dict[str, bytes | None]:
+                """Fetch every avatar in a user ID to URL mapping."""
+                images = await asyncio.gather(
+                        *(self.fetch(url) for url in urls.values())
+                )
+                return dict(zip(urls, images, strict=True))
+
+        async def close(self) -> None:
+                """Close the shared session and the cache index."""
+                if self._session is not None:
+                        await self._session.close()
+                        self._session = None
+                if self.cache is not None:
+                        await asyncio.to_thread(self.cache.close)
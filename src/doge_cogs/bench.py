@@ -0,0 +1,573 @@
+"""Timings and memory use of the alignment chart hot paths.
+
+Run with ``python -m doge_cogs.bench``. ``--json results.json`` saves
+the results; ``--compare baseline.json`` reports anything slower or
+larger than a saved run by more than ``--threshold``, and exits with
+status 1 if so.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import contextlib
+import gc
+import json
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+from io import BytesIO
+from pathlib import Path
+from typing import TYPE_CHECKING, TypedDict, get_args
+
+import yaml
+
+from doge_cogs.alignment import (
+        AlignmentChart,
+        AlignmentName,
+        BorderShape,
+        ChartStyle,
+        msgpack,
+        parse_alignment_chart,
+        persistent_chart,
+        process_avatar,
+        remove_user_alignment,
+        render_alignment_chart,
+        serialize_alignment_chart,
+        set_user_alignment,
+        solid_color_background,
+)
+from doge_cogs.hamt import PersistentMap
+from doge_cogs.sqlite_storage import SqliteBackend
+from doge_cogs.storage import ChartBackend, ShardedBackend, YamlBackend
+from doge_cogs.tiles import TileCache
+
+try:
+        from doge_cogs.numpy_render import render_chart_numpy
+except ImportError:
+        render_chart_numpy = None
+
+if TYPE_CHECKING:
+        from collections.abc import Callable
+
+        from doge_cogs.alignment import AlignmentOp
+
+ALIGNMENTS: tuple[AlignmentName, ...] = get_args(AlignmentName)
+BORDER_SHAPES: tuple[BorderShape, ...] = get_args(BorderShape)
+
+SUITE_SIZES = (10, 100, 1_000, 10_000, 100_000)
+DEFAULT_REPEAT = 5
+# Allowed slowdown against a baseline before it counts as a regression
+DEFAULT_THRESHOLD = 0.2
+
+
+class BenchResults(TypedDict):
+        """A benchmark run, as saved with ``--json``."""
+
+        python: str
+        platform: str
+        seconds: dict[str, float]
+        bytes: dict[str, float]
+
+
+def synthetic_chart(num_users: int, seed: int = 0) -> AlignmentChart:
+        """Build a chart with ``num_users`` realistic-looking entries."""
+        # Not for secrets: seeded, so every run times the same chart
+        rng = random.Random(seed)  # noqa: S311
+        users = {}
+        for _ in range(num_users):
+                user_id = str(rng.randrange(10**17, 10**18))
+                users[user_id] = {
+                        "alignment": rng.choice(ALIGNMENTS),
+                        "display_name": f"user_{rng.randrange(10**6)}",
+                        "avatar_url": (
+                                f"https://cdn.discordapp.com/avatars/{user_id}/"
+                                f"{rng.getrandbits(128):032x}.png"
+                        ),
+                }
+        admins = list(users)[: min(3, num_users)]
+        return {"users": users, "admins": admins}
+
+
+def best_of(func: Callable[[], object], repeat: int = 5) -> float:
+        """Return the fastest of ``repeat`` runs of ``func``, in seconds."""
+        best = float("inf")
+        for _ in range(repeat):
+                start = time.perf_counter()
+                func()
+                best = min(best, time.perf_counter() - start)
+        return best
+
+
+def per_call(func: Callable[[], object], repeat: int = DEFAULT_REPEAT) -> float:
+        """Return the fastest time of one call to ``func``, in seconds.
+
+        Quick calls are looped until a run takes long enough to measure,
+        like ``python -m timeit`` does.
+        """
+        timer = timeit.Timer(func)
+        number, _ = timer.autorange()
+        return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def _bench_chart_size(
+        chart: AlignmentChart,
+        repeat: int,
+) -> dict[str, float]:
+        data = serialize_alignment_chart(chart).getvalue()
+        resident = persistent_chart(chart)
+        # An existing user for remove, a new one for set
+        existing = next(iter(chart["users"]), "0")
+        results = {
+                "parse": per_call(
+                        lambda: parse_alignment_chart(BytesIO(data)), repeat
+                ),
+                "serialize": per_call(
+                        lambda: serialize_alignment_chart(chart), repeat
+                ),
+        }
+        for kind, target in (("dict", chart), ("persistent", resident)):
+                results[f"set_user_{kind}"] = per_call(
+                        lambda target=target: set_user_alignment(
+                                target, "1", "Chaotic Evil", "New User"
+                        ),
+                        repeat,
+                )
+                results[f"remove_user_{kind}"] = per_call(
+                        lambda target=target: remove_user_alignment(
+                                target, existing
+                        ),
+                        repeat,
+                )
+        return results
+
+
+def bench_chart_model(
+        sizes: tuple[int, ...] = SUITE_SIZES,
+        repeat: int = DEFAULT_REPEAT,
+) -> dict[str, float]:
+        """Time chart parsing, serializing and single-user updates.
+
+        Updates are timed on a plain chart, which is copied per update,
+        and on a resident ``PersistentMap`` chart.
+        """
+        results = {}
+        for num_users in sizes:
+                timings = _bench_chart_size(synthetic_chart(num_users), repeat)
+                for name, seconds in timings.items():
+                        results[f"{name}_{num_users}"] = seconds
+        return results
+
+
+def _storage_backends(data_dir: Path) -> dict[str, ChartBackend]:
+        backends: dict[str, ChartBackend] = {
+                "yaml": YamlBackend(data_dir / "yaml"),
+                "sqlite": SqliteBackend(data_dir / "charts.db"),
+                "sharded": ShardedBackend(data_dir / "sharded"),
+        }
+        if msgpack is not None:
+                backends["binary"] = YamlBackend(
+                        data_dir / "binary", snapshot_format="binary"
+                )
+        return backends
+
+
+def _bench_storage_size(
+        backends: dict[str, ChartBackend],
+        chart: AlignmentChart,
+        repeat: int,
+) -> dict[str, float]:
+        guild_id = len(chart["users"])
+
+        def round_trip(backend: ChartBackend) -> None:
+                backend.save(guild_id, chart)
+                backend.load(guild_id)
+
+        results = {
+                f"{name}_round_trip": per_call(
+                        lambda b=backend: round_trip(b), repeat
+                )
+                for name, backend in backends.items()
+        }
+        if not chart["users"]:
+                return results
+        # Sets a user to what they already are, so the chart stays valid
+        user_id, entry = next(iter(chart["users"].items()))
+        op: AlignmentOp = {"op": "set", "user_id": user_id, **entry}
+        for name, backend in backends.items():
+                results[f"{name}_save_one"] = per_call(
+                        lambda b=backend: b.save(guild_id, chart, [op]), repeat
+                )
+        return results
+
+
+def bench_storage(
+        sizes: tuple[int, ...] = SUITE_SIZES,
+        repeat: int = DEFAULT_REPEAT,
+) -> dict[str, float]:
+        """Time a whole chart round trip and a one-user save, per backend."""
+        results = {}
+        with tempfile.TemporaryDirectory() as tmpdir:
+                backends = _storage_backends(Path(tmpdir))
+                try:
+                        for num_users in sizes:
+                                timings = _bench_storage_size(
+                                        backends,
+                                        synthetic_chart(num_users),
+                                        repeat,
+                                )
+                                for name, seconds in timings.items():
+                                        results[f"{name}_{num_users}"] = seconds
+                finally:
+                        for backend in backends.values():
+                                backend.close()
+        return results
+
+
+def bench_avatar_shapes(
+        size: int = 128,
+        repeat: int = DEFAULT_REPEAT,
+) -> dict[str, float]:
+        """Time ``process_avatar`` on one avatar for every border shape."""
+        results = {}
+        with solid_color_background(2 * size, 2 * size, "orange") as source:
+                for shape in BORDER_SHAPES:
+
+                        def process(shape: BorderShape = shape) -> None:
+                                with source.clone() as img:
+                                        styled = process_avatar(
+                                                img,
+                                                (size, size),
+                                                4,
+                                                "red",
+                                                shape,
+                                        )
+                                        styled.close()
+
+                        results[f"process_avatar_{shape}"] = per_call(
+                                process, repeat
+                        )
+        return results
+
+
+def bench_chart_formats(
+        num_users: int = 10_000,
+        repeat: int = DEFAULT_REPEAT,
+) -> dict[str, float]:
+        """Time chart parse/serialize for each available encoding."""
+
+        def timed(func: Callable[[], object]) -> float:
+                return best_of(func, repeat)
+
+        chart = synthetic_chart(num_users)
+        yaml_bytes = serialize_alignment_chart(chart).getvalue()
+        results = {
+                "pure_yaml_parse": timed(
+                        lambda: yaml.load(  # noqa: S506
+                                yaml_bytes.decode(), Loader=yaml.SafeLoader
+                        )
+                ),
+                "pure_yaml_serialize": timed(
+                        lambda: yaml.dump(
+                                chart, Dumper=yaml.SafeDumper, sort_keys=False
+                        )
+                ),
+                "yaml_parse": timed(
+                        lambda: parse_alignment_chart(BytesIO(yaml_bytes))
+                ),
+                "yaml_serialize": timed(
+                        lambda: serialize_alignment_chart(chart)
+                ),
+        }
+        if msgpack is not None:
+                binary = serialize_alignment_chart(chart, "binary").getvalue()
+                results["binary_parse"] = timed(
+                        lambda: parse_alignment_chart(BytesIO(binary))
+                )
+                results["binary_serialize"] = timed(
+                        lambda: serialize_alignment_chart(chart, "binary")
+                )
+        return results
+
+
+def synthetic_avatars(
+        chart: AlignmentChart,
+        distinct: int = 64,
+        size: int = 128,
+) -> dict[str, bytes]:
+        """Give every user one of ``distinct`` solid color PNG avatars."""
+        images = []
+        for i in range(distinct):
+                with solid_color_background(
+                        size, size, f"hsl({i * 360 // distinct}, 70%, 50%)"
+                ) as img:
+                        images.append(img.make_blob("png"))
+        return {
+                user_id: images[i % distinct]
+                for i, user_id in enumerate(chart["users"])
+        }
+
+
+def _time_render(
+        render: Callable[..., bytes],
+        chart: AlignmentChart,
+        avatars: dict[str, bytes],
+        style: ChartStyle,
+) -> tuple[float, float]:
+        cold = best_of(
+                lambda: render(chart, avatars, style, TileCache()), repeat=3
+        )
+        tiles = TileCache()
+        render(chart, avatars, style, tiles)
+        warm = best_of(lambda: render(chart, avatars, style, tiles), repeat=3)
+        return cold, warm
+
+
+def bench_render_engines(
+        sizes: tuple[int, ...] = (100, 1_000, 5_000),
+) -> dict[str, float]:
+        """Time full chart renders with each engine, cold and warm.
+
+        Cold renders start from an empty tile cache; warm ones reuse the
+        tiles of the previous render.
+        """
+        engines = {"wand": render_alignment_chart}
+        if render_chart_numpy is not None:
+                engines["numpy"] = render_chart_numpy
+        results = {}
+        for num_users in sizes:
+                chart = synthetic_chart(num_users)
+                avatars = synthetic_avatars(chart)
+                for engine, render in engines.items():
+                        style = ChartStyle(engine=engine)
+                        cold, warm = _time_render(render, chart, avatars, style)
+                        results[f"{engine}_render_{num_users}_cold"] = cold
+                        results[f"{engine}_render_{num_users}_warm"] = warm
+        return results
+
+
+def allocated_bytes(build: Callable[[], object]) -> int:
+        """Return the memory still held by what ``build`` returns."""
+        gc.collect()
+        tracemalloc.start()
+        try:
+                kept = build()  # noqa: F841
+                gc.collect()
+                return tracemalloc.get_traced_memory()[0]
+        finally:
+                tracemalloc.stop()
+
+
+def bench_user_memory(
+        sizes: tuple[int, ...] = (10_000, 100_000),
+) -> dict[str, float]:
+        """Measure resident bytes per user of each chart representation.
+
+        Charts are parsed from YAML first, like the bot loads them, so
+        strings are not shared unless the representation shares them.
+        """
+        results = {}
+        for num_users in sizes:
+                data = serialize_alignment_chart(
+                        synthetic_chart(num_users)
+                ).getvalue()
+
+                def parse(data: bytes = data) -> AlignmentChart:
+                        return parse_alignment_chart(BytesIO(data))
+
+                def shared(data: bytes = data) -> PersistentMap:
+                        return PersistentMap(parse(data)["users"])
+
+                def compact(data: bytes = data) -> AlignmentChart:
+                        return persistent_chart(parse(data))
+
+                for name, build in (
+                        ("dict", parse),
+                        ("persistent", shared),
+                        ("compact", compact),
+                ):
+                        results[f"{name}_bytes_per_user_{num_users}"] = (
+                                allocated_bytes(build) / num_users
+                        )
+        return results
+
+
+def _time_import(modules: str) -> float:
+        return best_of(
+                lambda: subprocess.run(  # noqa: S603
+                        [sys.executable, "-c", f"import {modules}"],
+                        check=True,
+                        capture_output=True,
+                ),
+                repeat=5,
+        )
+
+
+async def _load_cog(
+        cog_class: type,
+        bot: object,
+        data_dir: Path,
+) -> tuple[float, float]:
+        start = time.perf_counter()
+        cog = cog_class(bot, metrics=False, data_dir=data_dir)
+        await cog.cog_load()
+        loaded = time.perf_counter()
+        await cog._warm_task  # noqa: SLF001
+        warmed = time.perf_counter()
+        await cog.cog_unload()
+        return loaded - start, warmed - start
+
+
+def bench_startup(
+        num_users: int = 1_000,
+        repeat: int = DEFAULT_REPEAT,
+) -> dict[str, float]:
+        """Time importing, loading and warming up the cog.
+
+        ``cog_import`` is a fresh interpreter importing what the cog
+        imports, less the interpreter's own start-up; ``with_wand`` adds
+        the imaging stack the cog no longer loads up front.
+        ``cog_load`` is constructing ``AlignmentCog`` on the load test's
+        fake bot and running ``cog_load``, and ``cog_warm`` is that plus
+        waiting for ``_warm`` to preload its recently used guilds of
+        ``num_users`` users each. Those two need Red and the repository
+        root on the path, and are skipped otherwise.
+        """
+        cog = (
+                "doge_cogs.cache, doge_cogs.pages, doge_cogs.render,"
+                " doge_cogs.storage, doge_cogs.transfer"
+        )
+        bare = best_of(
+                lambda: subprocess.run(  # noqa: S603
+                        [sys.executable, "-c", "pass"], check=True
+                )
+        )
+        results = {"cog_import": _time_import(cog) - bare}
+        with contextlib.suppress(subprocess.CalledProcessError):
+                results["cog_import_with_wand"] = (
+                        _time_import(f"{cog}, wand.image, wand.drawing") - bare
+                )
+        try:
+                from doge_alignment.doge_alignment import (
+                        DEFAULT_WARM_GUILDS,
+                        AlignmentCog,
+                )
+                from doge_alignment.loadtest import FakeBot
+        except ImportError as e:
+                print(f"Skipping cog load benchmarks: {e}", file=sys.stderr)
+                return results
+        with tempfile.TemporaryDirectory() as tmpdir:
+                data_dir = Path(tmpdir)
+                backend = YamlBackend(data_dir)
+                chart = synthetic_chart(num_users)
+                guild_ids = list(range(DEFAULT_WARM_GUILDS))
+                for guild_id in guild_ids:
+                        backend.save(guild_id, chart)
+                backend.close()
+                recent = json.dumps(guild_ids)
+                loads, warms = [], []
+                for _ in range(repeat):
+                        # Each unload rewrites it with the guilds it used
+                        (data_dir / "recent_guilds.json").write_text(recent)
+                        loaded, warmed = asyncio.run(
+                                _load_cog(AlignmentCog, FakeBot({}), data_dir)
+                        )
+                        loads.append(loaded)
+                        warms.append(warmed)
+        results["cog_load"] = min(loads)
+        results[f"cog_warm_{num_users}"] = min(warms)
+        return results
+
+
+def run_suite(
+        sizes: tuple[int, ...] = SUITE_SIZES,
+        repeat: int = DEFAULT_REPEAT,
+) -> BenchResults:
+        """Run every benchmark; the imaging ones only if Wand imports."""
+        seconds = (
+                bench_chart_model(sizes, repeat)
+                | bench_storage(sizes, repeat)
+                | bench_chart_formats(repeat=repeat)
+                | bench_startup(repeat=repeat)
+        )
+        try:
+                seconds |= bench_avatar_shapes(repeat=repeat)
+                seconds |= bench_render_engines()
+        except ImportError as e:
+                print(f"Skipping rendering benchmarks: {e}", file=sys.stderr)
+        return {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "seconds": seconds,
+                "bytes": bench_user_memory(
+                        tuple(n for n in sizes if n >= 1_000)
+                ),
+        }
+
+
+def compare_results(
+        current: BenchResults,
+        baseline: BenchResults,
+        threshold: float = DEFAULT_THRESHOLD,
+) -> list[str]:
+        """Describe each result worse than ``baseline`` by over ``threshold``.
+
+        Results missing from either run are not compared.
+        """
+        regressions = []
+        for section in ("seconds", "bytes"):
+                old = baseline.get(section, {})
+                for name, value in current[section].items():
+                        before = old.get(name)
+                        if before and value > before * (1 + threshold):
+                                change = value / before - 1
+                                regressions.append(
+                                        f"{name}: {before:.6g} -> {value:.6g}"
+                                        f" {section} (+{change:.0%})"
+                                )
+        return regressions
+
+
+def main(argv: list[str] | None = None) -> int:
+        """Run the suite, print it, and optionally save or compare it."""
+        parser = argparse.ArgumentParser(prog="python -m doge_cogs.bench")
+        parser.add_argument(
+                "--sizes",
+                type=int,
+                nargs="+",
+                default=SUITE_SIZES,
+                help="synthetic guild sizes, in users",
+        )
+        parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+        parser.add_argument("--json", type=Path, help="save results here")
+        parser.add_argument(
+                "--compare", type=Path, help="baseline results to compare to"
+        )
+        parser.add_argument(
+                "--threshold", type=float, default=DEFAULT_THRESHOLD
+        )
+        args = parser.parse_args(argv)
+
+        results = run_suite(tuple(args.sizes), args.repeat)
+        for name, seconds in results["seconds"].items():
+                print(f"{name:32} {seconds * 1000:12.4f} ms")
+        for name, size in results["bytes"].items():
+                print(f"{name:32} {size:12.0f} B")
+        if args.json is not None:
+                args.json.write_text(json.dumps(results, indent=2) + "\n")
+        if args.compare is None:
+                return 0
+        baseline = json.loads(args.compare.read_text())
+        regressions = compare_results(results, baseline, args.threshold)
+        for line in regressions:
+                print(f"REGRESSION {line}")
+        return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+        sys.exit(main())
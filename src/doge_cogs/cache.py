@@ -0,0 +1,293 @@
+from __future__ import annotations  # noqa: D100
+
+import asyncio
+import contextlib
+import itertools
+import logging
+import weakref
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+
+from doge_cogs.alignment import (
+        AlignmentIndex,
+        apply_alignment_ops,
+        persistent_chart,
+)
+
+if TYPE_CHECKING:
+        from collections.abc import Awaitable, Callable, Iterable, Sequence
+
+        from doge_cogs.alignment import AlignmentChart, AlignmentOp
+
+        ChartSave = Callable[
+                [int, AlignmentChart, Sequence[AlignmentOp]], Awaitable[None]
+        ]
+        # Called with the guild, the chart before the ops, and the ops
+        ChartListener = Callable[
+                [int, AlignmentChart, Sequence[AlignmentOp]], None
+        ]
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_GUILDS = 256
+DEFAULT_FLUSH_INTERVAL = 30.0
+DEFAULT_FLUSH_AFTER = 50
+DEFAULT_WARM_CONCURRENCY = 4
+
+
+class _Entry:
+        __slots__ = ("chart", "flush_lock", "index", "pending", "version")
+
+        def __init__(self, chart: AlignmentChart, version: int) -> None:
+                self.chart = chart
+                self.version = version
+                # Built on first use, then updated along with the chart
+                self.index: AlignmentIndex | None = None
+                self.pending: list[AlignmentOp] = []
+                self.flush_lock = asyncio.Lock()
+
+
+class ChartCache:
+        """Resident per-guild charts with write-behind persistence.
+
+        Charts are loaded on first use and kept in memory. Operations are
+        applied to the resident chart and queued; a guild's queued
+        operations are handed to ``save`` every ``flush_interval``
+        seconds, as soon as it collects ``flush_after`` of them, when it
+        is evicted, and on ``close``. At most ``max_guilds`` charts stay
+        resident, evicted LRU first.
+
+        Resident charts keep their users in a ``PersistentMap``, so an
+        update costs O(log n) rather than a copy of every user, and older
+        versions handed out earlier stay intact.
+
+        ``hits`` and ``misses`` count ``get`` calls that did and did not
+        find the chart resident.
+
+        ``put`` must be called while holding ``lock(guild_id)`` so checks
+        made on the chart still hold when the operations are applied;
+        ``update`` takes the lock itself.
+        """
+
+        def __init__(
+                self,
+                load: Callable[[int], Awaitable[AlignmentChart]],
+                save: ChartSave,
+                *,
+                max_guilds: int = DEFAULT_MAX_GUILDS,
+                flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+                flush_after: int = DEFAULT_FLUSH_AFTER,
+        ) -> None:
+                self._load = load
+                self._save = save
+                self.max_guilds = max_guilds
+                self.flush_interval = flush_interval
+                self.flush_after = flush_after
+                self.hits = 0
+                self.misses = 0
+                self._entries: OrderedDict[int, _Entry] = OrderedDict()
+                self._loading: dict[int, asyncio.Future] = {}
+                # A lock lives as long as someone holds or awaits it, so
+                # idle guilds cost nothing and no waiter is orphaned
+                self._locks: weakref.WeakValueDictionary[int, asyncio.Lock] = (
+                        weakref.WeakValueDictionary()
+                )
+                self._listeners: list[ChartListener] = []
+                # Never reused, even across eviction and reload
+                self._versions = itertools.count()
+                self._task: asyncio.Task | None = None
+
+        def __contains__(self, guild_id: int) -> bool:
+                return guild_id in self._entries
+
+        def __len__(self) -> int:
+                return len(self._entries)
+
+        def dirty_guilds(self) -> list[int]:
+                """Return the guilds with changes not yet written back."""
+                return [g for g, e in self._entries.items() if e.pending]
+
+        def peek(self, guild_id: int) -> AlignmentChart | None:
+                """Return a guild's chart if it is resident, without loading.
+
+                Unlike ``get`` it counts as neither a hit nor a use.
+                """
+                entry = self._entries.get(guild_id)
+                return None if entry is None else entry.chart
+
+        def recent_guilds(self) -> list[int]:
+                """Return the resident guilds, most recently used first."""
+                return list(reversed(self._entries))
+
+        def version(self, guild_id: int) -> int:
+                """Return the version of a resident chart.
+
+                It changes whenever the chart does, so it can key anything
+                derived from the chart.
+                """
+                return self._entries[guild_id].version
+
+        def add_listener(self, listener: ChartListener) -> None:
+                """Call ``listener`` for every batch of operations applied."""
+                self._listeners.append(listener)
+
+        def lock(self, guild_id: int) -> asyncio.Lock:
+                """Return the lock serializing updates to a guild's chart."""
+                lock = self._locks.get(guild_id)
+                if lock is None:
+                        lock = self._locks[guild_id] = asyncio.Lock()
+                return lock
+
+        async def get(self, guild_id: int) -> AlignmentChart:
+                """Return a guild's resident chart, loading it if needed."""
+                entry = self._entries.get(guild_id)
+                if entry is not None:
+                        self._entries.move_to_end(guild_id)
+                        self.hits += 1
+                        return entry.chart
+                self.misses += 1
+                # Concurrent misses share a single load
+                loading = self._loading.get(guild_id)
+                if loading is not None:
+                        return await asyncio.shield(loading)
+                loading = asyncio.get_running_loop().create_future()
+                self._loading[guild_id] = loading
+                try:
+                        chart = persistent_chart(await self._load(guild_id))
+                except BaseException as e:
+                        loading.set_exception(e)
+                        # Only surface it to waiters, if any
+                        loading.exception()
+                        raise
+                finally:
+                        del self._loading[guild_id]
+                entry = self._entries.get(guild_id)
+                if entry is None:
+                        entry = self._entries[guild_id] = _Entry(
+                                chart, next(self._versions)
+                        )
+                loading.set_result(entry.chart)
+                await self._evict()
+                return entry.chart
+
+        async def warm(
+                self,
+                guild_ids: Iterable[int],
+                *,
+                concurrency: int = DEFAULT_WARM_CONCURRENCY,
+        ) -> None:
+                """Preload guild charts, at most ``concurrency`` at a time.
+
+                Only as many guilds as still fit in the cache are loaded,
+                so warming never evicts a chart. Failed loads are logged
+                and skipped; the guild is loaded again on first use.
+                """
+                room = max(0, self.max_guilds - len(self._entries))
+                todo = [g for g in guild_ids if g not in self._entries][:room]
+                limit = asyncio.Semaphore(concurrency)
+
+                async def load(guild_id: int) -> None:
+                        async with limit:
+                                try:
+                                        await self.get(guild_id)
+                                except Exception:
+                                        log.exception(
+                                                "Warming guild %s failed",
+                                                guild_id,
+                                        )
+
+                await asyncio.gather(*(load(g) for g in todo))
+
+        async def index(self, guild_id: int) -> AlignmentIndex:
+                """Return the alignment index of a guild's resident chart."""
+                while True:
+                        await self.get(guild_id)
+                        # The chart may have changed, or been evicted,
+                        # while get was evicting others
+                        entry = self._entries.get(guild_id)
+                        if entry is not None:
+                                break
+                if entry.index is None:
+                        entry.index = AlignmentIndex(entry.chart)
+                return entry.index
+
+        async def put(self, guild_id: int, *ops: AlignmentOp) -> None:
+                """Apply operations to a guild's chart and queue them to save.
+
+                The caller must hold ``lock(guild_id)``.
+                """
+                chart = await self.get(guild_id)
+                entry = self._entries.get(guild_id)
+                index = None if entry is None else entry.index
+                for listener in self._listeners:
+                        listener(guild_id, chart, ops)
+                chart = apply_alignment_ops(chart, ops, index)
+                if entry is None:
+                        # Evicted while loading; it is clean, so start over
+                        entry = self._entries[guild_id] = _Entry(
+                                chart, next(self._versions)
+                        )
+                else:
+                        entry.chart = chart
+                        entry.version = next(self._versions)
+                        self._entries.move_to_end(guild_id)
+                entry.pending.extend(ops)
+                if len(entry.pending) >= self.flush_after:
+                        await self.flush(guild_id)
+                await self._evict()
+
+        async def update(self, guild_id: int, *ops: AlignmentOp) -> None:
+                """Apply operations to a guild's chart under its lock."""
+                async with self.lock(guild_id):
+                        await self.put(guild_id, *ops)
+
+        async def flush(self, guild_id: int | None = None) -> None:
+                """Write back one dirty guild, or every dirty guild."""
+                guild_ids = (
+                        self.dirty_guilds() if guild_id is None else [guild_id]
+                )
+                for gid in guild_ids:
+                        entry = self._entries.get(gid)
+                        if entry is None:
+                                continue
+                        # Saves of one guild must land in order
+                        async with entry.flush_lock:
+                                if not entry.pending:
+                                        continue
+                                ops, entry.pending = entry.pending, []
+                                try:
+                                        await self._save(gid, entry.chart, ops)
+                                except BaseException:
+                                        entry.pending[:0] = ops
+                                        raise
+
+        async def _evict(self) -> None:
+                while len(self._entries) > self.max_guilds:
+                        guild_id = next(iter(self._entries))
+                        await self.flush(guild_id)
+                        entry = self._entries.get(guild_id)
+                        # Drop it unless it was dirtied again while saving
+                        if entry is not None and not entry.pending:
+                                del self._entries[guild_id]
+
+        def start(self) -> None:
+                """Start the periodic write-back task."""
+                if self._task is None:
+                        self._task = asyncio.create_task(self._flush_loop())
+
+        async def _flush_loop(self) -> None:
+                while True:
+                        await asyncio.sleep(self.flush_interval)
+                        try:
+                                await self.flush()
+                        except Exception:
+                                log.exception("Periodic chart flush failed")
+
+        async def close(self) -> None:
+                """Stop the write-back task and flush everything."""
+                if self._task is not None:
+                        self._task.cancel()
+                        with contextlib.suppress(asyncio.CancelledError):
+                                await self._task
+                        self._task = None
+                await self.flush()
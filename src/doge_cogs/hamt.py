@@ -0,0 +1,368 @@
+from __future__ import annotations  # noqa: D100
+
+from collections.abc import Iterator, Mapping
+from typing import Any, Generic, TypeVar
+
+K = TypeVar("K")
+V = TypeVar("V")
+
+_BITS = 5
+_MASK = (1 << _BITS) - 1
+# Past this shift all 64 hash bits are used up
+_MAX_SHIFT = 64
+
+# Leaves are plain (key, insertion number, value) tuples. Hashes are
+# recomputed when needed rather than kept; str caches its own.
+_Leaf = tuple[Any, int, Any]
+
+
+def _hash(key: object) -> int:
+        return hash(key) & 0xFFFF_FFFF_FFFF_FFFF
+
+
+class _Collision:
+        """Leaves whose whole 64-bit hashes are equal."""
+
+        __slots__ = ("leaves",)
+
+        def __init__(self, leaves: tuple[_Leaf, ...]) -> None:
+                self.leaves = leaves
+
+        def find(
+                self,
+                shift: int,  # noqa: ARG002
+                h: int,  # noqa: ARG002
+                key: object,
+        ) -> _Leaf | None:
+                for leaf in self.leaves:
+                        if leaf[0] == key:
+                                return leaf
+                return None
+
+        def assoc(
+                self,
+                shift: int,  # noqa: ARG002
+                h: int,  # noqa: ARG002
+                leaf: _Leaf,
+        ) -> tuple[_Collision, bool]:
+                for i, old in enumerate(self.leaves):
+                        if old[0] == leaf[0]:
+                                leaves = (
+                                        self.leaves[:i]
+                                        + (leaf,)
+                                        + self.leaves[i + 1 :]
+                                )
+                                return _Collision(leaves), False
+                return _Collision((*self.leaves, leaf)), True
+
+        def without(
+                self,
+                shift: int,  # noqa: ARG002
+                h: int,  # noqa: ARG002
+                key: object,
+        ) -> _Collision | _Leaf | None:
+                leaves = tuple(leaf for leaf in self.leaves if leaf[0] != key)
+                if len(leaves) == len(self.leaves):
+                        return self
+                return leaves[0] if len(leaves) == 1 else _Collision(leaves)
+
+
+class _Node:
+        """Up to 32 children, one per 5-bit slice of the key hash."""
+
+        __slots__ = ("bitmap", "entries")
+
+        def __init__(self, bitmap: int, entries: tuple) -> None:
+                self.bitmap = bitmap
+                self.entries = entries
+
+        def find(self, shift: int, h: int, key: object) -> _Leaf | None:
+                bit = 1 << ((h >> shift) & _MASK)
+                if not self.bitmap & bit:
+                        return None
+                entry = self.entries[(self.bitmap & (bit - 1)).bit_count()]
+                if type(entry) is tuple:
+                        return entry if entry[0] == key else None
+                return entry.find(shift + _BITS, h, key)
+
+        def assoc(
+                self,
+                shift: int,
+                h: int,
+                leaf: _Leaf,
+        ) -> tuple[_Node, bool]:
+                bit = 1 << ((h >> shift) & _MASK)
+                idx = (self.bitmap & (bit - 1)).bit_count()
+                entries = self.entries
+                if not self.bitmap & bit:
+                        return (
+                                _Node(
+                                        self.bitmap | bit,
+                                        (*entries[:idx], leaf, *entries[idx:]),
+                                ),
+                                True,
+                        )
+                entry = entries[idx]
+                if type(entry) is not tuple:
+                        child, added = entry.assoc(shift + _BITS, h, leaf)
+                elif entry[0] == leaf[0]:
+                        child, added = leaf, False
+                else:
+                        child = _merge(
+                                entry, _hash(entry[0]), leaf, h, shift + _BITS
+                        )
+                        added = True
+                return (
+                        _Node(
+                                self.bitmap,
+                                (*entries[:idx], child, *entries[idx + 1 :]),
+                        ),
+                        added,
+                )
+
+        def without(
+                self,
+                shift: int,
+                h: int,
+                key: object,
+        ) -> _Node | _Leaf | None:
+                bit = 1 << ((h >> shift) & _MASK)
+                if not self.bitmap & bit:
+                        return self
+                idx = (self.bitmap & (bit - 1)).bit_count()
+                entry = self.entries[idx]
+                if type(entry) is tuple:
+                        if entry[0] != key:
+                                return self
+                        child = None
+                else:
+                        child = entry.without(shift + _BITS, h, key)
+                        if child is entry:
+                                return self
+                entries = self.entries
+                if child is not None:
+                        return _Node(
+                                self.bitmap,
+                                (*entries[:idx], child, *entries[idx + 1 :]),
+                        )
+                if len(entries) == 1:
+                        return None
+                rest = (*entries[:idx], *entries[idx + 1 :])
+                if len(rest) == 1 and type(rest[0]) is tuple and shift:
+                        # Let the parent hold a lone leaf directly
+                        return rest[0]
+                return _Node(self.bitmap & ~bit, rest)
+
+
+def _merge(
+        a: _Leaf,
+        hash_a: int,
+        b: _Leaf,
+        hash_b: int,
+        shift: int,
+) -> _Node | _Collision:
+        if shift >= _MAX_SHIFT:
+                return _Collision((a, b))
+        slot_a = (hash_a >> shift) & _MASK
+        slot_b = (hash_b >> shift) & _MASK
+        if slot_a == slot_b:
+                child = _merge(a, hash_a, b, hash_b, shift + _BITS)
+                return _Node(1 << slot_a, (child,))
+        pair = (a, b) if slot_a < slot_b else (b, a)
+        return _Node((1 << slot_a) | (1 << slot_b), pair)
+
+
+def _build(
+        leaves: list[tuple[int, _Leaf]],
+        shift: int,
+) -> _Node | _Collision:
+        if shift >= _MAX_SHIFT:
+                return _Collision(tuple(leaf for _, leaf in leaves))
+        slots: dict[int, list[tuple[int, _Leaf]]] = {}
+        for hashed in leaves:
+                slots.setdefault((hashed[0] >> shift) & _MASK, []).append(
+                        hashed
+                )
+        bitmap = 0
+        entries = []
+        for slot in sorted(slots):
+                bitmap |= 1 << slot
+                group = slots[slot]
+                entries.append(
+                        group[0][1]
+                        if len(group) == 1
+                        else _build(group, shift + _BITS)
+                )
+        return _Node(bitmap, tuple(entries))
+
+
+_EMPTY = _Node(0, ())
+
+
+# The insertion order is kept in a second trie, keyed by insertion
+# number from the most significant 5-bit slice down. Its nodes at shift
+# 0 hold keys, so walking it left to right yields them in order.
+
+
+def _order_assoc(node: _Node, shift: int, seq: int, key: object) -> _Node:
+        bit = 1 << ((seq >> shift) & _MASK)
+        idx = (node.bitmap & (bit - 1)).bit_count()
+        entries = node.entries
+        present = node.bitmap & bit
+        if not shift:
+                child = key
+        else:
+                below = entries[idx] if present else _EMPTY
+                child = _order_assoc(below, shift - _BITS, seq, key)
+        if present:
+                return _Node(
+                        node.bitmap,
+                        (*entries[:idx], child, *entries[idx + 1 :]),
+                )
+        return _Node(node.bitmap | bit, (*entries[:idx], child, *entries[idx:]))
+
+
+def _order_without(node: _Node, shift: int, seq: int) -> _Node | None:
+        bit = 1 << ((seq >> shift) & _MASK)
+        if not node.bitmap & bit:
+                return node
+        idx = (node.bitmap & (bit - 1)).bit_count()
+        entries = node.entries
+        if shift:
+                child = _order_without(entries[idx], shift - _BITS, seq)
+                if child is not None:
+                        return _Node(
+                                node.bitmap,
+                                (*entries[:idx], child, *entries[idx + 1 :]),
+                        )
+        if len(entries) == 1:
+                return None
+        return _Node(node.bitmap & ~bit, (*entries[:idx], *entries[idx + 1 :]))
+
+
+def _order_iter(node: _Node, shift: int) -> Iterator[Any]:
+        if not shift:
+                yield from node.entries
+                return
+        for child in node.entries:
+                yield from _order_iter(child, shift - _BITS)
+
+
+def _order_build(keys: list[Any]) -> tuple[_Node, int]:
+        """Build the order trie of keys numbered from 0, and its shift."""
+        nodes: list[Any] = keys
+        shift = -_BITS
+        while shift < 0 or len(nodes) > 1:
+                chunks = [
+                        nodes[i : i + _MASK + 1]
+                        for i in range(0, len(nodes), _MASK + 1)
+                ]
+                nodes = [
+                        _Node((1 << len(chunk)) - 1, tuple(chunk))
+                        for chunk in chunks
+                ]
+                shift += _BITS
+        return (nodes[0] if nodes else _EMPTY), shift
+
+
+class PersistentMap(Mapping[K, V], Generic[K, V]):
+        """Immutable, insertion-ordered mapping with O(log n) updates.
+
+        A hash array mapped trie: ``set`` and ``delete`` return a new map
+        that shares every untouched node with the old one, so an update
+        copies a handful of small tuples instead of the whole mapping.
+        Iteration follows insertion order like a dict; overwriting a key
+        keeps its position. The order is kept in a second trie, updated
+        alongside the first, so iterating never has to sort.
+        """
+
+        __slots__ = ("_len", "_next", "_order", "_order_shift", "_root")
+
+        def __init__(self, items: Mapping[K, V] | None = None) -> None:
+                keys = list(items or {})
+                leaves = [
+                        (_hash(key), (key, seq, value))
+                        for seq, (key, value) in enumerate(
+                                (items or {}).items()
+                        )
+                ]
+                self._root = _build(leaves, 0) if leaves else _EMPTY
+                self._len = len(leaves)
+                self._next = len(leaves)
+                self._order, self._order_shift = _order_build(keys)
+
+        @classmethod
+        def _make(
+                cls,
+                root: _Node,
+                length: int,
+                next_seq: int,
+                order: tuple[_Node, int],
+        ) -> PersistentMap[K, V]:
+                new = cls.__new__(cls)
+                new._root = root
+                new._len = length
+                new._next = next_seq
+                new._order, new._order_shift = order
+                return new
+
+        def __getitem__(self, key: K) -> V:
+                leaf = self._root.find(0, _hash(key), key)
+                if leaf is None:
+                        raise KeyError(key)
+                return leaf[2]
+
+        def __contains__(self, key: object) -> bool:
+                return self._root.find(0, _hash(key), key) is not None
+
+        def __len__(self) -> int:
+                return self._len
+
+        def __iter__(self) -> Iterator[K]:
+                return _order_iter(self._order, self._order_shift)
+
+        def __repr__(self) -> str:
+                return f"PersistentMap({dict(self.items())!r})"
+
+        def set(self, key: K, value: V) -> PersistentMap[K, V]:
+                """Return a new map with ``key`` set to ``value``."""
+                h = _hash(key)
+                old = self._root.find(0, h, key)
+                seq = self._next if old is None else old[1]
+                root, added = self._root.assoc(0, h, (key, seq, value))
+                order, shift = self._order, self._order_shift
+                if added:
+                        # Grow a level once the numbers outrun the trie
+                        while seq >> (shift + _BITS):
+                                if order.bitmap:
+                                        order = _Node(1, (order,))
+                                shift += _BITS
+                        order = _order_assoc(order, shift, seq, key)
+                return self._make(
+                        root,
+                        self._len + added,
+                        self._next + added,
+                        (order, shift),
+                )
+
+        def delete(self, key: K) -> PersistentMap[K, V]:
+                """Return a new map without ``key``, if it is there."""
+                h = _hash(key)
+                old = self._root.find(0, h, key)
+                if old is None:
+                        return self
+                root = self._root.without(0, h, key)
+                if root is None:
+                        root = _EMPTY
+                elif type(root) is tuple:
+                        root = _Node(1 << (_hash(root[0]) & _MASK), (root,))
+                order = _order_without(self._order, self._order_shift, old[1])
+                return self._make(
+                        root,
+                        self._len - 1,
+                        self._next,
+                        (order or _EMPTY, self._order_shift),
+                )
+
+        def __reduce__(self) -> tuple:
+                return (type(self), (dict(self.items()),))
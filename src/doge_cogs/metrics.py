@@ -0,0 +1,268 @@
+from __future__ import annotations  # noqa: D100
+
+import contextlib
+import time
+from bisect import bisect_left
+from io import BytesIO
+from typing import TYPE_CHECKING, Literal, Protocol
+
+from doge_cogs.alignment import save_file_buffer
+
+if TYPE_CHECKING:
+        from pathlib import Path
+        from types import TracebackType
+
+# Upper bounds in seconds, as in the Prometheus client defaults
+DEFAULT_BUCKETS = (
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1.0,
+        2.5,
+        5.0,
+        10.0,
+)
+
+# A span times one step of a command, a command the whole of it
+MetricFamily = Literal["span", "command"]
+
+_FAMILIES: dict[MetricFamily, tuple[str, str, str]] = {
+        "span": (
+                "doge_alignment_span_seconds",
+                "span",
+                "Time spent in one step of handling a command.",
+        ),
+        "command": (
+                "doge_alignment_command_seconds",
+                "command",
+                "Time from a command arriving to it finishing.",
+        ),
+}
+
+
+class HitCounter(Protocol):
+        """A cache counting its hits and misses, like ``TileCache``."""
+
+        @property
+        def hits(self) -> int:
+                """Lookups answered from the cache."""
+                ...
+
+        @property
+        def misses(self) -> int:
+                """Lookups that were not."""
+                ...
+
+
+class Histogram:
+        """Observations counted into fixed, cumulative-on-export buckets."""
+
+        __slots__ = ("buckets", "count", "counts", "sum")
+
+        def __init__(
+                self,
+                buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+        ) -> None:
+                self.buckets = buckets
+                # The last count is for values above every bucket
+                self.counts = [0] * (len(buckets) + 1)
+                self.count = 0
+                self.sum = 0.0
+
+        def observe(self, value: float) -> None:
+                """Count one observation."""
+                self.counts[bisect_left(self.buckets, value)] += 1
+                self.count += 1
+                self.sum += value
+
+        def quantile(self, q: float) -> float:
+                """Return the upper bound of the bucket holding quantile ``q``.
+
+                ``inf`` if it lies above every bucket, 0 with no observations.
+                """
+                if not self.count:
+                        return 0.0
+                rank = q * self.count
+                seen = 0
+                for bound, n in zip(self.buckets, self.counts, strict=False):
+                        seen += n
+                        if seen >= rank:
+                                return bound
+                return float("inf")
+
+
+class _Span:
+        __slots__ = ("_family", "_label", "_metrics", "_start")
+
+        def __init__(
+                self,
+                metrics: Metrics,
+                family: MetricFamily,
+                label: str,
+        ) -> None:
+                self._metrics = metrics
+                self._family = family
+                self._label = label
+
+        def __enter__(self) -> None:
+                self._start = time.perf_counter()
+
+        def __exit__(
+                self,
+                exc_type: type[BaseException] | None,
+                exc: BaseException | None,
+                tb: TracebackType | None,
+        ) -> None:
+                self._metrics.observe(
+                        self._family,
+                        self._label,
+                        time.perf_counter() - self._start,
+                )
+
+
+# Shared by every span taken while metrics are disabled
+_NO_SPAN = contextlib.nullcontext()
+
+
+class Metrics:
+        """Latency histograms and cache counters for one cog.
+
+        ``span`` times a block into a histogram per span name; whole
+        commands are recorded with ``observe("command", ...)``. Caches
+        registered with ``add_cache`` are read only when metrics are
+        exported, so counting costs them nothing extra. While disabled,
+        ``span`` hands out one shared no-op context manager and
+        ``observe`` returns at once.
+        """
+
+        def __init__(
+                self,
+                *,
+                enabled: bool = True,
+                buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+        ) -> None:
+                self.enabled = enabled
+                self.buckets = buckets
+                self._histograms: dict[tuple[MetricFamily, str], Histogram] = {}
+                self._caches: dict[str, HitCounter] = {}
+
+        def add_cache(self, name: str, cache: HitCounter) -> None:
+                """Export the hit and miss counts of ``cache``."""
+                self._caches[name] = cache
+
+        def span(
+                self,
+                label: str,
+                family: MetricFamily = "span",
+        ) -> contextlib.AbstractContextManager[None]:
+                """Return a context manager timing its block."""
+                if not self.enabled:
+                        return _NO_SPAN
+                return _Span(self, family, label)
+
+        def observe(
+                self,
+                family: MetricFamily,
+                label: str,
+                seconds: float,
+        ) -> None:
+                """Record one duration."""
+                if not self.enabled:
+                        return
+                key = (family, label)
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                        histogram = self._histograms[key] = Histogram(
+                                self.buckets
+                        )
+                histogram.observe(seconds)
+
+        def histogram(
+                self,
+                family: MetricFamily,
+                label: str,
+        ) -> Histogram | None:
+                """Return the histogram of one span or command, if any."""
+                return self._histograms.get((family, label))
+
+        def summary(self) -> str:
+                """Describe every histogram and cache in a few lines."""
+                lines = []
+                for family in _FAMILIES:
+                        rows = sorted(
+                                (label, h)
+                                for (f, label), h in self._histograms.items()
+                                if f == family
+                        )
+                        if rows:
+                                lines.append(f"__**{family.title()}s**__")
+                        for label, h in rows:
+                                mean = h.sum / h.count * 1000
+                                p95 = h.quantile(0.95) * 1000
+                                lines.append(
+                                        f"`{label}` n={h.count}"
+                                        f" mean {mean:.1f} ms,"
+                                        f" p95 ≤ {p95:.0f} ms"
+                                )
+                if self._caches:
+                        lines.append("__**Caches**__")
+                for name, cache in self._caches.items():
+                        total = cache.hits + cache.misses
+                        rate = cache.hits / total if total else 0.0
+                        lines.append(
+                                f"`{name}` {rate:.0%} hits"
+                                f" ({cache.hits}/{total})"
+                        )
+                return "\n".join(lines) or "No metrics recorded yet."
+
+        def prometheus_text(self) -> str:
+                """Return every metric in the Prometheus text format."""
+                lines = []
+                for family, (name, label_name, doc) in _FAMILIES.items():
+                        lines.append(f"# HELP {name} {doc}")
+                        lines.append(f"# TYPE {name} histogram")
+                        for (f, label), h in sorted(self._histograms.items()):
+                                if f != family:
+                                        continue
+                                tag = f'{label_name}="{label}"'
+                                cumulative = 0
+                                for bound, n in zip(
+                                        h.buckets, h.counts, strict=False
+                                ):
+                                        cumulative += n
+                                        lines.append(
+                                                f"{name}_bucket"
+                                                f'{{{tag},le="{bound}"}}'
+                                                f" {cumulative}"
+                                        )
+                                lines.append(
+                                        f'{name}_bucket{{{tag},le="+Inf"}}'
+                                        f" {h.count}"
+                                )
+                                lines.append(f"{name}_sum{{{tag}}} {h.sum}")
+                                lines.append(f"{name}_count{{{tag}}} {h.count}")
+                for kind in ("hits", "misses"):
+                        name = f"doge_alignment_cache_{kind}_total"
+                        lines.append(f"# HELP {name} Cache {kind}.")
+                        lines.append(f"# TYPE {name} counter")
+                        for cache_name, cache in self._caches.items():
+                                lines.append(
+                                        f'{name}{{cache="{cache_name}"}}'
+                                        f" {getattr(cache, kind)}"
+                                )
+                return "\n".join(lines) + "\n"
+
+        def write_prometheus(self, path: Path, text: str | None = None) -> None:
+                """Atomically write ``prometheus_text`` to ``path``.
+
+                Suits node_exporter's textfile collector. Metrics are not
+                locked, so to write from another thread, take ``text``
+                where they are recorded and pass it in.
+                """
+                if text is None:
+                        text = self.prometheus_text()
+                save_file_buffer(path, BytesIO(text.encode()))
@@ -0,0 +1,263 @@
+from __future__ import annotations  # noqa: D100
+
+from functools import lru_cache
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+from doge_cogs.alignment import (
+        ChartStyle,
+        blank_chart,
+        encode_chart,
+        layout_chart,
+)
+from doge_cogs.tiles import Tile, TileCache, TileKey, source_hash
+
+if TYPE_CHECKING:
+        from collections.abc import Mapping, Sequence
+
+        from doge_cogs.alignment import AlignmentChart, BorderShape
+
+RGBA = tuple[int, int, int, int]
+
+
+@lru_cache(maxsize=32)
+def color_rgba(color: str) -> RGBA:
+        """Return a color as 8-bit RGBA."""
+        from wand.color import Color
+
+        parsed = Color(color)
+        return (
+                parsed.red_int8,
+                parsed.green_int8,
+                parsed.blue_int8,
+                parsed.alpha_int8,
+        )
+
+
+@lru_cache(maxsize=64)
+def shape_alpha(size: int, shape: BorderShape) -> np.ndarray | None:
+        """Return the antialiased coverage of a shape, built once per size.
+
+        The result is a read-only ``(size, size)`` float32 array, or
+        ``None`` for squares, which need no mask.
+        """
+        if shape not in ("circle", "rounded"):
+                return None
+        centers = np.arange(size, dtype=np.float32) + 0.5
+        half = size / 2
+        if shape == "circle":
+                offsets = centers - half
+                dist = np.hypot(offsets[:, None], offsets[None, :]) - half
+        else:
+                # Same corner radius as shape_mask
+                radius = size // 8
+                outside = np.abs(centers - half) - (half - radius)
+                outside = np.maximum(outside, 0)
+                dist = np.hypot(outside[:, None], outside[None, :]) - radius
+        alpha = np.clip(0.5 - dist, 0, 1).astype(np.float32)
+        alpha.flags.writeable = False
+        return alpha
+
+
+def style_tiles(
+        pixels: np.ndarray,
+        border: int,
+        border_color: RGBA,
+        shape: BorderShape,
+) -> np.ndarray:
+        """Mask and border a stack of same-size RGBA avatars in one go.
+
+        ``pixels`` has shape ``(n, size, size, 4)``; the result has shape
+        ``(n, size + 2 * border, size + 2 * border, 4)``.
+        """
+        alpha = shape_alpha(pixels.shape[1], shape)
+        if alpha is not None:
+                pixels = pixels.copy()
+                pixels[..., 3] = pixels[..., 3] * alpha + 0.5
+        if border <= 0:
+                return pixels
+        count, size = pixels.shape[:2]
+        tile = size + 2 * border
+        out = np.empty((count, tile, tile, 4), dtype=np.uint8)
+        out[:, :border] = border_color
+        out[:, -border:] = border_color
+        out[:, :, :border] = border_color
+        out[:, :, -border:] = border_color
+        out[:, border:-border, border:-border] = pixels
+        return out
+
+
+def blit_grid(
+        canvas: np.ndarray,
+        tiles: np.ndarray,
+        left: int,
+        top: int,
+        cols: int,
+        gap: int,
+) -> None:
+        """Composite a row-major grid of tiles onto an opaque canvas.
+
+        The whole grid is assembled into one array and blended with a
+        single vectorized "over" operation.
+        """
+        count, tile = tiles.shape[:2]
+        rows = -(-count // cols)
+        pitch = tile + gap
+        grid = np.zeros((rows * cols, pitch, pitch, 4), dtype=np.uint8)
+        grid[:count, :tile, :tile] = tiles
+        grid = (
+                grid.reshape(rows, cols, pitch, pitch, 4)
+                .transpose(0, 2, 1, 3, 4)
+                .reshape(rows * pitch, cols * pitch, 4)
+        )[: rows * pitch - gap, : cols * pitch - gap]
+        height, width = grid.shape[:2]
+        region = canvas[top : top + height, left : left + width, :3]
+        alpha = grid[..., 3:].astype(np.uint16)
+        region[...] = (
+                grid[..., :3] * alpha + region * (255 - alpha) + 127
+        ) // 255
+
+
+@lru_cache(maxsize=4)
+def blank_pixels(style: ChartStyle) -> np.ndarray:
+        """Return the empty chart as a read-only RGBA array."""
+        with blank_chart(style) as canvas:
+                canvas.depth = 8
+                pixels = np.frombuffer(canvas.make_blob("RGBA"), np.uint8)
+                return pixels.reshape(canvas.height, canvas.width, 4)
+
+
+def decode_avatar(
+        data: bytes | None,
+        size: int,
+        style: ChartStyle,
+) -> np.ndarray:
+        """Decode and resize one avatar to RGBA, or return a placeholder."""
+        from wand.exceptions import WandException
+        from wand.image import Image
+
+        if data:
+                try:
+                        with Image(blob=data) as img:
+                                img.resize(size, size)
+                                img.depth = 8
+                                rgba = img.make_blob("RGBA")
+                except WandException:
+                        pass
+                else:
+                        return np.frombuffer(rgba, np.uint8).reshape(
+                                size, size, 4
+                        )
+        return np.full(
+                (size, size, 4), color_rgba(style.placeholder_color), np.uint8
+        )
+
+
+def avatar_tiles(
+        images: Sequence[bytes | None],
+        tile: int,
+        style: ChartStyle,
+        tiles: TileCache | None = None,
+) -> np.ndarray:
+        """Return the styled tiles of several avatars as one stack.
+
+        Each distinct image is decoded once. Every tile not found in
+        ``tiles`` is masked and bordered together with the others.
+        """
+        border = style.border if tile > 4 * style.border else 0
+        inner = tile - 2 * border
+        sources = [
+                source_hash(data)
+                if data
+                else f"placeholder:{style.placeholder_color}"
+                for data in images
+        ]
+        styled: dict[str, np.ndarray] = {}
+        missing: dict[str, bytes | None] = {}
+        for source, data in zip(sources, images, strict=True):
+                if source in styled or source in missing:
+                        continue
+                cached = None
+                key = _tile_key(source, inner, border, style)
+                if tiles is not None:
+                        cached = tiles.get(key)
+                if cached is None:
+                        missing[source] = data
+                else:
+                        styled[source] = np.frombuffer(
+                                cached.rgba, np.uint8
+                        ).reshape(tile, tile, 4)
+        if missing:
+                fresh = style_tiles(
+                        np.stack(
+                                [
+                                        decode_avatar(data, inner, style)
+                                        for data in missing.values()
+                                ]
+                        ),
+                        border,
+                        color_rgba(style.border_color),
+                        style.shape,
+                )
+                for source, pixels in zip(missing, fresh, strict=True):
+                        styled[source] = pixels
+                        if tiles is not None:
+                                tiles.put(
+                                        _tile_key(source, inner, border, style),
+                                        Tile(tile, tile, pixels.tobytes()),
+                                )
+        return np.stack([styled[source] for source in sources])
+
+
+def _tile_key(
+        source: str,
+        inner: int,
+        border: int,
+        style: ChartStyle,
+) -> TileKey:
+        return TileKey(
+                source,
+                inner,
+                border,
+                style.border_color,
+                style.shape,
+                "numpy",
+        )
+
+
+def render_chart_numpy(
+        chart: AlignmentChart,
+        avatars: Mapping[str, bytes | None],
+        style: ChartStyle = ChartStyle(),  # noqa: B008
+        tiles: TileCache | None = None,
+) -> bytes:
+        """Render the alignment chart with NumPy compositing.
+
+        Produces the same layout as ``render_alignment_chart``. ImageMagick
+        is only used to decode and resize avatars, and to encode the
+        result. Masks, borders and blending run on whole cells at a time.
+        """
+        from wand.image import Image
+
+        canvas = blank_pixels(style).copy()
+        for layout in layout_chart(chart, style).values():
+                if layout.tile <= 0:
+                        continue
+                stack = avatar_tiles(
+                        [avatars.get(uid) for uid, _, _ in layout.slots],
+                        layout.tile,
+                        style,
+                        tiles,
+                )
+                _, left, top = layout.slots[0]
+                cols = sum(1 for _, _, y in layout.slots if y == top)
+                blit_grid(canvas, stack, left, top, cols, style.gap)
+        with Image(
+                blob=canvas.tobytes(),
+                format="rgba",
+                width=canvas.shape[1],
+                height=canvas.shape[0],
+                depth=8,
+        ) as image:
+                return encode_chart(image, style)
@@ -0,0 +1,101 @@
+from __future__ import annotations  # noqa: D100
+
+from collections import OrderedDict
+from itertools import chain, islice
+from typing import TYPE_CHECKING
+
+from doge_cogs.alignment import ALIGNMENT_GRID
+
+if TYPE_CHECKING:
+        from doge_cogs.alignment import AlignmentChart, AlignmentIndex
+
+# 25 lines of at most ~40 characters, well under Discord's 2000 limit
+DEFAULT_PAGE_SIZE = 25
+DEFAULT_MAX_PAGINATIONS = 16
+
+
+class ChartPages:
+        """A chart's users as text pages, grouped by alignment.
+
+        Pages are read straight from the chart's ``AlignmentIndex``, so
+        nothing is grouped or copied when a chart version is first
+        shown. A page skips to its start within one alignment and only
+        formats its own ``page_size`` users. The index is live, so the
+        pages are only valid for the chart version they were made for.
+        """
+
+        def __init__(
+                self,
+                chart: AlignmentChart,
+                index: AlignmentIndex,
+                page_size: int = DEFAULT_PAGE_SIZE,
+        ) -> None:
+                self.chart = chart
+                self.index = index
+                self.page_size = page_size
+
+        def __len__(self) -> int:
+                return max(1, -(-len(self.chart["users"]) // self.page_size))
+
+        def page(self, number: int) -> str:
+                """Format one page, numbered from 0."""
+                skip = number * self.page_size
+                left = self.page_size
+                lines = []
+                for name in chain.from_iterable(ALIGNMENT_GRID):
+                        count = self.index.count(name)
+                        if skip >= count:
+                                skip -= count
+                                continue
+                        lines.append(f"__**{name}**__")
+                        for user_id in islice(
+                                self.index.users(name), skip, skip + left
+                        ):
+                                entry = self.chart["users"][user_id]
+                                lines.append(f"• {entry['display_name']}")
+                        left -= min(count - skip, left)
+                        skip = 0
+                        if not left:
+                                break
+                lines.append(f"-# Page {number + 1}/{len(self)}")
+                return "\n".join(lines)
+
+
+class PagesCache:
+        """The ``ChartPages`` of recently shown chart versions.
+
+        Everyone paging through the same chart version shares one
+        ``ChartPages``. Open paginators hold its ``(guild, version)``
+        key, not the pages, so evicted pages are freed right away.
+        """
+
+        def __init__(
+                self,
+                *,
+                max_charts: int = DEFAULT_MAX_PAGINATIONS,
+        ) -> None:
+                self.max_charts = max_charts
+                self._pages: OrderedDict[tuple[int, int], ChartPages] = (
+                        OrderedDict()
+                )
+
+        def get(
+                self,
+                guild_id: int,
+                version: int,
+                chart: AlignmentChart,
+                index: AlignmentIndex,
+        ) -> ChartPages:
+                """Return the pages of a guild's chart at ``version``.
+
+                ``chart`` and ``index`` must be that version's.
+                """
+                key = (guild_id, version)
+                pages = self._pages.get(key)
+                if pages is None:
+                        pages = self._pages[key] = ChartPages(chart, index)
+                        while len(self._pages) > self.max_charts:
+                                self._pages.popitem(last=False)
+                else:
+                        self._pages.move_to_end(key)
+                return pages
@@ -0,0 +1,150 @@
+from __future__ import annotations  # noqa: D100
+
+import sys
+from collections.abc import Iterator, Mapping
+from enum import IntEnum
+from typing import Literal, get_args
+
+# Define all possible alignments (classic 3x3 chart)
+AlignmentName = Literal[
+        "Lawful Good",
+        "Neutral Good",
+        "Chaotic Good",
+        "Lawful Neutral",
+        "True Neutral",
+        "Chaotic Neutral",
+        "Lawful Evil",
+        "Neutral Evil",
+        "Chaotic Evil",
+]
+
+# Labels in Alignment order, as written in chart files
+ALIGNMENT_LABELS: tuple[AlignmentName, ...] = get_args(AlignmentName)
+
+# Shared by most avatar URLs, so each record only keeps the remainder
+AVATAR_URL_PREFIXES = tuple(
+        sys.intern(prefix)
+        for prefix in (
+                "https://cdn.discordapp.com/avatars/",
+                "https://cdn.discordapp.com/embed/avatars/",
+                "https://cdn.discordapp.com/guilds/",
+                "https://media.discordapp.net/",
+        )
+)
+
+USER_FIELDS = ("alignment", "display_name", "avatar_url")
+
+
+class Alignment(IntEnum):
+        """Alignments as small integers."""
+
+        LAWFUL_GOOD = 0
+        NEUTRAL_GOOD = 1
+        CHAOTIC_GOOD = 2
+        LAWFUL_NEUTRAL = 3
+        TRUE_NEUTRAL = 4
+        CHAOTIC_NEUTRAL = 5
+        LAWFUL_EVIL = 6
+        NEUTRAL_EVIL = 7
+        CHAOTIC_EVIL = 8
+
+        @property
+        def label(self) -> str:
+                """Return the name used in chart files."""
+                return ALIGNMENT_LABELS[self]
+
+
+_BY_LABEL = {label: Alignment(i) for i, label in enumerate(ALIGNMENT_LABELS)}
+
+
+def _split_url(url: str) -> tuple[str, str]:
+        for prefix in AVATAR_URL_PREFIXES:
+                if url.startswith(prefix):
+                        return prefix, url[len(prefix) :]
+        return "", url
+
+
+class UserRecord(Mapping[str, object]):
+        """A read-only chart user entry in four slots.
+
+        Reads like a ``UserAlignment`` dict, and compares equal to one,
+        but stores the alignment as an ``Alignment``, an interned display
+        name and the avatar URL split after a shared, interned prefix.
+        """
+
+        __slots__ = ("_alignment", "_display_name", "_url_prefix", "_url_rest")
+
+        def __init__(
+                self,
+                alignment: Alignment,
+                display_name: str,
+                avatar_url: str | None,
+        ) -> None:
+                self._alignment = alignment
+                self._display_name = sys.intern(display_name)
+                if avatar_url is None:
+                        self._url_prefix = self._url_rest = None
+                else:
+                        self._url_prefix, self._url_rest = _split_url(
+                                avatar_url
+                        )
+
+        @property
+        def alignment(self) -> Alignment:
+                """The user's alignment."""
+                return self._alignment
+
+        @property
+        def avatar_url(self) -> str | None:
+                """The full avatar URL, if any."""
+                if self._url_rest is None:
+                        return None
+                return self._url_prefix + self._url_rest
+
+        def __getitem__(self, key: str) -> object:
+                match key:
+                        case "alignment":
+                                return ALIGNMENT_LABELS[self._alignment]
+                        case "display_name":
+                                return self._display_name
+                        case "avatar_url":
+                                return self.avatar_url
+                raise KeyError(key)
+
+        def __iter__(self) -> Iterator[str]:
+                return iter(USER_FIELDS)
+
+        def __len__(self) -> int:
+                return len(USER_FIELDS)
+
+        def __repr__(self) -> str:
+                return f"UserRecord({dict(self.items())!r})"
+
+        def __reduce__(self) -> tuple:
+                return (
+                        type(self),
+                        (self._alignment, self._display_name, self.avatar_url),
+                )
+
+
+def compact_user(entry: Mapping[str, object]) -> Mapping[str, object]:
+        """Return ``entry`` as a ``UserRecord`` when that is lossless.
+
+        Entries with unknown alignments, extra keys or unexpected value
+        types are returned unchanged, so converting back always gives
+        the original entry.
+        """
+        if type(entry) is UserRecord:
+                return entry
+        label = entry.get("alignment")
+        alignment = _BY_LABEL.get(label) if type(label) is str else None
+        display_name = entry.get("display_name")
+        avatar_url = entry.get("avatar_url", ...)
+        if (
+                alignment is None
+                or len(entry) != len(USER_FIELDS)
+                or type(display_name) is not str
+                or not (avatar_url is None or type(avatar_url) is str)
+        ):
+                return entry
+        return UserRecord(alignment, display_name, avatar_url)
@@ -0,0 +1,110 @@
+from __future__ import annotations  # noqa: D100
+
+import asyncio
+import contextlib
+import logging
+from typing import TYPE_CHECKING, NamedTuple
+
+if TYPE_CHECKING:
+        from collections.abc import Awaitable, Callable
+
+log = logging.getLogger(__name__)
+
+DEFAULT_REFRESH_DELAY = 30.0
+DEFAULT_MAX_PENDING = 10_000
+
+
+class Profile(NamedTuple):
+        """What a chart shows of a user besides their alignment."""
+
+        display_name: str
+        avatar_url: str | None
+
+
+class ProfileRefresher:
+        """Coalesce profile changes into one batch per guild.
+
+        The first change noted for a guild opens a ``delay`` second
+        window; when it closes, the latest profile of every user noted
+        meanwhile is handed to ``apply`` in one call. A user noted ten
+        times in a window costs one entry.
+
+        At most ``max_pending`` users are held across all guilds. When
+        the limit is hit every guild is flushed at once, and users noted
+        before those flushes free room are dropped and counted in ``dropped``.
+        """
+
+        def __init__(
+                self,
+                apply: Callable[[int, dict[str, Profile]], Awaitable[None]],
+                *,
+                delay: float = DEFAULT_REFRESH_DELAY,
+                max_pending: int = DEFAULT_MAX_PENDING,
+        ) -> None:
+                self._apply = apply
+                self.delay = delay
+                self.max_pending = max_pending
+                self.dropped = 0
+                self._pending: dict[int, dict[str, Profile]] = {}
+                self._size = 0
+                self._timers: dict[int, asyncio.TimerHandle] = {}
+                self._tasks: set[asyncio.Task] = set()
+
+        def __len__(self) -> int:
+                return self._size
+
+        def note(self, guild_id: int, user_id: str, profile: Profile) -> None:
+                """Queue a user's new profile for the guild's next batch."""
+                users = self._pending.get(guild_id)
+                if users is None or user_id not in users:
+                        if self._size >= self.max_pending:
+                                self.dropped += 1
+                                return
+                        if users is None:
+                                users = self._pending[guild_id] = {}
+                        self._size += 1
+                users[user_id] = profile
+                if self._size >= self.max_pending:
+                        for pending_id in list(self._pending):
+                                self._schedule(pending_id, 0)
+                elif guild_id not in self._timers:
+                        self._schedule(guild_id, self.delay)
+
+        def _schedule(self, guild_id: int, delay: float) -> None:
+                timer = self._timers.pop(guild_id, None)
+                if timer is not None:
+                        timer.cancel()
+                self._timers[guild_id] = asyncio.get_running_loop().call_later(
+                        delay, self._start_flush, guild_id
+                )
+
+        def _start_flush(self, guild_id: int) -> None:
+                task = asyncio.create_task(self.flush(guild_id))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+        async def flush(self, guild_id: int) -> None:
+                """Apply a guild's queued profiles now."""
+                timer = self._timers.pop(guild_id, None)
+                if timer is not None:
+                        timer.cancel()
+                users = self._pending.pop(guild_id, None)
+                if not users:
+                        return
+                self._size -= len(users)
+                try:
+                        await self._apply(guild_id, users)
+                except Exception:
+                        log.exception(
+                                "Refreshing %d profiles in guild %s failed",
+                                len(users),
+                                guild_id,
+                        )
+
+        async def close(self) -> None:
+                """Flush every guild and wait for running flushes."""
+                for guild_id in list(self._pending):
+                        await self.flush(guild_id)
+                for task in list(self._tasks):
+                        with contextlib.suppress(asyncio.CancelledError):
+                                await task
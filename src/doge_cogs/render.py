@@ -0,0 +1,546 @@
+from __future__ import annotations  # noqa: D100
+
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING, NamedTuple
+
+from doge_cogs.alignment import (
+        ChartStyle,
+        blank_chart,
+        cell_rects,
+        composite_cell,
+        dirty_cells_for_op,
+        encode_chart,
+        layout_chart,
+)
+from doge_cogs.tiles import DEFAULT_TILE_BYTES, TileCache
+
+if TYPE_CHECKING:
+        from collections.abc import (
+                Awaitable,
+                Callable,
+                Hashable,
+                Mapping,
+                Sequence,
+        )
+        from pathlib import Path
+
+        from wand.image import Image
+
+        from doge_cogs.alignment import (
+                AlignmentChart,
+                AlignmentName,
+                AlignmentOp,
+                CellLayout,
+                Rect,
+        )
+
+DEFAULT_MAX_CANVASES = 8
+DEFAULT_RENDER_WORKERS = min(4, os.cpu_count() or 1)
+DEFAULT_RESULT_TTL = 10.0
+DEFAULT_MAX_RESULTS = 32
+
+
+def ops_dirty_cells(
+        chart: AlignmentChart,
+        ops: Sequence[AlignmentOp],
+) -> set[AlignmentName]:
+        """Return the cells ``ops`` change, given the chart before them."""
+        # Judging every op against the chart before the batch can
+        # over-mark, but never misses a cell
+        return set().union(*(dirty_cells_for_op(chart, op) for op in ops))
+
+
+def cell_signature(
+        chart: AlignmentChart,
+        layout: CellLayout,
+        avatars: Mapping[str, bytes | None],
+) -> Hashable:
+        """Return everything that decides how a cell is drawn."""
+        return (
+                layout.tile,
+                tuple(
+                        (
+                                user_id,
+                                left,
+                                top,
+                                chart["users"][user_id]["avatar_url"],
+                                avatars.get(user_id) is None,
+                        )
+                        for user_id, left, top in layout.slots
+                ),
+        )
+
+
+class _GuildCanvas:
+        __slots__ = ("dirty", "dropped", "image", "lock", "signatures")
+
+        def __init__(self) -> None:
+                self.image: Image | None = None
+                self.signatures: dict[AlignmentName, Hashable] = {}
+                self.dirty: set[AlignmentName] = set()
+                self.lock = threading.Lock()
+                # No longer kept, so whoever draws on it last closes it
+                self.dropped = False
+
+        def close(self) -> None:
+                """Free the canvas; the caller must hold ``lock``."""
+                if self.image is not None:
+                        self.image.close()
+                        self.image = None
+
+
+class ChartRenderer:
+        """Re-render guild charts by redrawing only the cells that changed.
+
+        The last rendered canvas of up to ``max_guilds`` guilds is kept.
+        ``note_ops`` marks the cells operations touch as dirty; on the
+        next ``render`` only those cells, plus any whose contents no
+        longer match what was drawn, are restored from the blank chart
+        and recomposited. The result is identical to a full render.
+
+        Styles using the ``numpy`` engine are always rendered in full;
+        it composites whole cells at once, so there is little to save.
+
+        ``render`` may be called from worker threads.
+        """
+
+        def __init__(
+                self,
+                style: ChartStyle = ChartStyle(),  # noqa: B008
+                *,
+                tiles: TileCache | None = None,
+                max_guilds: int = DEFAULT_MAX_CANVASES,
+        ) -> None:
+                self.style = style
+                self.tiles = tiles
+                self.max_guilds = max_guilds
+                self._blank: Image | None = None
+                self._canvases: OrderedDict[int, _GuildCanvas] = OrderedDict()
+                self._lock = threading.Lock()
+
+        def note_ops(
+                self,
+                guild_id: int,
+                chart: AlignmentChart,
+                ops: Sequence[AlignmentOp],
+        ) -> None:
+                """Mark the cells ``ops`` change, given the prior chart."""
+                self.mark_dirty(guild_id, ops_dirty_cells(chart, ops))
+
+        def mark_dirty(
+                self,
+                guild_id: int,
+                cells: set[AlignmentName],
+        ) -> None:
+                """Redraw ``cells`` on the next render of a kept canvas."""
+                with self._lock:
+                        state = self._canvases.get(guild_id)
+                        if state is not None:
+                                state.dirty |= cells
+
+        def invalidate(self, guild_id: int) -> None:
+                """Forget a guild's canvas, forcing a full render next time."""
+                with self._lock:
+                        state = self._canvases.pop(guild_id, None)
+                if state is not None:
+                        self._drop([state])
+
+        @staticmethod
+        def _drop(states: list[_GuildCanvas]) -> None:
+                # Taken without self._lock, which render takes under these
+                for state in states:
+                        # A render in another thread may still be drawing
+                        with state.lock:
+                                state.dropped = True
+                                state.close()
+
+        def _state(self, guild_id: int) -> _GuildCanvas:
+                evicted = []
+                with self._lock:
+                        if self._blank is None:
+                                self._blank = blank_chart(self.style)
+                        state = self._canvases.get(guild_id)
+                        if state is None:
+                                state = _GuildCanvas()
+                                self._canvases[guild_id] = state
+                        self._canvases.move_to_end(guild_id)
+                        while len(self._canvases) > self.max_guilds:
+                                evicted.append(
+                                        self._canvases.popitem(last=False)[1]
+                                )
+                self._drop(evicted)
+                return state
+
+        def render(
+                self,
+                guild_id: int,
+                chart: AlignmentChart,
+                avatars: Mapping[str, bytes | None],
+        ) -> bytes:
+                """Render a guild's chart, reusing its previous canvas."""
+                if self.style.engine == "numpy":
+                        try:
+                                from doge_cogs.numpy_render import (
+                                        render_chart_numpy,
+                                )
+                        except ImportError as e:
+                                msg = "numpy is required for the numpy engine"
+                                raise RuntimeError(msg) from e
+                        return render_chart_numpy(
+                                chart, avatars, self.style, self.tiles
+                        )
+                layouts = layout_chart(chart, self.style)
+                signatures = {
+                        name: cell_signature(chart, layout, avatars)
+                        for name, layout in layouts.items()
+                }
+                state = self._state(guild_id)
+                with state.lock:
+                        with self._lock:
+                                dirty, state.dirty = state.dirty, set()
+                        if state.image is None:
+                                state.image = self._blank.clone()
+                                state.signatures = {}
+                        dirty |= {
+                                name
+                                for name, signature in signatures.items()
+                                if state.signatures.get(name) != signature
+                        }
+                        rects = cell_rects(self.style)
+                        try:
+                                for name in dirty:
+                                        self._redraw_cell(
+                                                state.image,
+                                                rects[name],
+                                                layouts[name],
+                                                avatars,
+                                        )
+                        except BaseException:
+                                # Half drawn, start from scratch next time
+                                state.close()
+                                raise
+                        state.signatures = signatures
+                        try:
+                                with state.image.clone() as out:
+                                        return encode_chart(out, self.style)
+                        finally:
+                                if state.dropped:
+                                        # Evicted while we waited for it
+                                        state.close()
+
+        def _redraw_cell(
+                self,
+                canvas: Image,
+                rect: Rect,
+                layout: CellLayout,
+                avatars: Mapping[str, bytes | None],
+        ) -> None:
+                # Restore the blank cell plus half the margin around it, so
+                # antialiased edges are covered without touching neighbours
+                pad = self.style.margin // 2
+                left, top = rect[0] - pad, rect[1] - pad
+                right = left + rect[2] + 2 * pad
+                bottom = top + rect[3] + 2 * pad
+                with self._blank[left:right, top:bottom] as patch:
+                        canvas.composite(
+                                patch, left=left, top=top, operator="copy"
+                        )
+                composite_cell(canvas, layout, avatars, self.style, self.tiles)
+
+
+class TileSettings(NamedTuple):
+        """How a worker process sets up its tile cache."""
+
+        max_bytes: int = DEFAULT_TILE_BYTES
+        spill_dir: Path | None = None
+
+
+# Each worker process keeps its own renderers, canvases and tiles
+_worker_tiles: dict[TileSettings, TileCache] = {}
+_worker_renderers: dict[ChartStyle, ChartRenderer] = {}
+
+
+def _render_in_worker(
+        style: ChartStyle,
+        tile_settings: TileSettings,
+        guild_id: int,
+        chart: AlignmentChart,
+        avatars: Mapping[str, bytes | None],
+        dirty: set[AlignmentName],
+        dropped: Sequence[int],
+) -> tuple[bytes, int, int]:
+        tiles = _worker_tiles.get(tile_settings)
+        if tiles is None:
+                tiles = _worker_tiles[tile_settings] = TileCache(
+                        max_bytes=tile_settings.max_bytes,
+                        spill_dir=tile_settings.spill_dir,
+                )
+        renderer = _worker_renderers.get(style)
+        if renderer is None:
+                renderer = _worker_renderers[style] = ChartRenderer(
+                        style, tiles=tiles
+                )
+        for dropped_id in dropped:
+                renderer.invalidate(dropped_id)
+        renderer.mark_dirty(guild_id, dirty)
+        image = renderer.render(guild_id, chart, avatars)
+        return image, tiles.hits, tiles.misses
+
+
+class RenderPool:
+        """Render charts in a pool of worker processes.
+
+        ImageMagick work is CPU bound and largely holds the GIL, so in a
+        thread it still slows down the event loop. Here renders run in
+        ``max_workers`` processes and scale across cores. Only the chart,
+        the avatar bytes and the style are sent to a worker, and only the
+        encoded image comes back.
+
+        Every guild is rendered by the same worker, which keeps its
+        canvas, and the cells ``note_ops`` marks are sent along with the
+        guild's next render. Only the last ``DEFAULT_MAX_CANVASES``
+        guilds sent to each worker are tracked, and the worker drops the
+        canvases of guilds that fall out. Each worker has its own tile
+        cache, with its share of ``tiles.max_bytes``, and spills to
+        ``tiles.spill_dir``, which all workers share. The price is that a
+        busy guild's renders queue on one worker even while others are
+        idle.
+
+        With ``max_workers=0`` charts are rendered in a thread instead,
+        straight into ``tiles``. That avoids copying charts and avatars
+        between processes, but renders then slow the event loop down.
+        """
+
+        def __init__(
+                self,
+                style: ChartStyle = ChartStyle(),  # noqa: B008
+                *,
+                max_workers: int = DEFAULT_RENDER_WORKERS,
+                tiles: TileCache | None = None,
+        ) -> None:
+                self.style = style
+                self._renderer: ChartRenderer | None = None
+                # One single-process pool per worker, so a guild always
+                # lands on the worker holding its canvas
+                self._executors: list[ProcessPoolExecutor] = []
+                # Guilds whose canvas each worker may hold, least recently
+                # sent first, with the cells changed since they were sent
+                self._resident: list[OrderedDict[int, set[AlignmentName]]] = []
+                # Guilds each worker should drop on its next render
+                self._evicted: list[list[int]] = []
+                # The latest tile hits and misses reported by each worker
+                self._tile_counts: list[tuple[int, int]] = []
+                if max_workers > 0:
+                        self._tile_settings = (
+                                TileSettings()
+                                if tiles is None
+                                else TileSettings(
+                                        tiles.max_bytes // max_workers,
+                                        tiles.spill_dir,
+                                )
+                        )
+                        # Forking a process that runs threads is unsafe
+                        context = multiprocessing.get_context("spawn")
+                        self._executors = [
+                                ProcessPoolExecutor(
+                                        max_workers=1, mp_context=context
+                                )
+                                for _ in range(max_workers)
+                        ]
+                        self._tile_counts = [(0, 0)] * max_workers
+                        self._resident = [
+                                OrderedDict() for _ in range(max_workers)
+                        ]
+                        self._evicted = [[] for _ in range(max_workers)]
+                else:
+                        self._renderer = ChartRenderer(style, tiles=tiles)
+
+        @property
+        def hits(self) -> int:
+                """Tile cache hits, across every worker."""
+                if self._renderer is not None:
+                        tiles = self._renderer.tiles
+                        return 0 if tiles is None else tiles.hits
+                return sum(hits for hits, _ in self._tile_counts)
+
+        @property
+        def misses(self) -> int:
+                """Tile cache misses, across every worker."""
+                if self._renderer is not None:
+                        tiles = self._renderer.tiles
+                        return 0 if tiles is None else tiles.misses
+                return sum(misses for _, misses in self._tile_counts)
+
+        def note_ops(
+                self,
+                guild_id: int,
+                chart: AlignmentChart,
+                ops: Sequence[AlignmentOp],
+        ) -> None:
+                """Mark the cells ``ops`` change for the guild's renderer."""
+                if self._renderer is not None:
+                        self._renderer.note_ops(guild_id, chart, ops)
+                        return
+                resident = self._resident[guild_id % len(self._executors)]
+                # A guild with no canvas in its worker is drawn in full
+                dirty = resident.get(guild_id)
+                if dirty is not None:
+                        dirty |= ops_dirty_cells(chart, ops)
+
+        async def render(
+                self,
+                guild_id: int,
+                chart: AlignmentChart,
+                avatars: Mapping[str, bytes | None],
+        ) -> bytes:
+                """Render a guild's chart without blocking the event loop."""
+                if self._renderer is not None:
+                        return await asyncio.to_thread(
+                                self._renderer.render, guild_id, chart, avatars
+                        )
+                worker = guild_id % len(self._executors)
+                resident = self._resident[worker]
+                dirty = resident.pop(guild_id, set())
+                resident[guild_id] = set()
+                while len(resident) > DEFAULT_MAX_CANVASES:
+                        self._evicted[worker].append(
+                                resident.popitem(last=False)[0]
+                        )
+                dropped, self._evicted[worker] = self._evicted[worker], []
+                loop = asyncio.get_running_loop()
+                try:
+                        image, hits, misses = await loop.run_in_executor(
+                                self._executors[worker],
+                                _render_in_worker,
+                                self.style,
+                                self._tile_settings,
+                                guild_id,
+                                chart,
+                                dict(avatars),
+                                dirty,
+                                dropped,
+                        )
+                except BaseException:
+                        # The worker may not have seen them; keep them
+                        pending = resident.get(guild_id)
+                        if pending is not None:
+                                pending |= dirty
+                        self._evicted[worker].extend(dropped)
+                        raise
+                self._tile_counts[worker] = (hits, misses)
+                return image
+
+        def close(self) -> None:
+                """Stop the worker processes."""
+                for executor in self._executors:
+                        executor.shutdown(wait=False, cancel_futures=True)
+
+
+class RenderKey(NamedTuple):
+        guild_id: int
+        version: int  # ChartCache.version of the rendered chart
+        style: ChartStyle
+
+
+class RenderFlights:
+        """Share chart renders between concurrent requests.
+
+        Requests with the same ``RenderKey`` while a render is running
+        wait for that render instead of starting their own. The latest
+        result of each guild is then served for ``ttl`` seconds, as long
+        as the chart version does not change. Only the ``max_results``
+        most recently rendered guilds keep a result, and expired results
+        are dropped when next looked at. Requests that start a render
+        count as misses, all others as hits.
+        """
+
+        def __init__(
+                self,
+                *,
+                ttl: float = DEFAULT_RESULT_TTL,
+                max_results: int = DEFAULT_MAX_RESULTS,
+        ) -> None:
+                self.ttl = ttl
+                self.max_results = max_results
+                self.hits = 0
+                self.misses = 0
+                self._inflight: dict[RenderKey, asyncio.Future[bytes]] = {}
+                self._results: OrderedDict[
+                        int, tuple[RenderKey, float, bytes]
+                ] = OrderedDict()
+
+        def __len__(self) -> int:
+                return len(self._results)
+
+        def note_ops(
+                self,
+                guild_id: int,
+                chart: AlignmentChart,  # noqa: ARG002
+                ops: Sequence[AlignmentOp],  # noqa: ARG002
+        ) -> None:
+                """Drop a guild's cached result, its chart is changing."""
+                self.invalidate(guild_id)
+
+        def invalidate(self, guild_id: int) -> None:
+                """Drop a guild's cached result."""
+                self._results.pop(guild_id, None)
+
+        async def get(
+                self,
+                key: RenderKey,
+                render: Callable[[], Awaitable[bytes]],
+        ) -> bytes:
+                """Return the image for ``key``, rendering it if needed."""
+                cached = self._live_result(key.guild_id)
+                if cached is not None and cached[0] == key:
+                        self._results.move_to_end(key.guild_id)
+                        self.hits += 1
+                        return cached[2]
+                inflight = self._inflight.get(key)
+                if inflight is not None:
+                        self.hits += 1
+                else:
+                        self.misses += 1
+                        inflight = asyncio.ensure_future(render())
+                        self._inflight[key] = inflight
+                        inflight.add_done_callback(
+                                lambda done: self._finished(key, done)
+                        )
+                # One caller giving up must not cancel the shared render
+                return await asyncio.shield(inflight)
+
+        def _live_result(
+                self,
+                guild_id: int,
+        ) -> tuple[RenderKey, float, bytes] | None:
+                cached = self._results.get(guild_id)
+                if cached is None or time.monotonic() - cached[1] < self.ttl:
+                        return cached
+                del self._results[guild_id]
+                return None
+
+        def _finished(
+                self,
+                key: RenderKey,
+                done: asyncio.Future[bytes],
+        ) -> None:
+                del self._inflight[key]
+                if done.cancelled() or done.exception() is not None:
+                        return
+                cached = self._live_result(key.guild_id)
+                # Never replace the result of a newer chart version
+                if cached is None or cached[0].version <= key.version:
+                        self._results[key.guild_id] = (
+                                key,
+                                time.monotonic(),
+                                done.result(),
+                        )
+                        self._results.move_to_end(key.guild_id)
+                        while len(self._results) > self.max_results:
+                                self._results.popitem(last=False)
@@ -0,0 +1,272 @@
+from __future__ import annotations  # noqa: D100
+
+import sqlite3
+import sys
+import threading
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from doge_cogs.storage import read_chart_files, stored_guild_ids
+
+if TYPE_CHECKING:
+        from collections.abc import Iterable, Sequence
+
+        from doge_cogs.alignment import (
+                AlignmentChart,
+                AlignmentName,
+                AlignmentOp,
+                UserAlignment,
+        )
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+        guild_id INTEGER NOT NULL,
+        user_id TEXT NOT NULL,
+        alignment TEXT NOT NULL,
+        display_name TEXT NOT NULL,
+        avatar_url TEXT,
+        PRIMARY KEY (guild_id, user_id)
+);
+CREATE INDEX IF NOT EXISTS users_by_alignment
+        ON users (guild_id, alignment);
+CREATE TABLE IF NOT EXISTS admins (
+        guild_id INTEGER NOT NULL,
+        user_id TEXT NOT NULL,
+        PRIMARY KEY (guild_id, user_id)
+);
+"""
+
+# Upserts keep the rowid, so rows come back in chart (dict) order
+UPSERT_USER = """
+INSERT INTO users (guild_id, user_id, alignment, display_name, avatar_url)
+VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (guild_id, user_id) DO UPDATE SET
+        alignment = excluded.alignment,
+        display_name = excluded.display_name,
+        avatar_url = excluded.avatar_url
+"""
+
+
+def _user_row(row: tuple) -> UserAlignment:
+        return {
+                "alignment": row[0],
+                "display_name": row[1],
+                "avatar_url": row[2],
+        }
+
+
+class SqliteBackend:
+        """All guild charts in one SQLite database.
+
+        The database runs in WAL mode so lookups from the I/O pool never
+        wait on a writer. Users are indexed by (guild_id, user_id) and
+        (guild_id, alignment), so point lookups and per-alignment queries
+        read only the rows they need.
+        """
+
+        def __init__(self, path: Path) -> None:
+                self.path = path
+                self._local = threading.local()
+                self._connections: list[sqlite3.Connection] = []
+                self._connections_lock = threading.Lock()
+                with self._connection() as conn:
+                        conn.executescript(SCHEMA)
+
+        def _connection(self) -> sqlite3.Connection:
+                # One connection per pool thread
+                conn = getattr(self._local, "conn", None)
+                if conn is None:
+                        conn = sqlite3.connect(
+                                self.path, check_same_thread=False
+                        )
+                        conn.execute("PRAGMA journal_mode=WAL")
+                        conn.execute("PRAGMA synchronous=NORMAL")
+                        self._local.conn = conn
+                        with self._connections_lock:
+                                self._connections.append(conn)
+                return conn
+
+        def load(self, guild_id: int) -> AlignmentChart:
+                """Return a guild's full chart."""
+                conn = self._connection()
+                users = {
+                        row[0]: _user_row(row[1:])
+                        for row in conn.execute(
+                                "SELECT user_id, alignment, display_name,"
+                                " avatar_url FROM users WHERE guild_id = ?"
+                                " ORDER BY rowid",
+                                (guild_id,),
+                        )
+                }
+                admins = [
+                        row[0]
+                        for row in conn.execute(
+                                "SELECT user_id FROM admins WHERE guild_id = ?"
+                                " ORDER BY rowid",
+                                (guild_id,),
+                        )
+                ]
+                return {"users": users, "admins": admins}
+
+        def save(
+                self,
+                guild_id: int,
+                chart: AlignmentChart,
+                ops: Sequence[AlignmentOp] | None = None,
+        ) -> None:
+                """Apply ``ops`` as row changes, or replace the whole guild."""
+                with self._connection() as conn:
+                        if ops is None:
+                                self._replace(conn, guild_id, chart)
+                        else:
+                                self._apply(conn, guild_id, ops)
+
+        def _replace(
+                self,
+                conn: sqlite3.Connection,
+                guild_id: int,
+                chart: AlignmentChart,
+        ) -> None:
+                conn.execute(
+                        "DELETE FROM users WHERE guild_id = ?", (guild_id,)
+                )
+                conn.execute(
+                        "DELETE FROM admins WHERE guild_id = ?", (guild_id,)
+                )
+                conn.executemany(
+                        UPSERT_USER,
+                        (
+                                (
+                                        guild_id,
+                                        uid,
+                                        entry["alignment"],
+                                        entry["display_name"],
+                                        entry["avatar_url"],
+                                )
+                                for uid, entry in chart["users"].items()
+                        ),
+                )
+                conn.executemany(
+                        "INSERT OR IGNORE INTO admins VALUES (?, ?)",
+                        ((guild_id, uid) for uid in chart["admins"]),
+                )
+
+        def _apply(
+                self,
+                conn: sqlite3.Connection,
+                guild_id: int,
+                ops: Iterable[AlignmentOp],
+        ) -> None:
+                for op in ops:
+                        match op["op"]:
+                                case "set":
+                                        conn.execute(
+                                                UPSERT_USER,
+                                                (
+                                                        guild_id,
+                                                        op["user_id"],
+                                                        op["alignment"],
+                                                        op["display_name"],
+                                                        op["avatar_url"],
+                                                ),
+                                        )
+                                case "remove":
+                                        conn.execute(
+                                                "DELETE FROM users"
+                                                " WHERE guild_id = ?"
+                                                " AND user_id = ?",
+                                                (guild_id, op["user_id"]),
+                                        )
+                                case "add_admin":
+                                        conn.execute(
+                                                "INSERT OR IGNORE INTO admins"
+                                                " VALUES (?, ?)",
+                                                (guild_id, op["user_id"]),
+                                        )
+                                case "remove_admin":
+                                        conn.execute(
+                                                "DELETE FROM admins"
+                                                " WHERE guild_id = ?"
+                                                " AND user_id = ?",
+                                                (guild_id, op["user_id"]),
+                                        )
+                                case _:
+                                        msg = (
+                                                "Unknown chart operation:"
+                                                f" {op['op']!r}"
+                                        )
+                                        raise ValueError(msg)
+
+        def get_user(self, guild_id: int, user_id: str) -> UserAlignment | None:
+                """Return one user's entry, if any."""
+                row = (
+                        self._connection()
+                        .execute(
+                                "SELECT alignment, display_name, avatar_url"
+                                " FROM users"
+                                " WHERE guild_id = ? AND user_id = ?",
+                                (guild_id, user_id),
+                        )
+                        .fetchone()
+                )
+                return None if row is None else _user_row(row)
+
+        def users_with_alignment(
+                self,
+                guild_id: int,
+                alignment: AlignmentName,
+        ) -> dict[str, UserAlignment]:
+                """Return the entries of every user with an alignment."""
+                return {
+                        row[0]: _user_row(row[1:])
+                        for row in self._connection().execute(
+                                "SELECT user_id, alignment, display_name,"
+                                " avatar_url FROM users"
+                                " WHERE guild_id = ? AND alignment = ?"
+                                " ORDER BY rowid",
+                                (guild_id, alignment),
+                        )
+                }
+
+        def guild_ids(self) -> list[int]:
+                """Return every guild with users or admins."""
+                return [
+                        row[0]
+                        for row in self._connection().execute(
+                                "SELECT guild_id FROM users"
+                                " UNION SELECT guild_id FROM admins"
+                                " ORDER BY guild_id"
+                        )
+                ]
+
+        def close(self) -> None:
+                """Close every pool thread's connection."""
+                with self._connections_lock:
+                        for conn in self._connections:
+                                conn.close()
+                        self._connections.clear()
+                self._local = threading.local()
+
+
+def migrate_yaml_to_sqlite(data_dir: Path, db_path: Path) -> int:
+        """Bulk-import every YAML chart in ``data_dir`` into SQLite.
+
+        Guilds already in the database are overwritten by their YAML chart.
+        The YAML files are only read. Returns the number of guilds imported.
+        """
+        target = SqliteBackend(db_path)
+        guild_ids = stored_guild_ids(data_dir)
+        try:
+                for guild_id in guild_ids:
+                        target.save(
+                                guild_id, read_chart_files(data_dir, guild_id)
+                        )
+        finally:
+                target.close()
+        return len(guild_ids)
+
+
+if __name__ == "__main__":
+        data_dir, db_path = (Path(arg) for arg in sys.argv[1:3])
+        count = migrate_yaml_to_sqlite(data_dir, db_path)
+        print(f"Imported {count} guild chart(s) into {db_path}")
@@ -0,0 +1,672 @@
+from __future__ import annotations  # noqa: D100
+
+import asyncio
+import os
+import shutil
+import threading
+import weakref
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from itertools import islice
+from typing import TYPE_CHECKING, Protocol, TypeVar
+
+import yaml
+
+from doge_cogs.alignment import (
+        AlignmentChart,
+        AlignmentName,
+        AlignmentOp,
+        ChartFormat,
+        UserAlignment,
+        append_file_buffer,
+        apply_alignment_ops,
+        load_file_buffer,
+        parse_alignment_chart,
+        parse_alignment_journal,
+        save_file_buffer,
+        serialize_alignment_chart,
+        serialize_alignment_ops,
+)
+from doge_cogs.cache import DEFAULT_MAX_GUILDS
+
+if TYPE_CHECKING:
+        from collections.abc import Callable, Sequence
+        from pathlib import Path
+
+T = TypeVar("T")
+
+DEFAULT_IO_WORKERS = 4
+DEFAULT_COMPACT_BYTES = 1 << 20
+DEFAULT_SHARDS = 16
+
+
+class ChartBackend(Protocol):
+        """Blocking storage for per-guild alignment charts.
+
+        Implementations must be safe to call from several threads at once.
+        """
+
+        def load(self, guild_id: int) -> AlignmentChart:
+                """Return a guild's full chart."""
+                ...
+
+        def save(
+                self,
+                guild_id: int,
+                chart: AlignmentChart,
+                ops: Sequence[AlignmentOp] | None = None,
+        ) -> None:
+                """Persist a guild's chart.
+
+                ``chart`` must already include ``ops``. Backends may store
+                just the operations; without them the whole chart is written.
+                """
+                ...
+
+        def get_user(self, guild_id: int, user_id: str) -> UserAlignment | None:
+                """Return one user's entry, if any."""
+                ...
+
+        def users_with_alignment(
+                self,
+                guild_id: int,
+                alignment: AlignmentName,
+        ) -> dict[str, UserAlignment]:
+                """Return the entries of every user with an alignment."""
+                ...
+
+        def guild_ids(self) -> list[int]:
+                """Return every guild with a stored chart."""
+                ...
+
+        def close(self) -> None:
+                """Release any resources held by the backend."""
+                ...
+
+
+class YamlBackend:
+        """One YAML snapshot plus a change journal per guild.
+
+        Each guild has a YAML snapshot, ``<guild_id>.yaml``, and an
+        append-only journal of operations applied since that snapshot,
+        ``<guild_id>.journal``. Saving appends to the journal; once it
+        has grown past ``compact_bytes`` the next save rewrites the
+        snapshot and drops the journal instead. Loading replays the
+        journal over the snapshot and never writes anything.
+
+        Snapshots are written in ``snapshot_format``; either format is
+        read back regardless of the setting. Guilds stored by
+        ``ShardedBackend`` are read as they are and converted to a
+        snapshot on their first save.
+        """
+
+        def __init__(
+                self,
+                data_dir: Path,
+                *,
+                compact_bytes: int = DEFAULT_COMPACT_BYTES,
+                snapshot_format: ChartFormat = "yaml",
+        ) -> None:
+                self.data_dir = data_dir
+                self.data_dir.mkdir(parents=True, exist_ok=True)
+                self.compact_bytes = compact_bytes
+                self.snapshot_format = snapshot_format
+                # Where the last whole line of each journal seen ends
+                self._journal_sizes: dict[int, int] = {}
+                # Guilds whose journal continues past that, with a torn line
+                self._torn: set[int] = set()
+                # Guilds with shards, which their next save must replace
+                self._with_shards: set[int] = set()
+                self._locks: dict[int, threading.Lock] = {}
+                self._locks_lock = threading.Lock()
+                self._sharded: ShardedBackend | None = None
+
+        def path_for(self, guild_id: int) -> Path:
+                """Return the snapshot file for a guild."""
+                return self.data_dir / f"{guild_id}.yaml"
+
+        def exists(self, guild_id: int) -> bool:
+                """Return whether a guild has a snapshot or journal."""
+                return (
+                        self.path_for(guild_id).exists()
+                        or self.journal_path_for(guild_id).exists()
+                )
+
+        def journal_path_for(self, guild_id: int) -> Path:
+                """Return the change journal for a guild."""
+                return self.data_dir / f"{guild_id}.journal"
+
+        def _lock(self, guild_id: int) -> threading.Lock:
+                with self._locks_lock:
+                        return self._locks.setdefault(
+                                guild_id, threading.Lock()
+                        )
+
+        def load(self, guild_id: int) -> AlignmentChart:
+                """Read a guild's snapshot and replay its journal."""
+                with self._lock(guild_id):
+                        if (
+                                not self.exists(guild_id)
+                                and (
+                                        shard_meta_path(self.data_dir, guild_id)
+                                ).exists()
+                        ):
+                                self._with_shards.add(guild_id)
+                                return self._sharded_reader().load(guild_id)
+                        raw_data = load_file_buffer(self.path_for(guild_id))
+                        chart = parse_alignment_chart(raw_data)
+                        journal = load_file_buffer(
+                                self.journal_path_for(guild_id)
+                        )
+                        ops = parse_alignment_journal(journal)
+                        self._note_journal(guild_id, journal, len(ops))
+                        if ops:
+                                chart = apply_alignment_ops(chart, ops)
+                        return chart
+
+        def save(
+                self,
+                guild_id: int,
+                chart: AlignmentChart,
+                ops: Sequence[AlignmentOp] | None = None,
+        ) -> None:
+                """Append ``ops`` to the journal, compacting when it is full."""
+                with self._lock(guild_id):
+                        if ops is None or not self._append(guild_id, ops):
+                                self._compact(guild_id, chart)
+
+        def append(self, guild_id: int, ops: Sequence[AlignmentOp]) -> bool:
+                """Append ``ops`` to the journal unless it is due to compact.
+
+                Returns ``False``, having written nothing, when the whole
+                chart must be saved instead.
+                """
+                with self._lock(guild_id):
+                        return self._append(guild_id, ops)
+
+        def _append(self, guild_id: int, ops: Sequence[AlignmentOp]) -> bool:
+                journal = self.journal_path_for(guild_id)
+                size = self._journal_sizes.get(guild_id)
+                if size is None:
+                        # Not loaded by this process
+                        data = load_file_buffer(journal)
+                        count = len(parse_alignment_journal(data))
+                        size = self._note_journal(guild_id, data, count)
+                if size > self.compact_bytes or guild_id in self._with_shards:
+                        return False
+                if guild_id in self._torn:
+                        # New lines must not run on from the torn one
+                        os.truncate(journal, size)
+                        self._torn.discard(guild_id)
+                if ops:
+                        try:
+                                self._journal_sizes[guild_id] = (
+                                        append_file_buffer(
+                                                journal,
+                                                serialize_alignment_ops(ops),
+                                        )
+                                )
+                        except BaseException:
+                                self._drop_partial_append(guild_id, size)
+                                raise
+                return True
+
+        def _drop_partial_append(self, guild_id: int, size: int) -> None:
+                # Lines appended later must not run on from a partial one
+                try:
+                        os.truncate(self.journal_path_for(guild_id), size)
+                except FileNotFoundError:
+                        pass
+                except OSError:
+                        # Cut off by the next append instead
+                        self._torn.add(guild_id)
+
+        def _note_journal(
+                self,
+                guild_id: int,
+                data: BytesIO,
+                count: int,
+        ) -> int:
+                """Record where the ``count`` whole lines of a journal end."""
+                data.seek(0)
+                size = sum(len(line) for line in islice(data, count))
+                self._journal_sizes[guild_id] = size
+                if size < len(data.getbuffer()):
+                        self._torn.add(guild_id)
+                if (self.data_dir / str(guild_id)).is_dir():
+                        self._with_shards.add(guild_id)
+                return size
+
+        def _compact(self, guild_id: int, chart: AlignmentChart) -> None:
+                save_file_buffer(
+                        self.path_for(guild_id),
+                        serialize_alignment_chart(chart, self.snapshot_format),
+                )
+                # A crash before this unlink only means the journal gets
+                # replayed over a snapshot that already contains it.
+                self.journal_path_for(guild_id).unlink(missing_ok=True)
+                self._journal_sizes[guild_id] = 0
+                self._torn.discard(guild_id)
+                # The snapshot now holds everything, shards are left over
+                remove_shards(self.data_dir, guild_id)
+                self._with_shards.discard(guild_id)
+
+        def _sharded_reader(self) -> ShardedBackend:
+                if self._sharded is None:
+                        self._sharded = ShardedBackend(
+                                self.data_dir,
+                                snapshot_format=self.snapshot_format,
+                        )
+                return self._sharded
+
+        def get_user(self, guild_id: int, user_id: str) -> UserAlignment | None:
+                """Return one user's entry, if any."""
+                return self.load(guild_id)["users"].get(user_id)
+
+        def users_with_alignment(
+                self,
+                guild_id: int,
+                alignment: AlignmentName,
+        ) -> dict[str, UserAlignment]:
+                """Return the entries of every user with an alignment."""
+                return {
+                        uid: entry
+                        for uid, entry in self.load(guild_id)["users"].items()
+                        if entry["alignment"] == alignment
+                }
+
+        def guild_ids(self) -> list[int]:
+                """Return every guild with a stored chart, in either layout."""
+                return stored_guild_ids(self.data_dir)
+
+        def close(self) -> None:
+                """Release the reader of sharded guilds, if one was needed."""
+                if self._sharded is not None:
+                        self._sharded.close()
+
+
+def shard_of(user_id: str, shards: int) -> int:
+        """Return the shard holding a user, the same in every process."""
+        return zlib.crc32(user_id.encode()) % shards
+
+
+def shard_meta_path(data_dir: Path, guild_id: int) -> Path:
+        """Return the file with a sharded guild's admins and shard count."""
+        return data_dir / str(guild_id) / "meta.yaml"
+
+
+def sharded_guild_ids(data_dir: Path) -> list[int]:
+        """Return every guild stored by ``ShardedBackend`` in ``data_dir``."""
+        return sorted(
+                int(path.parent.name)
+                for path in data_dir.glob("*/meta.yaml")
+                if path.parent.name.isdigit()
+        )
+
+
+def stored_guild_ids(data_dir: Path) -> list[int]:
+        """Return every guild stored in ``data_dir``, in either layout."""
+        return sorted(
+                {
+                        int(path.stem)
+                        for pattern in ("*.yaml", "*.journal")
+                        for path in data_dir.glob(pattern)
+                        if path.stem.isdigit()
+                }
+                | set(sharded_guild_ids(data_dir))
+        )
+
+
+def read_chart_files(data_dir: Path, guild_id: int) -> AlignmentChart:
+        """Return a guild's chart from the files of either layout.
+
+        Snapshots and journals are parsed directly, so unlike the
+        backends' ``load`` this never changes anything in ``data_dir``.
+        """
+
+        def replay(snapshot: Path, journal: Path) -> AlignmentChart:
+                chart = parse_alignment_chart(load_file_buffer(snapshot))
+                ops = parse_alignment_journal(load_file_buffer(journal))
+                return apply_alignment_ops(chart, ops) if ops else chart
+
+        snapshot = data_dir / f"{guild_id}.yaml"
+        journal = data_dir / f"{guild_id}.journal"
+        meta_path = shard_meta_path(data_dir, guild_id)
+        if snapshot.exists() or journal.exists() or not meta_path.exists():
+                return replay(snapshot, journal)
+        meta = yaml.safe_load(meta_path.read_bytes())
+        users = {}
+        for shard in range(meta["shards"]):
+                users.update(
+                        replay(
+                                meta_path.parent / f"{shard}.yaml",
+                                meta_path.parent / f"{shard}.journal",
+                        )["users"]
+                )
+        return {"users": users, "admins": meta["admins"]}
+
+
+def remove_shards(data_dir: Path, guild_id: int) -> None:
+        """Delete a guild's sharded files, if there are any."""
+        guild_dir = data_dir / str(guild_id)
+        meta = shard_meta_path(data_dir, guild_id)
+        if guild_dir.is_dir():
+                # The meta file goes first, which unmarks the guild as sharded
+                meta.unlink(missing_ok=True)
+                shutil.rmtree(guild_dir)
+
+
+class ShardedBackend:
+        """Per-guild charts split into shards by user ID.
+
+        A guild's users are spread over ``shards`` shards by ``shard_of``,
+        and its admins and shard count kept in ``<guild_id>/meta.yaml``.
+        Each shard is stored like a ``YamlBackend`` guild, as
+        ``<guild_id>/<shard>.yaml`` plus a journal, and compacted on its
+        own once its journal outgrows its share of ``compact_bytes``. So
+        compacting rewrites one shard rather than the whole chart, and
+        the meta file is only rewritten when admins change. Loading reads
+        the shards in parallel.
+
+        Guilds in ``YamlBackend``'s single-file layout are read as they
+        are and split on their first save, and ``YamlBackend`` joins them
+        again the same way. A guild keeps the shard count it was split
+        with.
+
+        The meta file and shard members of the last ``max_guilds`` guilds
+        used are kept in memory. A guild that falls out has every shard
+        rewritten on its next save unless it is loaded first.
+        """
+
+        def __init__(
+                self,
+                data_dir: Path,
+                *,
+                shards: int = DEFAULT_SHARDS,
+                compact_bytes: int = DEFAULT_COMPACT_BYTES,
+                snapshot_format: ChartFormat = "yaml",
+                load_workers: int = DEFAULT_IO_WORKERS,
+                max_guilds: int = DEFAULT_MAX_GUILDS,
+        ) -> None:
+                self.data_dir = data_dir
+                self.data_dir.mkdir(parents=True, exist_ok=True)
+                self.shards = shards
+                self.max_guilds = max_guilds
+                self.compact_bytes = compact_bytes
+                self.snapshot_format = snapshot_format
+                self._single = YamlBackend(
+                        data_dir, snapshot_format=snapshot_format
+                )
+                # Every shard of a guild is a "guild" of its own store
+                self._stores: dict[int, YamlBackend] = {}
+                # The user IDs in each shard of every guild kept
+                self._members: dict[int, list[set[str]]] = {}
+                # The meta file of every guild kept
+                self._meta: dict[int, dict] = {}
+                # Sharded guilds whose single-file layout is left over
+                self._with_single: set[int] = set()
+                # Kept guilds, least recently used first
+                self._recent: OrderedDict[int, None] = OrderedDict()
+                # Dropped once no thread holds or waits for them
+                self._locks: weakref.WeakValueDictionary[
+                        int, threading.Lock
+                ] = weakref.WeakValueDictionary()
+                self._locks_lock = threading.Lock()
+                self._executor = ThreadPoolExecutor(
+                        max_workers=load_workers,
+                        thread_name_prefix="doge-shard-io",
+                )
+
+        def _lock(self, guild_id: int) -> threading.Lock:
+                with self._locks_lock:
+                        self._recent[guild_id] = None
+                        self._recent.move_to_end(guild_id)
+                        while len(self._recent) > self.max_guilds:
+                                oldest, _ = self._recent.popitem(last=False)
+                                self._forget(oldest)
+                        return self._locks.setdefault(
+                                guild_id, threading.Lock()
+                        )
+
+        def _forget(self, guild_id: int) -> None:
+                # Callers working on the guild hold what they need locally
+                self._stores.pop(guild_id, None)
+                self._members.pop(guild_id, None)
+                self._meta.pop(guild_id, None)
+                self._with_single.discard(guild_id)
+
+        def shard_store(self, guild_id: int, shards: int) -> YamlBackend:
+                """Return the store holding a guild's shards."""
+                store = self._stores.get(guild_id)
+                if store is None:
+                        store = self._stores[guild_id] = YamlBackend(
+                                self.data_dir / str(guild_id),
+                                compact_bytes=self.compact_bytes // shards,
+                                snapshot_format=self.snapshot_format,
+                        )
+                return store
+
+        def _read_meta(self, guild_id: int) -> dict | None:
+                meta = self._meta.get(guild_id)
+                if meta is not None:
+                        return meta
+                path = shard_meta_path(self.data_dir, guild_id)
+                if not path.exists():
+                        return None
+                meta = self._meta[guild_id] = yaml.safe_load(path.read_bytes())
+                return meta
+
+        def _write_meta(
+                self,
+                guild_id: int,
+                chart: AlignmentChart,
+                shards: int,
+        ) -> None:
+                meta = {"shards": shards, "admins": list(chart["admins"])}
+                save_file_buffer(
+                        shard_meta_path(self.data_dir, guild_id),
+                        BytesIO(yaml.safe_dump(meta).encode()),
+                )
+                self._meta[guild_id] = meta
+
+        @staticmethod
+        def _shard_chart(
+                chart: AlignmentChart,
+                members: set[str],
+        ) -> AlignmentChart:
+                users = chart["users"]
+                return {
+                        "users": {uid: users[uid] for uid in members},
+                        "admins": [],
+                }
+
+        def _write_all(
+                self,
+                guild_id: int,
+                chart: AlignmentChart,
+                shards: int,
+        ) -> None:
+                members: list[set[str]] = [set() for _ in range(shards)]
+                for user_id in chart["users"]:
+                        members[shard_of(user_id, shards)].add(user_id)
+                self._members[guild_id] = members
+                store = self.shard_store(guild_id, shards)
+                store.data_dir.mkdir(exist_ok=True)
+                for shard in range(shards):
+                        store.save(
+                                shard, self._shard_chart(chart, members[shard])
+                        )
+                # Written last: until it exists the guild is not sharded
+                self._write_meta(guild_id, chart, shards)
+
+        def _remove_single(self, guild_id: int) -> None:
+                self._single.path_for(guild_id).unlink(missing_ok=True)
+                self._single.journal_path_for(guild_id).unlink(missing_ok=True)
+
+        def load(self, guild_id: int) -> AlignmentChart:
+                """Read every shard of a guild's chart in parallel."""
+                with self._lock(guild_id):
+                        meta = self._read_meta(guild_id)
+                        if meta is None:
+                                if not self._single.exists(guild_id):
+                                        return {"users": {}, "admins": []}
+                                return self._single.load(guild_id)
+                        if self._single.exists(guild_id):
+                                # Left over if a conversion was cut short
+                                self._with_single.add(guild_id)
+                        store = self.shard_store(guild_id, meta["shards"])
+                        parts = list(
+                                self._executor.map(
+                                        store.load, range(meta["shards"])
+                                )
+                        )
+                        self._members[guild_id] = [
+                                set(part["users"]) for part in parts
+                        ]
+                        users = {}
+                        for part in parts:
+                                users.update(part["users"])
+                        return {"users": users, "admins": list(meta["admins"])}
+
+        def save(
+                self,
+                guild_id: int,
+                chart: AlignmentChart,
+                ops: Sequence[AlignmentOp] | None = None,
+        ) -> None:
+                """Pass ``ops`` on to the shards they touch.
+
+                Without operations every shard is rewritten.
+                """
+                with self._lock(guild_id):
+                        meta = self._read_meta(guild_id)
+                        shards = self.shards if meta is None else meta["shards"]
+                        members = self._members.get(guild_id)
+                        if ops is None or meta is None or members is None:
+                                self._write_all(guild_id, chart, shards)
+                                self._remove_single(guild_id)
+                                self._with_single.discard(guild_id)
+                                return
+                        if guild_id in self._with_single:
+                                self._remove_single(guild_id)
+                                self._with_single.discard(guild_id)
+                        by_shard: dict[int, list[AlignmentOp]] = {}
+                        admins_changed = False
+                        for op in ops:
+                                if op["op"] not in ("set", "remove"):
+                                        admins_changed = True
+                                        continue
+                                user_id = op["user_id"]
+                                shard = shard_of(user_id, shards)
+                                by_shard.setdefault(shard, []).append(op)
+                                if user_id in chart["users"]:
+                                        members[shard].add(user_id)
+                                else:
+                                        members[shard].discard(user_id)
+                        store = self.shard_store(guild_id, shards)
+                        for shard, shard_ops in by_shard.items():
+                                # Only a shard due to compact needs its users
+                                if not store.append(shard, shard_ops):
+                                        store.save(
+                                                shard,
+                                                self._shard_chart(
+                                                        chart, members[shard]
+                                                ),
+                                        )
+                        if admins_changed:
+                                self._write_meta(guild_id, chart, shards)
+
+        def get_user(self, guild_id: int, user_id: str) -> UserAlignment | None:
+                """Return one user's entry, reading only their shard."""
+                with self._lock(guild_id):
+                        meta = self._read_meta(guild_id)
+                        if meta is not None:
+                                shards = meta["shards"]
+                                store = self.shard_store(guild_id, shards)
+                                return store.load(shard_of(user_id, shards))[
+                                        "users"
+                                ].get(user_id)
+                return self.load(guild_id)["users"].get(user_id)
+
+        def users_with_alignment(
+                self,
+                guild_id: int,
+                alignment: AlignmentName,
+        ) -> dict[str, UserAlignment]:
+                """Return the entries of every user with an alignment."""
+                return {
+                        uid: entry
+                        for uid, entry in self.load(guild_id)["users"].items()
+                        if entry["alignment"] == alignment
+                }
+
+        def guild_ids(self) -> list[int]:
+                """Return every guild with a stored chart, in either layout."""
+                return self._single.guild_ids()
+
+        def close(self) -> None:
+                """Release the shard reading threads."""
+                self._executor.shutdown(wait=True)
+                self._single.close()
+
+
+class ChartStorage:
+        """Async facade over a ``ChartBackend``.
+
+        Every backend call, including the YAML parse/dump, runs in a
+        bounded thread pool so a large guild never stalls the event loop.
+        """
+
+        def __init__(
+                self,
+                backend: ChartBackend,
+                *,
+                max_workers: int = DEFAULT_IO_WORKERS,
+        ) -> None:
+                self.backend = backend
+                self._executor = ThreadPoolExecutor(
+                        max_workers=max_workers,
+                        thread_name_prefix="doge-chart-io",
+                )
+
+        async def _run(self, func: Callable[..., T], *args: object) -> T:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self._executor, func, *args)
+
+        async def load(self, guild_id: int) -> AlignmentChart:
+                """Load a guild's chart in the I/O pool."""
+                return await self._run(self.backend.load, guild_id)
+
+        async def save(
+                self,
+                guild_id: int,
+                chart: AlignmentChart,
+                ops: Sequence[AlignmentOp] | None = None,
+        ) -> None:
+                """Persist a guild's chart in the I/O pool."""
+                await self._run(self.backend.save, guild_id, chart, ops)
+
+        async def get_user(
+                self,
+                guild_id: int,
+                user_id: str,
+        ) -> UserAlignment | None:
+                """Look up one user's entry in the I/O pool."""
+                return await self._run(self.backend.get_user, guild_id, user_id)
+
+        async def users_with_alignment(
+                self,
+                guild_id: int,
+                alignment: AlignmentName,
+        ) -> dict[str, UserAlignment]:
+                """Query every user with an alignment in the I/O pool."""
+                return await self._run(
+                        self.backend.users_with_alignment, guild_id, alignment
+                )
+
+        def close(self) -> None:
+                """Wait for pending I/O, then release the pool and backend."""
+                self._executor.shutdown(wait=True)
+                self.backend.close()
@@ -1,17 +1,90 @@
+import asyncio
+import errno
+import os
+import pickle
+import random
+import subprocess
+import sys
 import tempfile
+import threading
+import time
 import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from io import BytesIO
 from pathlib import Path
+from typing import get_args
+from unittest import mock
 
 from doge_cogs.alignment import (
         AlignmentChart,
+        AlignmentIndex,
+        AlignmentName,
+        ChartStyle,
+        apply_alignment_op,
+        apply_alignment_ops,
+        dirty_cells_for_op,
+        grid_dimensions,
+        layout_chart,
+        layout_positions,
         load_file_buffer,
+        msgpack,
         parse_alignment_chart,
+        persistent_chart,
+        plain_chart,
         remove_user_alignment,
+        render_alignment_chart,
         save_file_buffer,
         serialize_alignment_chart,
         set_user_alignment,
 )
+from doge_cogs.avatars import AvatarDiskCache, AvatarFetcher
+from doge_cogs.bench import compare_results
+from doge_cogs.cache import ChartCache
+from doge_cogs.hamt import PersistentMap
+from doge_cogs.metrics import Histogram, Metrics
+from doge_cogs.pages import ChartPages, PagesCache
+from doge_cogs.records import (
+        ALIGNMENT_LABELS,
+        Alignment,
+        UserRecord,
+        compact_user,
+)
+from doge_cogs.refresh import Profile, ProfileRefresher
+from doge_cogs.render import (
+        DEFAULT_MAX_CANVASES,
+        ChartRenderer,
+        RenderFlights,
+        RenderKey,
+        RenderPool,
+)
+from doge_cogs.sqlite_storage import SqliteBackend, migrate_yaml_to_sqlite
+from doge_cogs.storage import (
+        ChartStorage,
+        ShardedBackend,
+        YamlBackend,
+        shard_of,
+        sharded_guild_ids,
+)
+from doge_cogs.tiles import Tile, TileCache, TileKey
+from doge_cogs.transfer import export_to_spool, import_chart_ops
+
+try:
+        import numpy as np
+
+        from doge_cogs.numpy_render import blit_grid, shape_alpha, style_tiles
+except ImportError:
+        np = None
+
+try:
+        import wand.image
+except ImportError:
+        wand = None
+
+try:
+        from doge_alignment.loadtest import run_load_test
+except ImportError:
+        # Needs Red, and the repository root on the path
+        run_load_test = None
 
 
 class TestAlignmentChart(unittest.TestCase):
@@ -55,12 +128,119 @@ class TestAlignmentChart(unittest.TestCase):
                 self.assertNotIn("123", updated["users"])
                 self.assertIn("123", chart["users"])  # original unchanged
 
+        def test_updates_preserve_admins(self):
+                chart: AlignmentChart = {"users": {}, "admins": ["42"]}
+                updated = set_user_alignment(
+                        chart, "123", "Lawful Good", "Tester"
+                )
+                self.assertEqual(updated["admins"], ["42"])
+                updated = remove_user_alignment(updated, "123")
+                self.assertEqual(updated["admins"], ["42"])
+
+        def test_index_follows_updates(self):
+                chart: AlignmentChart = {"users": {}, "admins": []}
+                chart = set_user_alignment(chart, "1", "Lawful Good", "A")
+                index = AlignmentIndex(chart)
+                chart = set_user_alignment(
+                        chart, "2", "Lawful Good", "B", index=index
+                )
+                chart = set_user_alignment(
+                        chart, "1", "Chaotic Evil", "A", index=index
+                )
+                chart = apply_alignment_op(chart, _set_op("3"), index)
+                chart = remove_user_alignment(chart, "2", index=index)
+                self.assertEqual(index.counts(), AlignmentIndex(chart).counts())
+                self.assertEqual(list(index.users("Chaotic Evil")), ["1"])
+                self.assertEqual(index.count("Lawful Good"), 0)
+                self.assertEqual(index.count("True Neutral"), 1)
+
+        def test_apply_ops_in_one_copy(self):
+                chart: AlignmentChart = {"users": {}, "admins": ["9"]}
+                chart = set_user_alignment(chart, "1", "Lawful Good", "A")
+                ops = [
+                        _set_op("2"),
+                        _set_op("1", "Chaotic Evil"),
+                        {"op": "remove", "user_id": "2"},
+                        {"op": "add_admin", "user_id": "1"},
+                        {"op": "remove_admin", "user_id": "9"},
+                        _set_op("3"),
+                ]
+                index = AlignmentIndex(chart)
+                batched = apply_alignment_ops(chart, ops, index)
+                one_by_one = chart
+                for op in ops:
+                        one_by_one = apply_alignment_op(one_by_one, op)
+                self.assertEqual(batched, one_by_one)
+                expected = AlignmentIndex(batched).counts()
+                self.assertEqual(index.counts(), expected)
+                # The input chart is left alone
+                self.assertEqual(list(chart["users"]), ["1"])
+                self.assertEqual(chart["admins"], ["9"])
+                # Untouched parts are shared, not copied
+                admins_only = apply_alignment_ops(
+                        chart, [{"op": "add_admin", "user_id": "2"}]
+                )
+                self.assertIs(admins_only["users"], chart["users"])
+
+        def test_unknown_op_changes_nothing(self):
+                chart: AlignmentChart = {"users": {}, "admins": []}
+                chart = set_user_alignment(chart, "1", "Lawful Good", "A")
+                index = AlignmentIndex(chart)
+                ops = [_set_op("2"), {"op": "rename", "user_id": "1"}]
+                with self.assertRaises(ValueError):
+                        apply_alignment_ops(chart, ops, index)
+                self.assertEqual(index.counts(), AlignmentIndex(chart).counts())
+                self.assertEqual(list(chart["users"]), ["1"])
+
+        def test_persistent_chart_matches_plain_chart(self):
+                chart: AlignmentChart = {"users": {}, "admins": ["9"]}
+                chart = set_user_alignment(chart, "1", "Lawful Good", "A")
+                shared = persistent_chart(chart)
+                self.assertIsInstance(shared["users"], PersistentMap)
+                ops = [
+                        _set_op("2"),
+                        _set_op("1", "Chaotic Evil"),
+                        {"op": "remove", "user_id": "2"},
+                        {"op": "add_admin", "user_id": "1"},
+                        _set_op("3"),
+                ]
+                batched = apply_alignment_ops(shared, ops)
+                self.assertIsInstance(batched["users"], PersistentMap)
+                self.assertEqual(batched, apply_alignment_ops(chart, ops))
+                self.assertEqual(list(batched["users"]), ["1", "3"])
+                updated = remove_user_alignment(
+                        set_user_alignment(shared, "4", "Lawful Evil", "D"),
+                        "1",
+                )
+                self.assertEqual(updated["admins"], ["9"])
+                self.assertEqual(list(updated["users"]), ["4"])
+                # Older versions are untouched
+                self.assertEqual(shared, chart)
+                plain = plain_chart(batched)
+                self.assertIs(type(plain["users"]), dict)
+                self.assertEqual(plain, batched)
+                for fmt in ("yaml", "binary") if msgpack else ("yaml",):
+                        buf = serialize_alignment_chart(batched, fmt)
+                        self.assertEqual(parse_alignment_chart(buf), plain)
+
         def test_serialization_round_trip(self):
                 chart: AlignmentChart = {"users": {}, "admins": []}
                 buf = serialize_alignment_chart(chart)
                 parsed = parse_alignment_chart(buf)
                 self.assertEqual(chart, parsed)
 
+        @unittest.skipIf(msgpack is None, "msgpack is not installed")
+        def test_binary_round_trip(self):
+                chart = set_user_alignment(
+                        {"users": {}, "admins": ["1"]},
+                        "123",
+                        "Lawful Neutral",
+                        "Tester",
+                )
+                buf = serialize_alignment_chart(chart, "binary")
+                self.assertFalse(buf.getvalue().startswith(b"users"))
+                self.assertEqual(parse_alignment_chart(buf), chart)
+
         def test_load_and_save_file(self):
                 with tempfile.TemporaryDirectory() as tmpdir:
                         path = Path(tmpdir) / "test.yaml"
@@ -77,6 +257,1371 @@ class TestAlignmentChart(unittest.TestCase):
                         self.assertEqual(parsed, {"users": {}, "admins": []})
 
 
+def _set_op(user_id: str, alignment: str = "True Neutral") -> dict:
+        return {
+                "op": "set",
+                "user_id": user_id,
+                "alignment": alignment,
+                "display_name": f"User {user_id}",
+                "avatar_url": None,
+        }
+
+
+class _Colliding(str):
+        """A key whose hash collides with every other one."""
+
+        __slots__ = ()
+
+        def __hash__(self) -> int:
+                return 7
+
+
+class TestPersistentMap(unittest.TestCase):
+        def _check_against_dict(self, make_key) -> None:
+                # Not for secrets: seeded, so a failure can be replayed
+                rng = random.Random(1)  # noqa: S311
+                current = PersistentMap()
+                model: dict = {}
+                snapshots = []
+                for step in range(5000):
+                        key = make_key(rng.randrange(500))
+                        if rng.random() < 0.3:
+                                current = current.delete(key)
+                                model.pop(key, None)
+                        else:
+                                current = current.set(key, step)
+                                model[key] = step
+                        if step % 500 == 0:
+                                snapshots.append((current, dict(model)))
+                self.assertEqual(len(current), len(model))
+                self.assertEqual(list(current.items()), list(model.items()))
+                for snapshot, expected in snapshots:
+                        self.assertEqual(
+                                list(snapshot.items()), list(expected.items())
+                        )
+                self.assertEqual(list(PersistentMap(model)), list(model))
+
+        def test_matches_dict(self):
+                self._check_against_dict(str)
+
+        def test_hash_collisions(self):
+                self._check_against_dict(_Colliding)
+
+        def test_updates_share_structure(self):
+                base = PersistentMap({str(i): i for i in range(1000)})
+                self.assertIs(base.delete("missing"), base)
+                updated = base.set("0", -1)
+                self.assertEqual(updated["0"], -1)
+                self.assertEqual(base["0"], 0)
+                shared = set(map(id, base._root.entries)) & set(
+                        map(id, updated._root.entries)
+                )
+                self.assertEqual(len(shared), len(base._root.entries) - 1)
+
+        def test_order_of_a_built_map_follows_updates(self):
+                model = {str(i): i for i in range(1000)}
+                current = PersistentMap(model)
+                for i in range(0, 1000, 3):
+                        current = current.delete(str(i))
+                        del model[str(i)]
+                for i in range(500, 2000, 7):
+                        current = current.set(str(i), -i)
+                        model[str(i)] = -i
+                self.assertEqual(list(current.items()), list(model.items()))
+
+        def test_pickle_keeps_order(self):
+                items = {str(i): i for i in range(100, 0, -1)}
+                # Only ever loads what this test just dumped
+                data = pickle.dumps(PersistentMap(items))
+                restored = pickle.loads(data)  # noqa: S301
+                self.assertEqual(list(restored.items()), list(items.items()))
+
+
+class TestUserRecords(unittest.TestCase):
+        def test_labels_match_alignment_names(self):
+                self.assertEqual(ALIGNMENT_LABELS, get_args(AlignmentName))
+                self.assertEqual(Alignment.TRUE_NEUTRAL.label, "True Neutral")
+
+        def test_round_trip_is_lossless(self):
+                for avatar_url in (
+                        "https://cdn.discordapp.com/avatars/1/abc.png",
+                        "https://example.com/a.png",
+                        None,
+                ):
+                        entry = {
+                                "alignment": "Chaotic Good",
+                                "display_name": "Tester",
+                                "avatar_url": avatar_url,
+                        }
+                        record = compact_user(entry)
+                        self.assertIsInstance(record, UserRecord)
+                        self.assertEqual(record, entry)
+                        self.assertEqual(dict(record), entry)
+                        # Only ever loads what this test just dumped
+                        data = pickle.dumps(record)
+                        restored = pickle.loads(data)  # noqa: S301
+                        self.assertEqual(restored, entry)
+                self.assertIs(record.alignment, Alignment.CHAOTIC_GOOD)
+
+        def test_unusual_entries_are_kept(self):
+                base = {
+                        "alignment": "Lawful Good",
+                        "display_name": "A",
+                        "avatar_url": None,
+                }
+                for entry in (
+                        {**base, "alignment": "Mostly Harmless"},
+                        {**base, "note": "extra"},
+                        {**base, "display_name": 5},
+                ):
+                        self.assertIs(compact_user(entry), entry)
+
+        def test_resident_charts_are_compact(self):
+                chart = set_user_alignment(
+                        {"users": {}, "admins": []}, "1", "Lawful Evil", "A"
+                )
+                compact = persistent_chart(chart)
+                self.assertIsInstance(compact["users"]["1"], UserRecord)
+                compact = set_user_alignment(compact, "2", "Neutral Evil", "B")
+                self.assertIsInstance(compact["users"]["2"], UserRecord)
+                buf = serialize_alignment_chart(compact)
+                self.assertEqual(
+                        parse_alignment_chart(buf), plain_chart(compact)
+                )
+                self.assertIs(type(plain_chart(compact)["users"]["2"]), dict)
+
+
+class TestChartLayout(unittest.TestCase):
+        def test_dirty_cells_for_op(self):
+                chart = apply_alignment_op(
+                        {"users": {}, "admins": []}, _set_op("1", "Lawful Good")
+                )
+                self.assertEqual(
+                        dirty_cells_for_op(chart, _set_op("1", "Chaotic Evil")),
+                        {"Lawful Good", "Chaotic Evil"},
+                )
+                self.assertEqual(
+                        dirty_cells_for_op(chart, _set_op("1", "Lawful Good")),
+                        set(),
+                )
+                self.assertEqual(
+                        dirty_cells_for_op(
+                                chart, {"op": "remove", "user_id": "1"}
+                        ),
+                        {"Lawful Good"},
+                )
+                self.assertEqual(
+                        dirty_cells_for_op(
+                                chart, {"op": "add_admin", "user_id": "1"}
+                        ),
+                        set(),
+                )
+
+        def test_layout_positions_wraps_rows(self):
+                self.assertEqual(
+                        layout_positions(5, (10, 10), 2, area_width=34),
+                        [(0, 0), (12, 0), (24, 0), (0, 12), (12, 12)],
+                )
+                self.assertEqual(
+                        layout_positions(2, (10, 10), 2), [(0, 0), (0, 12)]
+                )
+
+        def test_grid_dimensions(self):
+                self.assertEqual(grid_dimensions(1, (100, 100), 0), (1, 1, 100))
+                self.assertEqual(grid_dimensions(4, (100, 100), 0), (2, 2, 50))
+                self.assertEqual(grid_dimensions(3, (300, 100), 0), (3, 1, 100))
+                cols, rows, tile = grid_dimensions(500, (480, 420), 4)
+                self.assertGreaterEqual(cols * rows, 500)
+                self.assertLessEqual(cols * (tile + 4) - 4, 480)
+                self.assertLessEqual(rows * (tile + 4) - 4, 420)
+
+        def test_layout_chart_stays_in_cells(self):
+                chart: AlignmentChart = {"users": {}, "admins": []}
+                for i in range(300):
+                        chart = set_user_alignment(
+                                chart, str(i), "Chaotic Good", f"User {i}"
+                        )
+                style = ChartStyle()
+                layouts = layout_chart(chart, style)
+                self.assertEqual(layouts["Lawful Good"].slots, [])
+                cell = layouts["Chaotic Good"]
+                self.assertEqual(len(cell.slots), 300)
+                for _, left, top in cell.slots:
+                        self.assertGreater(left, 2 * style.size // 3)
+                        self.assertLess(top + cell.tile, style.size // 3)
+
+
+class TestChartTransfer(unittest.TestCase):
+        def _chart(self) -> AlignmentChart:
+                chart: AlignmentChart = {"users": {}, "admins": ["1"]}
+                chart = set_user_alignment(chart, "1", "Lawful Good", "A, B")
+                return set_user_alignment(
+                        chart, "2", "Chaotic Evil", "Ünï", "https://x/2.png"
+                )
+
+        def test_round_trip(self):
+                chart = self._chart()
+                for fmt in ("csv", "yaml"):
+                        with export_to_spool(chart, fmt) as data:
+                                ops = list(import_chart_ops(fmt, data))
+                        imported = apply_alignment_ops(
+                                {"users": {}, "admins": []}, ops
+                        )
+                        self.assertEqual(imported["users"], chart["users"])
+                        # Imports never grant admin rights
+                        self.assertEqual(imported["admins"], [])
+
+        def test_invalid_rows_are_reported(self):
+                data = BytesIO(
+                        b"user_id,alignment\n1,Lawful Good\n2,Lawful Bad\n"
+                )
+                with self.assertRaisesRegex(ValueError, "Line 3"):
+                        list(import_chart_ops("csv", data))
+                with self.assertRaisesRegex(ValueError, "header"):
+                        list(import_chart_ops("csv", BytesIO(b"id,name\n")))
+                with self.assertRaisesRegex(TypeError, "users"):
+                        list(import_chart_ops("yaml", BytesIO(b"- 1\n")))
+
+
+class TestChartPages(unittest.TestCase):
+        def test_pages_group_users_by_alignment(self):
+                chart: AlignmentChart = {"users": {}, "admins": []}
+                for i in range(7):
+                        alignment = "Chaotic Evil" if i % 2 else "Lawful Good"
+                        op = _set_op(str(i), alignment)
+                        chart = apply_alignment_op(chart, op)
+                pages = ChartPages(chart, AlignmentIndex(chart), page_size=3)
+                self.assertEqual(len(pages), 3)
+                self.assertEqual(
+                        pages.page(0).splitlines(),
+                        [
+                                "__**Lawful Good**__",
+                                "• User 0",
+                                "• User 2",
+                                "• User 4",
+                                "-# Page 1/3",
+                        ],
+                )
+                # Page 2 continues Lawful Good and then starts Chaotic Evil
+                self.assertEqual(
+                        pages.page(1).splitlines()[:4],
+                        [
+                                "__**Lawful Good**__",
+                                "• User 6",
+                                "__**Chaotic Evil**__",
+                                "• User 1",
+                        ],
+                )
+                empty: AlignmentChart = {"users": {}, "admins": []}
+                self.assertEqual(
+                        len(ChartPages(empty, AlignmentIndex(empty))), 1
+                )
+
+        def test_pages_are_shared_per_version(self):
+                cache = PagesCache(max_charts=1)
+                chart: AlignmentChart = {"users": {}, "admins": []}
+                index = AlignmentIndex(chart)
+                pages = cache.get(1, 0, chart, index)
+                self.assertIs(cache.get(1, 0, chart, index), pages)
+                cache.get(1, 1, chart, index)
+                self.assertIsNot(cache.get(1, 0, chart, index), pages)
+
+
+class TestLazyImports(unittest.TestCase):
+        def test_text_paths_do_not_load_imaging(self):
+                code = (
+                        "import sys\n"
+                        "import doge_cogs.cache, doge_cogs.pages\n"
+                        "import doge_cogs.render, doge_cogs.transfer\n"
+                        "print(sorted({'numpy', 'wand'} & set(sys.modules)))"
+                )
+                # This interpreter, running the fixed snippet above
+                out = subprocess.run(  # noqa: S603
+                        [sys.executable, "-c", code],
+                        capture_output=True,
+                        check=True,
+                        text=True,
+                )
+                self.assertEqual(out.stdout.strip(), "[]")
+
+
+@unittest.skipIf(wand is None, "Wand is not installed")
+class TestChartRendering(unittest.TestCase):
+        def test_render_fits_discord_limits(self):
+                chart: AlignmentChart = {"users": {}, "admins": []}
+                for i in range(40):
+                        chart = set_user_alignment(
+                                chart, str(i), "True Neutral", f"User {i}"
+                        )
+                style = ChartStyle(size=600)
+                png = render_alignment_chart(chart, {}, style)
+                self.assertTrue(png.startswith(b"\x89PNG"))
+                self.assertLessEqual(len(png), style.max_bytes)
+
+        def test_rerender_reuses_tiles(self):
+                chart: AlignmentChart = {"users": {}, "admins": []}
+                for i in range(30):
+                        chart = set_user_alignment(
+                                chart, str(i), "Lawful Good", f"User {i}"
+                        )
+                style = ChartStyle(size=600)
+                tiles = TileCache()
+                first = render_alignment_chart(chart, {}, style, tiles)
+                misses = tiles.misses
+                second = render_alignment_chart(chart, {}, style, tiles)
+                self.assertEqual(tiles.misses, misses)
+                self.assertGreaterEqual(tiles.hits, 30)
+                self.assertEqual(first, second)
+
+        def test_incremental_render_matches_full_render(self):
+                style = ChartStyle(size=600)
+                renderer = ChartRenderer(style)
+                chart: AlignmentChart = {"users": {}, "admins": []}
+                for i in range(20):
+                        chart = apply_alignment_op(chart, _set_op(str(i)))
+                renderer.render(1, chart, {})
+                for op in (
+                        _set_op("3", "Chaotic Evil"),
+                        {"op": "remove", "user_id": "4"},
+                        _set_op("30", "Lawful Good"),
+                ):
+                        renderer.note_ops(1, chart, [op])
+                        chart = apply_alignment_op(chart, op)
+                        self.assertEqual(
+                                renderer.render(1, chart, {}),
+                                render_alignment_chart(chart, {}, style),
+                        )
+
+
+class _FakeCanvas:
+        closed = False
+
+        def close(self) -> None:
+                self.closed = True
+
+
+class TestChartRendererEviction(unittest.TestCase):
+        def test_eviction_waits_for_a_render_in_progress(self):
+                renderer = ChartRenderer(max_guilds=1)
+                renderer._blank = _FakeCanvas()  # noqa: SLF001
+                state = renderer._state(1)  # noqa: SLF001
+                state.image = image = _FakeCanvas()
+                with state.lock:
+                        # Guild 1 is being drawn when guild 2 evicts it
+                        evicting = threading.Thread(
+                                target=renderer._state,  # noqa: SLF001
+                                args=(2,),
+                        )
+                        evicting.start()
+                        evicting.join(0.05)
+                        self.assertTrue(evicting.is_alive())
+                        self.assertFalse(image.closed)
+                evicting.join()
+                self.assertTrue(image.closed)
+                self.assertTrue(state.dropped)
+
+
+@unittest.skipIf(wand is None, "Wand is not installed")
+@unittest.skipIf(np is None, "numpy is not installed")
+class TestNumpyEngine(unittest.TestCase):
+        def test_shape_alpha(self):
+                self.assertIsNone(shape_alpha(16, "square"))
+                circle = shape_alpha(16, "circle")
+                self.assertEqual(circle[8, 8], 1)
+                self.assertEqual(circle[0, 0], 0)
+                rounded = shape_alpha(16, "rounded")
+                self.assertEqual(rounded[0, 8], 1)
+                self.assertLess(rounded[0, 0], 1)
+
+        def test_style_tiles(self):
+                pixels = np.full((3, 8, 8, 4), 200, np.uint8)
+                out = style_tiles(pixels, 2, (1, 2, 3, 255), "circle")
+                self.assertEqual(out.shape, (3, 12, 12, 4))
+                self.assertTrue((out[:, 0, :] == (1, 2, 3, 255)).all())
+                self.assertEqual(out[1, 6, 6].tolist(), [200, 200, 200, 200])
+                self.assertEqual(out[1, 2, 2, 3], 0)
+                # The input stack is left alone
+                self.assertTrue((pixels == 200).all())
+
+        def test_blit_grid(self):
+                canvas = np.zeros((20, 20, 4), np.uint8)
+                canvas[..., 3] = 255
+                tiles = np.zeros((3, 4, 4, 4), np.uint8)
+                tiles[..., 0] = 255
+                tiles[..., 3] = 255
+                tiles[2, 0, 0, 3] = 0  # transparent pixel keeps the canvas
+                blit_grid(canvas, tiles, 2, 3, 2, 1)
+                red = canvas[..., 0] == 255
+                self.assertEqual(int(red.sum()), 3 * 16 - 1)
+                self.assertTrue(red[3:7, 2:6].all())
+                self.assertTrue(red[3:7, 7:11].all())
+                self.assertFalse(red[3:7, 6].any())  # the gap
+                self.assertFalse(red[8, 2])
+                self.assertTrue(red[8:12, 3:6].all())
+                self.assertTrue((canvas[..., 3] == 255).all())
+
+
+@unittest.skipIf(wand is None, "Wand is not installed")
+class TestRenderPool(unittest.IsolatedAsyncioTestCase):
+        async def test_worker_render_matches_in_process_render(self):
+                chart: AlignmentChart = {"users": {}, "admins": []}
+                for i in range(12):
+                        chart = apply_alignment_op(chart, _set_op(str(i)))
+                style = ChartStyle(size=600)
+                pool = RenderPool(style, max_workers=2)
+                try:
+                        images = await asyncio.gather(
+                                *(pool.render(g, chart, {}) for g in range(4))
+                        )
+                finally:
+                        pool.close()
+                expected = render_alignment_chart(chart, {}, style)
+                self.assertEqual(images, [expected] * 4)
+
+        async def test_workers_redraw_noted_cells(self):
+                chart: AlignmentChart = {"users": {}, "admins": []}
+                for i in range(6):
+                        chart = apply_alignment_op(chart, _set_op(str(i)))
+                style = ChartStyle(size=600)
+                pool = RenderPool(
+                        style, max_workers=2, tiles=TileCache(max_bytes=1 << 20)
+                )
+                op = _set_op("0", "Chaotic Evil")
+                try:
+                        await pool.render(1, chart, {})
+                        pool.note_ops(1, chart, [op])
+                        chart = apply_alignment_op(chart, op)
+                        image = await pool.render(1, chart, {})
+                finally:
+                        pool.close()
+                self.assertEqual(
+                        image, render_alignment_chart(chart, {}, style)
+                )
+
+        async def test_workers_only_track_resident_canvases(self):
+                chart: AlignmentChart = {"users": {}, "admins": []}
+                for i in range(6):
+                        chart = apply_alignment_op(chart, _set_op(str(i)))
+                style = ChartStyle(size=600)
+                pool = RenderPool(style, max_workers=1)
+                op = _set_op("0", "Chaotic Evil")
+                try:
+                        for guild_id in range(DEFAULT_MAX_CANVASES + 1):
+                                await pool.render(guild_id, chart, {})
+                        # Guild 0 fell out, and a guild never rendered
+                        # has nothing to track
+                        pool.note_ops(0, chart, [op])
+                        pool.note_ops(1000, chart, [op])
+                        resident = pool._resident[0]  # noqa: SLF001
+                        self.assertEqual(len(resident), DEFAULT_MAX_CANVASES)
+                        self.assertNotIn(0, resident)
+                        self.assertNotIn(1000, resident)
+                        chart = apply_alignment_op(chart, op)
+                        image = await pool.render(0, chart, {})
+                finally:
+                        pool.close()
+                self.assertEqual(
+                        image, render_alignment_chart(chart, {}, style)
+                )
+
+
+class TestRenderFlights(unittest.IsolatedAsyncioTestCase):
+        async def test_concurrent_requests_share_a_render(self):
+                flights = RenderFlights()
+                renders = 0
+
+                async def render() -> bytes:
+                        nonlocal renders
+                        renders += 1
+                        await asyncio.sleep(0.01)
+                        return b"png"
+
+                key = RenderKey(1, 0, ChartStyle())
+                images = await asyncio.gather(
+                        *(flights.get(key, render) for _ in range(50))
+                )
+                self.assertEqual(images, [b"png"] * 50)
+                self.assertEqual(renders, 1)
+                # Served from the result cache until the chart changes
+                await flights.get(key, render)
+                self.assertEqual(renders, 1)
+                flights.note_ops(1, {"users": {}, "admins": []}, [])
+                await flights.get(key, render)
+                self.assertEqual(renders, 2)
+                await flights.get(key._replace(version=1), render)
+                self.assertEqual(renders, 3)
+                self.assertEqual((flights.hits, flights.misses), (50, 3))
+
+        async def test_failures_are_not_cached(self):
+                flights = RenderFlights()
+                key = RenderKey(1, 0, ChartStyle())
+
+                async def fail() -> bytes:
+                        raise RuntimeError
+
+                with self.assertRaises(RuntimeError):
+                        await flights.get(key, fail)
+
+                async def render() -> bytes:
+                        return b"png"
+
+                self.assertEqual(await flights.get(key, render), b"png")
+
+        async def test_results_are_bounded(self):
+                flights = RenderFlights(ttl=60, max_results=2)
+
+                async def render() -> bytes:
+                        return b"png"
+
+                for guild_id in (1, 2, 1, 3):
+                        await flights.get(
+                                RenderKey(guild_id, 0, ChartStyle()), render
+                        )
+                # Guild 2 was the least recently used
+                self.assertEqual(len(flights), 2)
+                self.assertEqual((flights.hits, flights.misses), (1, 3))
+                await flights.get(RenderKey(2, 0, ChartStyle()), render)
+                self.assertEqual(flights.misses, 4)
+
+                # An expired result is dropped and rendered again
+                flights.ttl = 0
+                await flights.get(RenderKey(2, 0, ChartStyle()), render)
+                self.assertEqual(flights.misses, 5)
+
+
+class TestBench(unittest.TestCase):
+        def test_compare_flags_regressions_only(self):
+                baseline = {
+                        "python": "3",
+                        "platform": "test",
+                        "seconds": {"parse_10": 1.0, "serialize_10": 1.0},
+                        "bytes": {"dict_bytes_per_user_1000": 700.0},
+                }
+                current = {
+                        **baseline,
+                        "seconds": {
+                                "parse_10": 1.1,
+                                "serialize_10": 1.5,
+                                "new_10": 9.0,
+                        },
+                        "bytes": {"dict_bytes_per_user_1000": 900.0},
+                }
+                regressions = compare_results(current, baseline, 0.2)
+                self.assertEqual(len(regressions), 2)
+                self.assertTrue(regressions[0].startswith("serialize_10"))
+                self.assertTrue(
+                        regressions[1].startswith("dict_bytes_per_user_1000")
+                )
+
+
+class TestMetrics(unittest.TestCase):
+        def test_histogram_buckets(self):
+                histogram = Histogram((0.1, 1.0))
+                for value in (0.05, 0.1, 0.5, 5.0):
+                        histogram.observe(value)
+                self.assertEqual(histogram.counts, [2, 1, 1])
+                self.assertEqual(histogram.quantile(0.5), 0.1)
+                self.assertEqual(histogram.quantile(0.75), 1.0)
+                self.assertEqual(histogram.quantile(1.0), float("inf"))
+
+        def test_spans_and_prometheus_text(self):
+                metrics = Metrics(buckets=(0.5, 60.0))
+                with metrics.span("render"):
+                        pass
+                metrics.observe("command", "alignment_show", 2.0)
+                tiles = TileCache()
+                tiles.hits, tiles.misses = 3, 1
+                # A thread-mode pool reports its tile cache's counters
+                pool = RenderPool(max_workers=0, tiles=tiles)
+                metrics.add_cache("tiles", pool)
+                self.assertEqual(metrics.histogram("span", "render").count, 1)
+                text = metrics.prometheus_text()
+                self.assertIn(
+                        'doge_alignment_span_seconds_bucket{span="render",'
+                        'le="0.5"} 1',
+                        text,
+                )
+                self.assertIn(
+                        "doge_alignment_command_seconds_bucket"
+                        '{command="alignment_show",le="0.5"} 0',
+                        text,
+                )
+                self.assertIn(
+                        'doge_alignment_cache_hits_total{cache="tiles"} 3', text
+                )
+                self.assertIn("`tiles` 75% hits (3/4)", metrics.summary())
+                with tempfile.TemporaryDirectory() as tmpdir:
+                        path = Path(tmpdir) / "metrics.prom"
+                        metrics.write_prometheus(path)
+                        self.assertEqual(path.read_text(), text)
+                        # A snapshot is written as taken
+                        metrics.observe("command", "alignment_show", 2.0)
+                        metrics.write_prometheus(path, text)
+                        self.assertEqual(path.read_text(), text)
+
+        def test_disabled_metrics_record_nothing(self):
+                metrics = Metrics(enabled=False)
+                self.assertIs(metrics.span("a"), metrics.span("b"))
+                with metrics.span("render"):
+                        pass
+                metrics.observe("command", "alignment_show", 1.0)
+                self.assertIsNone(metrics.histogram("span", "render"))
+                self.assertEqual(metrics.summary(), "No metrics recorded yet.")
+
+
+@unittest.skipIf(run_load_test is None, "the cog cannot be imported")
+class TestLoadTest(unittest.IsolatedAsyncioTestCase):
+        async def test_no_lost_updates(self):
+                with tempfile.TemporaryDirectory() as tmpdir:
+                        report = await run_load_test(
+                                Path(tmpdir),
+                                guilds=3,
+                                members=20,
+                                rate=2_000,
+                                commands=300,
+                        )
+                self.assertEqual(report["commands"], 300)
+                self.assertEqual(report["errors"], 0)
+                self.assertEqual(report["lost_updates"], 0)
+                self.assertGreater(report["by_command"]["set"]["count"], 0)
+
+
+class TestTileCache(unittest.TestCase):
+        def _key(self, name: str) -> TileKey:
+                return TileKey(name, 10, 2, "white", "circle")
+
+        def test_lru_eviction_and_spill(self):
+                with tempfile.TemporaryDirectory() as tmpdir:
+                        cache = TileCache(max_bytes=8, spill_dir=Path(tmpdir))
+                        cache.put(self._key("a"), Tile(1, 1, b"aaaa"))
+                        cache.put(self._key("b"), Tile(1, 1, b"bbbb"))
+                        cache.get(self._key("a"))
+                        cache.put(self._key("c"), Tile(1, 1, b"cccc"))
+                        self.assertEqual(len(cache), 2)
+                        self.assertEqual(cache.total_bytes, 8)
+                        # b was evicted to disk and comes back from there
+                        self.assertEqual(
+                                cache.get(self._key("b")), Tile(1, 1, b"bbbb")
+                        )
+                        self.assertIsNone(cache.get(self._key("d")))
+                        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+        def test_memory_only(self):
+                cache = TileCache(max_bytes=4)
+                cache.put(self._key("a"), Tile(1, 1, b"aaaa"))
+                cache.put(self._key("b"), Tile(1, 1, b"bbbb"))
+                self.assertIsNone(cache.get(self._key("a")))
+                self.assertEqual(cache.get(self._key("b")).rgba, b"bbbb")
+
+
+class TestChartCache(unittest.IsolatedAsyncioTestCase):
+        def setUp(self):
+                self.disk: dict[int, AlignmentChart] = {}
+                self.saved_ops: list = []
+                self.loads = 0
+
+        async def _load(self, guild_id: int) -> AlignmentChart:
+                self.loads += 1
+                return self.disk.get(guild_id, {"users": {}, "admins": []})
+
+        async def _save(
+                self, guild_id: int, chart: AlignmentChart, ops: list
+        ) -> None:
+                self.disk[guild_id] = chart
+                self.saved_ops.extend(ops)
+
+        def _cache(self, **kwargs: float) -> ChartCache:
+                return ChartCache(self._load, self._save, **kwargs)
+
+        async def test_write_behind(self):
+                cache = self._cache(flush_after=3)
+                await cache.update(1, _set_op("0"))
+                await cache.update(1, _set_op("1"))
+                self.assertNotIn(1, self.disk)
+                self.assertEqual(cache.dirty_guilds(), [1])
+
+                await cache.update(1, {"op": "remove", "user_id": "0"})
+                self.assertEqual(list(self.disk[1]["users"]), ["1"])
+                self.assertEqual(len(self.saved_ops), 3)
+                self.assertEqual(cache.dirty_guilds(), [])
+                await cache.get(1)
+                self.assertEqual(self.loads, 1)
+                self.assertEqual((cache.hits, cache.misses), (3, 1))
+
+        async def test_lru_eviction_flushes(self):
+                cache = self._cache(max_guilds=2)
+                for guild_id in (1, 2):
+                        await cache.update(guild_id, _set_op("7"))
+                await cache.get(1)  # 2 is now least recently used
+                await cache.get(3)
+                self.assertNotIn(2, cache)
+                self.assertIn(1, cache)
+                self.assertIn("7", self.disk[2]["users"])
+                self.assertNotIn(1, self.disk)
+
+        async def test_close_flushes(self):
+                cache = self._cache(flush_interval=3600)
+                cache.start()
+                await cache.update(5, _set_op("9", "Chaotic Evil"))
+                await asyncio.sleep(0)
+                await cache.close()
+                self.assertIn("9", self.disk[5]["users"])
+
+        async def test_versions_change_with_the_chart(self):
+                cache = self._cache(max_guilds=1)
+                await cache.get(1)
+                first = cache.version(1)
+                await cache.get(1)
+                self.assertEqual(cache.version(1), first)
+                await cache.update(1, _set_op("0"))
+                second = cache.version(1)
+                self.assertNotEqual(second, first)
+                # Evicting and reloading never brings back an old version
+                await cache.get(2)
+                await cache.get(1)
+                self.assertNotIn(cache.version(1), (first, second))
+
+        async def test_index_is_kept_current(self):
+                self.disk[1] = set_user_alignment(
+                        {"users": {}, "admins": []}, "0", "Lawful Good", "A"
+                )
+                cache = self._cache()
+                index = await cache.index(1)
+                self.assertEqual(index.count("Lawful Good"), 1)
+                await cache.update(1, _set_op("0"), _set_op("1"))
+                self.assertIs(await cache.index(1), index)
+                self.assertEqual(index.count("Lawful Good"), 0)
+                self.assertEqual(list(index.users("True Neutral")), ["0", "1"])
+
+        async def test_index_matches_updates_made_while_loading(self):
+                loaded = asyncio.Event()
+                saved = asyncio.Event()
+
+                async def load(guild_id: int) -> AlignmentChart:
+                        if guild_id == 1:
+                                await loaded.wait()
+                        return await self._load(guild_id)
+
+                async def save(guild_id, chart, ops) -> None:
+                        await saved.wait()
+                        await self._save(guild_id, chart, ops)
+
+                cache = ChartCache(load, save, max_guilds=1)
+                await cache.update(2, _set_op("0"))
+                loader = asyncio.create_task(cache.index(1))
+                await asyncio.sleep(0)
+                # Both wait on the load; the update is woken first
+                put = asyncio.create_task(cache.update(1, _set_op("1")))
+                await asyncio.sleep(0)
+                waiter = asyncio.create_task(cache.index(1))
+                await asyncio.sleep(0)
+                # The loader then evicts guild 2, whose save is held up
+                loaded.set()
+                await asyncio.sleep(0.01)
+                saved.set()
+                await asyncio.gather(loader, put, waiter)
+                self.assertIs(waiter.result(), loader.result())
+                self.assertEqual(
+                        list(waiter.result().users("True Neutral")), ["1"]
+                )
+
+        async def test_listeners_see_chart_before_ops(self):
+                cache = self._cache()
+                seen = []
+                cache.add_listener(
+                        lambda gid, chart, ops: seen.append(
+                                (gid, list(chart["users"]), len(ops))
+                        )
+                )
+                await cache.update(1, _set_op("0"), _set_op("1"))
+                await cache.update(1, {"op": "remove", "user_id": "0"})
+                self.assertEqual(seen, [(1, [], 2), (1, ["0", "1"], 1)])
+
+        async def test_warm_loads_what_fits(self):
+                active = 0
+                peak = 0
+
+                async def load(guild_id: int) -> AlignmentChart:
+                        nonlocal active, peak
+                        active += 1
+                        peak = max(peak, active)
+                        await asyncio.sleep(0.01)
+                        active -= 1
+                        if guild_id == 3:
+                                msg = "unreadable"
+                                raise OSError(msg)
+                        return {"users": {}, "admins": []}
+
+                cache = ChartCache(load, self._save, max_guilds=5)
+                await cache.get(9)
+                with self.assertLogs("doge_cogs.cache", "ERROR"):
+                        await cache.warm(range(1, 9), concurrency=2)
+                self.assertEqual(peak, 2)
+                # Room for four more, one of which failed
+                self.assertEqual(sorted(cache.recent_guilds()), [1, 2, 4, 9])
+                await cache.get(9)
+                self.assertEqual(cache.recent_guilds()[0], 9)
+
+        async def test_eviction_keeps_awaited_locks(self):
+                cache = self._cache(max_guilds=1)
+                lock = cache.lock(1)
+                await lock.acquire()
+                waiter = asyncio.create_task(lock.acquire())
+                await asyncio.sleep(0)
+                await cache.get(1)
+                # Woken, but the waiter has not run to take the lock yet
+                lock.release()
+                await cache.get(2)  # evicts guild 1
+                self.assertNotIn(1, cache)
+                await waiter
+                # Held by the waiter, so still the guild's lock
+                self.assertIs(cache.lock(1), lock)
+                lock.release()
+
+        async def test_peek_does_not_load(self):
+                cache = ChartCache(self._load, self._save)
+                self.assertIsNone(cache.peek(1))
+                chart = await cache.get(1)
+                self.assertIs(cache.peek(1), chart)
+                self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+
+class TestProfileRefresher(unittest.IsolatedAsyncioTestCase):
+        def setUp(self):
+                self.applied: list[tuple[int, dict[str, Profile]]] = []
+
+        async def _apply(self, guild_id: int, profiles: dict[str, Profile]):
+                self.applied.append((guild_id, profiles))
+
+        async def test_coalesces_per_guild(self):
+                refresher = ProfileRefresher(self._apply, delay=0.01)
+                refresher.note(1, "0", Profile("a", None))
+                refresher.note(1, "0", Profile("b", None))
+                refresher.note(1, "1", Profile("c", None))
+                refresher.note(2, "0", Profile("d", None))
+                self.assertEqual(len(refresher), 3)
+                await asyncio.sleep(0.05)
+                self.assertEqual(
+                        sorted(self.applied),
+                        [
+                                (
+                                        1,
+                                        {
+                                                "0": Profile("b", None),
+                                                "1": Profile("c", None),
+                                        },
+                                ),
+                                (2, {"0": Profile("d", None)}),
+                        ],
+                )
+                self.assertEqual(len(refresher), 0)
+
+        async def test_bounded(self):
+                refresher = ProfileRefresher(
+                        self._apply, delay=60, max_pending=2
+                )
+                refresher.note(1, "0", Profile("a", None))
+                refresher.note(2, "0", Profile("b", None))
+                # Full: both guilds are flushed, and new users dropped
+                refresher.note(3, "0", Profile("c", None))
+                refresher.note(1, "0", Profile("e", None))
+                self.assertEqual((len(refresher), refresher.dropped), (2, 1))
+                await asyncio.sleep(0.01)
+                self.assertEqual(
+                        sorted(self.applied),
+                        [
+                                (1, {"0": Profile("e", None)}),
+                                (2, {"0": Profile("b", None)}),
+                        ],
+                )
+                refresher.note(3, "0", Profile("c", None))
+                self.assertEqual(len(refresher), 1)
+                await refresher.close()
+
+        async def test_close_flushes(self):
+                refresher = ProfileRefresher(self._apply, delay=60)
+                profile = Profile("a", "https://x/a.png")
+                refresher.note(1, "0", profile)
+                await refresher.close()
+                self.assertEqual(self.applied, [(1, {"0": profile})])
+
+        async def test_failures_are_logged(self):
+                async def apply(_guild_id: int, _profiles: dict) -> None:
+                        raise OSError
+
+                refresher = ProfileRefresher(apply, delay=60)
+                refresher.note(1, "0", Profile("a", None))
+                with self.assertLogs("doge_cogs.refresh", "ERROR"):
+                        await refresher.close()
+                self.assertEqual(len(refresher), 0)
+
+
+class TestChartStorage(unittest.IsolatedAsyncioTestCase):
+        async def test_async_round_trip(self):
+                with tempfile.TemporaryDirectory() as tmpdir:
+                        storage = ChartStorage(
+                                YamlBackend(Path(tmpdir)), max_workers=2
+                        )
+                        chart = set_user_alignment(
+                                {"users": {}, "admins": ["1"]},
+                                "123",
+                                "Neutral Good",
+                                "Tester",
+                        )
+                        await storage.save(7, chart)
+                        self.assertTrue(storage.backend.path_for(7).exists())
+                        loaded, empty = await asyncio.gather(
+                                storage.load(7), storage.load(8)
+                        )
+                        storage.close()
+                        self.assertEqual(loaded, chart)
+                        self.assertEqual(empty, {"users": {}, "admins": []})
+
+        def test_journal_replay_and_compaction(self):
+                with tempfile.TemporaryDirectory() as tmpdir:
+                        storage = YamlBackend(Path(tmpdir), compact_bytes=400)
+                        ops = [
+                                _set_op("1"),
+                                _set_op("2"),
+                                {"op": "add_admin", "user_id": "2"},
+                                {"op": "remove", "user_id": "1"},
+                        ]
+                        chart: AlignmentChart = {"users": {}, "admins": []}
+                        for op in ops:
+                                chart = apply_alignment_op(chart, op)
+                                storage.save(3, chart, [op])
+                        self.assertFalse(storage.path_for(3).exists())
+                        storage.close()
+                        journal = storage.journal_path_for(3)
+                        with journal.open("ab") as f:
+                                f.write(b'{"op":"remove","us')  # torn append
+                        on_disk = journal.read_bytes()
+                        storage = YamlBackend(Path(tmpdir), compact_bytes=400)
+                        self.assertEqual(storage.load(3), chart)
+                        # Loading leaves the files alone
+                        self.assertEqual(journal.read_bytes(), on_disk)
+                        self.assertFalse(storage.path_for(3).exists())
+
+                        for i in range(10):
+                                op = _set_op(str(i))
+                                chart = apply_alignment_op(chart, op)
+                                storage.save(3, chart, [op])
+                        self.assertLess(journal.stat().st_size, 400)
+                        self.assertEqual(
+                                YamlBackend(Path(tmpdir)).load(3), chart
+                        )
+                        storage.close()
+
+        def test_failed_append_is_cut_off(self):
+                def half_append(path: Path, data: BytesIO) -> int:
+                        with path.open("ab") as f:
+                                f.write(data.getvalue()[:10])
+                        raise OSError(errno.ENOSPC, "No space left on device")
+
+                with tempfile.TemporaryDirectory() as tmpdir:
+                        storage = YamlBackend(Path(tmpdir))
+                        chart: AlignmentChart = {"users": {}, "admins": []}
+                        op = _set_op("1")
+                        chart = apply_alignment_op(chart, op)
+                        storage.save(4, chart, [op])
+                        failed = _set_op("2")
+                        with (
+                                mock.patch(
+                                        "doge_cogs.storage.append_file_buffer",
+                                        half_append,
+                                ),
+                                self.assertRaises(OSError),
+                        ):
+                                storage.save(4, chart, [failed])
+                        # Retried, as ChartCache does, then one more
+                        for op in (failed, _set_op("3")):
+                                chart = apply_alignment_op(chart, op)
+                                storage.save(4, chart, [op])
+                        storage.close()
+                        self.assertEqual(
+                                YamlBackend(Path(tmpdir)).load(4), chart
+                        )
+
+        async def test_concurrent_updates_are_not_lost(self):
+                with tempfile.TemporaryDirectory() as tmpdir:
+                        storage = ChartStorage(
+                                YamlBackend(Path(tmpdir)), max_workers=4
+                        )
+                        cache = ChartCache(
+                                storage.load, storage.save, flush_after=25
+                        )
+
+                        async def add(i: int) -> None:
+                                await asyncio.sleep(0)
+                                await cache.update(1, _set_op(str(i)))
+
+                        await asyncio.gather(*(add(i) for i in range(300)))
+                        await cache.close()
+                        on_disk = storage.backend.load(1)
+                        storage.close()
+                        self.assertEqual(len(on_disk["users"]), 300)
+                        names = await asyncio.to_thread(os.listdir, tmpdir)
+                        self.assertLessEqual(
+                                set(names), {"1.yaml", "1.journal"}
+                        )
+
+
+class TestShardedBackend(unittest.TestCase):
+        def test_writes_touch_one_shard(self):
+                with tempfile.TemporaryDirectory() as tmpdir:
+                        backend = ShardedBackend(Path(tmpdir), shards=4)
+                        chart: AlignmentChart = {"users": {}, "admins": []}
+                        for i in range(20):
+                                chart = apply_alignment_op(
+                                        chart, _set_op(str(i))
+                                )
+                        backend.save(5, chart)
+                        backend.load(5)
+                        store = backend.shard_store(5, 4)
+                        snapshots = [store.path_for(n) for n in range(4)]
+                        before = [p.stat().st_ino for p in snapshots]
+                        op = {"op": "remove", "user_id": "7"}
+                        chart = apply_alignment_op(chart, op)
+                        backend.save(5, chart, [op])
+                        self.assertEqual(
+                                [
+                                        n
+                                        for n in range(4)
+                                        if store.journal_path_for(n).exists()
+                                ],
+                                [shard_of("7", 4)],
+                        )
+                        self.assertEqual(
+                                [p.stat().st_ino for p in snapshots], before
+                        )
+                        op = {"op": "add_admin", "user_id": "3"}
+                        chart = apply_alignment_op(chart, op)
+                        backend.save(5, chart, [op])
+                        backend.close()
+
+                        backend = ShardedBackend(Path(tmpdir))
+                        self.assertEqual(backend.load(5), chart)
+                        self.assertEqual(
+                                backend.get_user(5, "3"), chart["users"]["3"]
+                        )
+                        self.assertIsNone(backend.get_user(5, "7"))
+                        self.assertEqual(backend.guild_ids(), [5])
+                        backend.close()
+
+        def test_keeps_only_recent_guilds(self):
+                with tempfile.TemporaryDirectory() as tmpdir:
+                        backend = ShardedBackend(
+                                Path(tmpdir), shards=2, max_guilds=2
+                        )
+                        charts = {}
+                        for guild_id in range(5):
+                                chart: AlignmentChart = {
+                                        "users": {},
+                                        "admins": [],
+                                }
+                                chart = apply_alignment_op(chart, _set_op("1"))
+                                backend.save(guild_id, chart)
+                                op = {"op": "add_admin", "user_id": "1"}
+                                chart = apply_alignment_op(chart, op)
+                                backend.save(guild_id, chart, [op])
+                                charts[guild_id] = chart
+                        # Guild 0 fell out; its save rewrites every shard
+                        op = _set_op("2")
+                        charts[0] = apply_alignment_op(charts[0], op)
+                        backend.save(0, charts[0], [op])
+                        state = (
+                                backend._stores,  # noqa: SLF001
+                                backend._members,  # noqa: SLF001
+                                backend._meta,  # noqa: SLF001
+                        )
+                        for kept in state:
+                                self.assertEqual(sorted(kept), [0, 4])
+                        self.assertEqual(len(backend._locks), 0)  # noqa: SLF001
+                        backend.close()
+
+                        backend = ShardedBackend(Path(tmpdir))
+                        for guild_id, chart in charts.items():
+                                self.assertEqual(backend.load(guild_id), chart)
+                        backend.close()
+
+        def test_converts_between_layouts(self):
+                with tempfile.TemporaryDirectory() as tmpdir:
+                        data_dir = Path(tmpdir)
+                        single = YamlBackend(data_dir)
+                        chart: AlignmentChart = {"users": {}, "admins": []}
+                        ops = [_set_op(str(i)) for i in range(10)]
+                        ops.append({"op": "add_admin", "user_id": "1"})
+                        for op in ops:
+                                chart = apply_alignment_op(chart, op)
+                                single.save(2, chart, [op])
+
+                        sharded = ShardedBackend(data_dir, shards=3)
+                        self.assertEqual(sharded.load(2), chart)
+                        self.assertEqual(sharded_guild_ids(data_dir), [])
+                        op = _set_op("10")
+                        chart = apply_alignment_op(chart, op)
+                        sharded.save(2, chart, [op])
+                        self.assertEqual(sharded_guild_ids(data_dir), [2])
+                        self.assertFalse(single.exists(2))
+                        sharded.close()
+
+                        single = YamlBackend(data_dir)
+                        self.assertEqual(single.guild_ids(), [2])
+                        self.assertEqual(single.load(2), chart)
+                        self.assertEqual(sharded_guild_ids(data_dir), [2])
+                        op = _set_op("11")
+                        chart = apply_alignment_op(chart, op)
+                        single.save(2, chart, [op])
+                        self.assertEqual(single.load(2), chart)
+                        self.assertEqual(sharded_guild_ids(data_dir), [])
+                        self.assertEqual(
+                                [p.name for p in data_dir.iterdir()], ["2.yaml"]
+                        )
+                        single.close()
+
+
+class TestSqliteBackend(unittest.TestCase):
+        def test_ops_and_queries(self):
+                with tempfile.TemporaryDirectory() as tmpdir:
+                        backend = SqliteBackend(Path(tmpdir) / "charts.db")
+                        chart: AlignmentChart = {"users": {}, "admins": []}
+                        ops = [
+                                _set_op("1", "Lawful Good"),
+                                _set_op("2", "Chaotic Evil"),
+                                _set_op("3", "Chaotic Evil"),
+                                _set_op("1", "Chaotic Evil"),
+                                {"op": "remove", "user_id": "2"},
+                                {"op": "add_admin", "user_id": "3"},
+                        ]
+                        for op in ops:
+                                chart = apply_alignment_op(chart, op)
+                        backend.save(9, chart, ops)
+                        self.assertEqual(backend.load(9), chart)
+                        self.assertEqual(
+                                backend.get_user(9, "3"), chart["users"]["3"]
+                        )
+                        self.assertIsNone(backend.get_user(9, "2"))
+                        evil = backend.users_with_alignment(9, "Chaotic Evil")
+                        self.assertEqual(list(evil), ["1", "3"])
+                        backend.close()
+
+        def test_migrate_from_yaml(self):
+                with tempfile.TemporaryDirectory() as tmpdir:
+                        data_dir = Path(tmpdir) / "data"
+                        yaml_backend = YamlBackend(data_dir)
+                        charts = {}
+                        for guild_id in (1, 2):
+                                empty: AlignmentChart = {
+                                        "users": {},
+                                        "admins": [str(guild_id)],
+                                }
+                                chart = set_user_alignment(
+                                        empty,
+                                        "5",
+                                        "Neutral Evil",
+                                        "Tester",
+                                )
+                                yaml_backend.save(guild_id, chart)
+                                charts[guild_id] = chart
+                        # Guild 2 has a journal, guild 3 is sharded
+                        op = _set_op("6")
+                        charts[2] = apply_alignment_op(charts[2], op)
+                        yaml_backend.save(2, charts[2], [op])
+                        sharded = ShardedBackend(data_dir, shards=2)
+                        charts[3] = apply_alignment_op(charts[1], op)
+                        sharded.save(3, charts[3])
+                        sharded.close()
+                        before = {
+                                path: path.read_bytes()
+                                for path in data_dir.rglob("*")
+                                if path.is_file()
+                        }
+                        db_path = Path(tmpdir) / "charts.db"
+                        self.assertEqual(
+                                migrate_yaml_to_sqlite(data_dir, db_path), 3
+                        )
+                        self.assertEqual(
+                                {
+                                        path: path.read_bytes()
+                                        for path in data_dir.rglob("*")
+                                        if path.is_file()
+                                },
+                                before,
+                        )
+                        backend = SqliteBackend(db_path)
+                        self.assertEqual(backend.guild_ids(), [1, 2, 3])
+                        for guild_id, chart in charts.items():
+                                self.assertEqual(backend.load(guild_id), chart)
+                        backend.close()
+
+
+class _AvatarHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        delay = 0.05
+
+        def do_GET(self):  # noqa: N802
+                with self.server.lock:
+                        self.server.requests.append(self.path)
+                        self.server.active += 1
+                        self.server.peak = max(
+                                self.server.peak, self.server.active
+                        )
+                try:
+                        self._respond()
+                finally:
+                        with self.server.lock:
+                                self.server.active -= 1
+
+        def _respond(self):
+                time.sleep(self.delay)
+                if self.path.startswith("/missing"):
+                        self.send_error(404)
+                        return
+                if self.path.startswith("/slow"):
+                        time.sleep(1)
+                body = self.path.encode()
+                try:
+                        self.send_response(200)
+                        self.send_header("Content-Length", str(len(body)))
+                        self.end_headers()
+                        self.wfile.write(body)
+                except ConnectionError:
+                        pass  # the client gave up waiting
+
+        def log_message(self, *args: object) -> None:
+                pass
+
+
+class _AvatarServer(ThreadingHTTPServer):
+        daemon_threads = True
+        request_queue_size = 128
+
+        def __init__(self) -> None:
+                super().__init__(("127.0.0.1", 0), _AvatarHandler)
+                self.lock = threading.Lock()
+                self.requests = []
+                self.active = 0
+                self.peak = 0
+
+
+class TestAvatarFetcher(unittest.IsolatedAsyncioTestCase):
+        def setUp(self):
+                self.server = _AvatarServer()
+                threading.Thread(
+                        target=self.server.serve_forever, daemon=True
+                ).start()
+                host, port = self.server.server_address
+                self.base = f"http://{host}:{port}"
+
+        def tearDown(self):
+                self.server.shutdown()
+                self.server.server_close()
+
+        async def test_concurrent_downloads_are_bounded(self):
+                fetcher = AvatarFetcher(limit_per_host=50)
+                urls = {str(i): f"{self.base}/{i}.png" for i in range(500)}
+                start = time.perf_counter()
+                images = await fetcher.fetch_many(urls)
+                elapsed = time.perf_counter() - start
+                await fetcher.close()
+                self.assertEqual(images["7"], b"/7.png")
+                self.assertEqual(len(self.server.requests), 500)
+                self.assertLessEqual(self.server.peak, 50)
+                # 500 x 50ms sequentially would take 25s; 10 waves of 50
+                # take about half a second
+                self.assertLess(elapsed, 5)
+
+        async def test_identical_urls_share_a_download(self):
+                fetcher = AvatarFetcher()
+                url = f"{self.base}/same.png"
+                first = await asyncio.gather(
+                        fetcher.fetch_many({str(i): url for i in range(50)}),
+                        fetcher.fetch(url),
+                )
+                await fetcher.close()
+                self.assertEqual(set(first[0].values()), {b"/same.png"})
+                self.assertEqual(self.server.requests, ["/same.png"])
+
+        async def test_failures_fall_back_to_placeholder(self):
+                fetcher = AvatarFetcher(timeout=0.5, placeholder=b"?")
+                images = await fetcher.fetch_many(
+                        {
+                                "1": f"{self.base}/missing.png",
+                                "2": f"{self.base}/slow.png",
+                                "3": None,
+                        }
+                )
+                await fetcher.close()
+                self.assertEqual(images, {"1": b"?", "2": b"?", "3": b"?"})
+
+        async def test_disk_cache_skips_the_network(self):
+                with tempfile.TemporaryDirectory() as tmpdir:
+                        urls = {
+                                str(i): f"{self.base}/{i}.png"
+                                for i in range(20)
+                        }
+                        for _ in range(2):
+                                fetcher = AvatarFetcher(
+                                        cache=AvatarDiskCache(Path(tmpdir))
+                                )
+                                images = await fetcher.fetch_many(urls)
+                                await fetcher.close()
+                                self.assertEqual(images["3"], b"/3.png")
+                        self.assertEqual(len(self.server.requests), 20)
+
+
+class TestAvatarDiskCache(unittest.TestCase):
+        def test_lru_eviction_within_budget(self):
+                with tempfile.TemporaryDirectory() as tmpdir:
+                        cache = AvatarDiskCache(Path(tmpdir), max_bytes=30)
+                        cache.put("a", b"a" * 10)
+                        cache.put("b", b"b" * 10)
+                        cache.put("c", b"c" * 10)
+                        self.assertEqual(cache.get("a"), b"a" * 10)
+                        cache.put("d", b"d" * 10)  # evicts b, the LRU entry
+                        self.assertNotIn("b", cache)
+                        self.assertIsNone(cache.get("b"))
+                        self.assertEqual(cache.total_bytes, 30)
+                        self.assertFalse(
+                                (Path(tmpdir) / cache.key_for("b")).exists()
+                        )
+                        cache.close()
+
+                        reopened = AvatarDiskCache(Path(tmpdir), max_bytes=30)
+                        self.assertEqual(reopened.total_bytes, 30)
+                        reopened.put("e", b"e" * 10)  # evicts c
+                        self.assertNotIn("c", reopened)
+                        self.assertEqual(reopened.get("a"), b"a" * 10)
+
+        def test_reads_do_not_write_the_index(self):
+                with tempfile.TemporaryDirectory() as tmpdir:
+                        cache = AvatarDiskCache(Path(tmpdir))
+                        cache.put("a", b"a")
+                        cache.close()
+                        index = Path(tmpdir) / "index.json"
+                        saved = index.stat().st_mtime_ns
+                        for _ in range(200):
+                                cache.get("a")
+                        self.assertEqual(index.stat().st_mtime_ns, saved)
+
+        def test_unindexed_files_are_counted_and_evicted_first(self):
+                with tempfile.TemporaryDirectory() as tmpdir:
+                        cache = AvatarDiskCache(Path(tmpdir), max_bytes=30)
+                        cache.put("a", b"a" * 10)
+                        cache.close()
+                        # Written after the last index save, then a crash
+                        stray = Path(tmpdir) / cache.key_for("b")
+                        stray.write_bytes(b"b" * 10)
+                        (Path(tmpdir) / cache.key_for("a")).unlink()
+
+                        reopened = AvatarDiskCache(Path(tmpdir), max_bytes=30)
+                        self.assertEqual(reopened.total_bytes, 10)
+                        self.assertNotIn("a", reopened)
+                        reopened.put("c", b"c" * 10)
+                        reopened.put("d", b"d" * 10)
+                        reopened.put("e", b"e" * 10)  # evicts b
+                        self.assertFalse(stray.exists())
+                        self.assertEqual(reopened.total_bytes, 30)
 
 
 def main():
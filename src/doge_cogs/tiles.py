@@ -0,0 +1,135 @@
+from __future__ import annotations  # noqa: D100
+
+import hashlib
+import struct
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import TYPE_CHECKING, NamedTuple
+
+if TYPE_CHECKING:
+        from doge_cogs.alignment import BorderShape, RenderEngine
+
+DEFAULT_TILE_BYTES = 64 * 1024 * 1024
+
+_SPILL_HEADER = struct.Struct("<II")
+
+
+class TileKey(NamedTuple):
+        source: str  # hash of the source image bytes
+        size: int
+        border: int
+        border_color: str
+        shape: BorderShape
+        engine: RenderEngine = "wand"  # engines style tiles differently
+
+
+class Tile(NamedTuple):
+        width: int
+        height: int
+        rgba: bytes  # 8-bit RGBA pixels, row major
+
+
+def source_hash(data: bytes) -> str:
+        """Return the digest identifying a source image."""
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class TileCache:
+        """LRU cache of finished avatar tiles as raw RGBA pixels.
+
+        Keeping the styled pixels means a re-render only has to blit each
+        unchanged avatar instead of resizing, masking and bordering it
+        again. Memory use is bounded by ``max_bytes``. With a
+        ``spill_dir``, evicted tiles are written there and read back on
+        a later miss instead of being rebuilt.
+        """
+
+        def __init__(
+                self,
+                *,
+                max_bytes: int = DEFAULT_TILE_BYTES,
+                spill_dir: Path | None = None,
+        ) -> None:
+                self.max_bytes = max_bytes
+                self.spill_dir = spill_dir
+                if spill_dir is not None:
+                        spill_dir.mkdir(parents=True, exist_ok=True)
+                self.hits = 0
+                self.misses = 0
+                self._tiles: OrderedDict[TileKey, Tile] = OrderedDict()
+                self._total = 0
+                self._lock = threading.Lock()
+
+        def __len__(self) -> int:
+                return len(self._tiles)
+
+        @property
+        def total_bytes(self) -> int:
+                """Return the bytes of pixel data held in memory."""
+                return self._total
+
+        def _spill_path(self, key: TileKey) -> Path:
+                name = hashlib.blake2b(
+                        repr(tuple(key)).encode(), digest_size=16
+                ).hexdigest()
+                return self.spill_dir / f"{name}.rgba"
+
+        def get(self, key: TileKey) -> Tile | None:
+                """Return a cached tile, from memory or the spill directory."""
+                with self._lock:
+                        tile = self._tiles.get(key)
+                        if tile is not None:
+                                self._tiles.move_to_end(key)
+                                self.hits += 1
+                                return tile
+                if self.spill_dir is not None:
+                        try:
+                                raw = self._spill_path(key).read_bytes()
+                        except OSError:
+                                pass
+                        else:
+                                width, height = _SPILL_HEADER.unpack_from(raw)
+                                tile = Tile(
+                                        width,
+                                        height,
+                                        raw[_SPILL_HEADER.size :],
+                                )
+                                self.put(key, tile)
+                                with self._lock:
+                                        self.hits += 1
+                                return tile
+                with self._lock:
+                        self.misses += 1
+                return None
+
+        def put(self, key: TileKey, tile: Tile) -> None:
+                """Cache a tile, evicting the least recently used ones."""
+                if len(tile.rgba) > self.max_bytes:
+                        return
+                with self._lock:
+                        old = self._tiles.pop(key, None)
+                        if old is not None:
+                                self._total -= len(old.rgba)
+                        self._tiles[key] = tile
+                        self._total += len(tile.rgba)
+                        evicted = []
+                        while self._total > self.max_bytes:
+                                old_key, old = self._tiles.popitem(last=False)
+                                self._total -= len(old.rgba)
+                                evicted.append((old_key, old))
+                if self.spill_dir is not None:
+                        for old_key, old in evicted:
+                                self._spill(old_key, old)
+
+        def _spill(self, key: TileKey, tile: Tile) -> None:
+                path = self._spill_path(key)
+                if path.exists():
+                        return
+                with tempfile.NamedTemporaryFile(
+                        dir=self.spill_dir, suffix=".tmp", delete=False
+                ) as tmp:
+                        tmp.write(_SPILL_HEADER.pack(tile.width, tile.height))
+                        tmp.write(tile.rgba)
+                Path(tmp.name).replace(path)
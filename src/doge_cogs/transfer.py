@@ -0,0 +1,185 @@
+from __future__ import annotations  # noqa: D100
+
+import csv
+import io
+import tempfile
+from typing import IO, TYPE_CHECKING, Literal, get_args
+
+import yaml
+
+from doge_cogs.alignment import AlignmentName, ChartDumper, SafeLoader
+
+if TYPE_CHECKING:
+        from collections.abc import Iterator
+
+        import aiohttp
+
+        from doge_cogs.alignment import AlignmentChart, SetAlignmentOp
+
+TransferFormat = Literal["csv", "yaml"]
+
+CSV_FIELDS = ("user_id", "alignment", "display_name", "avatar_url")
+DEFAULT_IMPORT_BYTES = 16 * 1024 * 1024
+# Transfers larger than this go to a temporary file instead of memory
+SPOOL_BYTES = 1024 * 1024
+# Imports apply and save this many users at a time
+IMPORT_BATCH_OPS = 500
+
+ALIGNMENTS = frozenset(get_args(AlignmentName))
+
+
+def format_for_filename(filename: str) -> TransferFormat | None:
+        """Return the transfer format implied by a file name, if any."""
+        suffix = filename.rsplit(".", 1)[-1].lower()
+        if suffix == "csv":
+                return "csv"
+        if suffix in ("yaml", "yml"):
+                return "yaml"
+        return None
+
+
+def export_chart(
+        chart: AlignmentChart,
+        fmt: TransferFormat,
+        out: IO[bytes],
+) -> None:
+        """Write a chart's users to ``out`` as CSV, or the whole chart as YAML.
+
+        Rows are written as they are produced, never as one big string.
+        YAML exports are regular chart files.
+        """
+        if fmt == "yaml":
+                yaml.dump(
+                        chart,
+                        out,
+                        Dumper=ChartDumper,
+                        sort_keys=False,
+                        encoding="utf-8",
+                )
+                return
+        text = io.TextIOWrapper(out, encoding="utf-8", newline="")
+        writer = csv.writer(text)
+        writer.writerow(CSV_FIELDS)
+        for user_id, entry in chart["users"].items():
+                writer.writerow(
+                        (
+                                user_id,
+                                entry["alignment"],
+                                entry["display_name"],
+                                entry["avatar_url"] or "",
+                        )
+                )
+        text.flush()
+        # Leave ``out`` open for the caller
+        text.detach()
+
+
+def export_to_spool(chart: AlignmentChart, fmt: TransferFormat) -> IO[bytes]:
+        """Export a chart into a spooled temporary file, rewound."""
+        spool = tempfile.SpooledTemporaryFile(  # noqa: SIM115
+                max_size=SPOOL_BYTES
+        )
+        try:
+                export_chart(chart, fmt, spool)
+        except BaseException:
+                spool.close()
+                raise
+        spool.seek(0)
+        return spool
+
+
+def _set_op(row: dict, where: str) -> SetAlignmentOp:
+        user_id = str(row.get("user_id") or "").strip()
+        if not user_id.isdigit():
+                msg = f"{where}: invalid user ID {user_id!r}"
+                raise ValueError(msg)
+        alignment = row.get("alignment")
+        if alignment not in ALIGNMENTS:
+                msg = f"{where}: unknown alignment {alignment!r}"
+                raise ValueError(msg)
+        display_name = row.get("display_name") or user_id
+        avatar_url = row.get("avatar_url") or None
+        if not isinstance(display_name, str) or not isinstance(
+                avatar_url, str | None
+        ):
+                msg = f"{where}: display_name and avatar_url must be text"
+                raise TypeError(msg)
+        return {
+                "op": "set",
+                "user_id": user_id,
+                "alignment": alignment,
+                "display_name": display_name,
+                "avatar_url": avatar_url,
+        }
+
+
+def import_chart_ops(
+        fmt: TransferFormat,
+        data: IO[bytes],
+) -> Iterator[SetAlignmentOp]:
+        """Yield one set operation per user in a CSV or YAML export.
+
+        CSV files are read a row at a time. Admins in YAML files are
+        ignored, an import never grants admin rights. Raises
+        ``ValueError`` or, for entries of the wrong type, ``TypeError``
+        naming the first invalid row or user.
+        """
+        if fmt == "csv":
+                text = io.TextIOWrapper(data, encoding="utf-8-sig", newline="")
+                reader = csv.DictReader(text)
+                fields = set(reader.fieldnames or ())
+                missing = {"user_id", "alignment"} - fields
+                if missing:
+                        msg = f"CSV header lacks {', '.join(sorted(missing))}"
+                        raise ValueError(msg)
+                for row in reader:
+                        yield _set_op(row, f"Line {reader.line_num}")
+                return
+        try:
+                loaded = yaml.load(data, Loader=SafeLoader)  # noqa: S506
+        except yaml.YAMLError as e:
+                msg = f"Invalid YAML: {e}"
+                raise ValueError(msg) from e
+        users = loaded.get("users") if isinstance(loaded, dict) else None
+        if not isinstance(users, dict):
+                msg = "YAML file has no users mapping"
+                raise TypeError(msg)
+        for user_id, entry in users.items():
+                if not isinstance(entry, dict):
+                        msg = f"User {user_id}: entry is not a mapping"
+                        raise TypeError(msg)
+                yield _set_op({**entry, "user_id": user_id}, f"User {user_id}")
+
+
+async def download_to_spool(
+        session: aiohttp.ClientSession,
+        url: str,
+        *,
+        max_bytes: int = DEFAULT_IMPORT_BYTES,
+) -> IO[bytes]:
+        """Stream a download into a spooled temporary file.
+
+        Small files stay in memory, larger ones go to disk. Raises
+        ``ValueError`` once more than ``max_bytes`` arrive.
+        """
+        spool = tempfile.SpooledTemporaryFile(  # noqa: SIM115
+                max_size=SPOOL_BYTES
+        )
+        try:
+                async with session.get(url) as response:
+                        response.raise_for_status()
+                        async for chunk in response.content.iter_chunked(
+                                64 * 1024
+                        ):
+                                spool.write(chunk)
+                                if spool.tell() > max_bytes:
+                                        break
+        except BaseException:
+                spool.close()
+                raise
+        if spool.tell() > max_bytes:
+                spool.close()
+                msg = "File is too large to import"
+                raise ValueError(msg)
+        spool.seek(0)
+        return spool